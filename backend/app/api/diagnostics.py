@@ -0,0 +1,93 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from app.core.admin import require_admin
+from app.core.config import settings
+from app.services.diagnostics import (
+    DiagnosticsBusy, collapsed_text, dump_tasks, loop_lag, memory_tracer, request_profiler, sample_process
+)
+
+# Operator-only; every route 404s unless ADMIN_TOKEN is configured
+router = APIRouter(prefix="/admin/diagnostics", dependencies=[Depends(require_admin)])
+
+
+@router.get("/profile")
+async def cpu_profile(
+    seconds: float = Query(10.0, gt=0, description="Capped at DIAG_PROFILE_MAX_S"),
+    interval_ms: float = Query(settings.DIAG_PROFILE_INTERVAL_MS, ge=1),
+    format: str = Query("collapsed", pattern="^(collapsed|json)$")
+):
+    """Sampling profile of all threads; `collapsed` output feeds flamegraph.pl or speedscope."""
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(None, sample_process, seconds, interval_ms)
+    except DiagnosticsBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "collapsed":
+        return PlainTextResponse(collapsed_text(result["stacks"]))
+    return {**result, "stacks": dict(result["stacks"].most_common(200))}
+
+
+@router.get("/profiles")
+async def list_profiles():
+    return {"profiles": request_profiler.profiles()}
+
+
+@router.get("/profiles/{key}")
+async def get_profile(key: str, format: str = Query("collapsed", pattern="^(collapsed|json)$")):
+    """Per-request profile, keyed `upload:<doc_id>` or `invoice:<doc_id>` (see X-Profile on /upload)."""
+    session = request_profiler.get(key)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"No profile {key}")
+    if format == "collapsed":
+        return PlainTextResponse(collapsed_text(session.stacks))
+    return {
+        "key": session.key,
+        "duration_s": session.duration_s,
+        "samples": session.samples,
+        "stage_ms": session.stage_ms,
+        "stacks": dict(session.stacks.most_common(200)),
+    }
+
+
+@router.post("/memory/start")
+async def start_memory_trace(frames: int = Query(settings.DIAG_TRACEMALLOC_FRAMES, ge=1, le=50)):
+    try:
+        return memory_tracer.start(frames)
+    except DiagnosticsBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.get("/memory/diff")
+async def memory_diff(
+    top: int = Query(25, ge=1, le=500),
+    key_type: str = Query("lineno", pattern="^(lineno|filename|traceback)$"),
+    rebase: bool = Query(False, description="Make this snapshot the new baseline")
+):
+    """Allocation growth since `memory/start` (or the last rebase), largest first."""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, memory_tracer.diff, top, key_type, rebase)
+    except DiagnosticsBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.post("/memory/stop")
+async def stop_memory_trace():
+    return memory_tracer.stop()
+
+
+@router.get("/memory")
+async def memory_status():
+    return memory_tracer.status()
+
+
+@router.get("/tasks")
+async def get_tasks(stack_depth: int = Query(3, ge=0, le=50)):
+    """All asyncio tasks and where they are suspended, plus every in-flight invoice's running stages."""
+    return dump_tasks(stack_depth)
+
+
+@router.get("/loop-lag")
+async def get_loop_lag():
+    return loop_lag.stats()
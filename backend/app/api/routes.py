@@ -1,14 +1,29 @@
-from fastapi import APIRouter, UploadFile, File, BackgroundTasks, HTTPException
+from fastapi import APIRouter, UploadFile, File, HTTPException, Query, Request, Response, Header, Depends
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import uuid
+import hashlib
 import logging
-import json
-from datetime import datetime
-from typing import List
+from datetime import date, datetime
+from typing import List, Optional
 
-from app.core.config import settings
 from app.core.db import get_snowflake_connection, q
-from app.models.schemas import InvoiceUploadResponse, FinalResult, MetricsResponse, StatusResponse
+from app.core.serialization import RawJSONResponse
+from app.core.tenancy import get_company_id
+from app.core.admin import is_admin, require_admin
+from app.core.breakers import BREAKERS
+from app.models.schemas import (
+    InvoiceUploadResponse, FinalResult, MetricsResponse, StatusResponse, AnalyticsResponse,
+    UploadInitRequest, UploadSessionResponse, ChunkUploadResponse, UploadCompleteRequest
+)
 from app.services.orchestrator import orchestrator
+from app.services.export import EXPORT_FORMATS, ExportFilters, stream_export
+from app.services.analytics import DIMENSIONS, query_analytics
+from app.services.uploads import UploadError, register_document, upload_store
+from app.services.write_buffer import write_buffer
+from app.services.scheduler import pipeline_scheduler, gemini_quota, nominatim_quota
+from app.services.retry_queue import retry_queue
+from app.services.diagnostics import request_profiler
 
 logger = logging.getLogger(__name__)
 
@@ -16,68 +31,127 @@ router = APIRouter()
 
 @router.post("/upload", response_model=InvoiceUploadResponse)
 async def upload_invoice(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
+    response: Response,
+    file: UploadFile = File(...),
+    company_id: str = Depends(get_company_id),
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None)
 ):
+    doc_id = str(uuid.uuid4())
+    # Opt-in profiling of this request and of the invoice's pipeline run (admins only);
+    # results are served under /admin/diagnostics/profiles
+    if x_profile and is_admin(x_admin_token):
+        request_profiler.request(doc_id)
+        response.headers["X-Profile-Keys"] = f"upload:{doc_id},invoice:{doc_id}"
+        async with request_profiler.session(f"upload:{doc_id}", strict=False):
+            return await _accept_upload(doc_id, file, company_id)
+    return await _accept_upload(doc_id, file, company_id)
+
+async def _accept_upload(doc_id: str, file: UploadFile, company_id: str) -> InvoiceUploadResponse:
     try:
-        doc_id = str(uuid.uuid4())
         file_content = await file.read()
         file_type = file.content_type or "application/octet-stream"
-        file_size = len(file_content)
-        
-        conn = get_snowflake_connection()
-        cursor = conn.cursor()
-        try:
-            # Explicitly USE context just in case session lost it
-            cursor.execute(f"USE DATABASE {settings.SNOWFLAKE_DATABASE}")
-            cursor.execute(f"USE SCHEMA {settings.SNOWFLAKE_SCHEMA}")
-            cursor.execute(f"USE WAREHOUSE {settings.SNOWFLAKE_WAREHOUSE}")
-
-            cursor.execute(
-                f"INSERT INTO {q('RAW_DOCUMENTS')} (DOC_ID, COMPANY_ID, SOURCE_SYSTEM, FILE_NAME, FILE_TYPE, RAW_BINARY, FILE_SIZE_BYTES, PROCESSING_STATUS) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                (doc_id, "DEFAULT_COMPANY", "WEB_UPLOAD", file.filename, file_type, file_content, file_size, "uploaded")
-            )
-        finally:
-            cursor.close()
-            conn.close()
-
-        background_tasks.add_task(orchestrator.process_invoice, doc_id)
+        file_hash = hashlib.sha256(file_content).hexdigest()
+
+        register_document(doc_id, file.filename, file_type, file_content, file_hash, company_id=company_id)
+
+        pipeline_scheduler.submit(company_id, doc_id, orchestrator.process_invoice)
 
         return InvoiceUploadResponse(
             doc_id=doc_id,
             status="uploaded",
-            message="Invoice received and processing started."
+            message="Invoice received and queued for processing."
         )
 
     except Exception as e:
         logger.error(f"Upload failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _session_response(session: dict) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=session["upload_id"],
+        chunk_size=session["chunk_size"],
+        total_chunks=session["total_chunks"],
+        received_chunks=session.get("received_chunks", []),
+        doc_id=session.get("doc_id")
+    )
+
+@router.post("/uploads", response_model=UploadSessionResponse)
+async def init_upload(body: UploadInitRequest, company_id: str = Depends(get_company_id)):
+    try:
+        session = upload_store.create(company_id, body.file_name, body.file_type, body.file_size)
+        return _session_response(session)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload(upload_id: str, company_id: str = Depends(get_company_id)):
+    try:
+        return _session_response(upload_store.status(upload_id, company_id))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.put("/uploads/{upload_id}/chunks/{index}", response_model=ChunkUploadResponse)
+async def upload_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None),
+    company_id: str = Depends(get_company_id)
+):
+    try:
+        # Body is streamed to disk as it arrives, never buffered whole
+        sha, size = await upload_store.write_chunk(upload_id, index, request.stream(), x_chunk_sha256, company_id)
+        return ChunkUploadResponse(upload_id=upload_id, index=index, sha256=sha, size=size)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@router.post("/uploads/{upload_id}/complete", response_model=InvoiceUploadResponse)
+async def complete_upload(
+    upload_id: str,
+    body: Optional[UploadCompleteRequest] = None,
+    company_id: str = Depends(get_company_id)
+):
+    def register(doc_id: str, meta: dict, content: bytearray, file_hash: str):
+        register_document(doc_id, meta["file_name"], meta["file_type"], content, file_hash, company_id=company_id)
+
+    try:
+        # Idempotent: a retried or concurrent complete gets the DOC_ID of the first one
+        doc_id, registered_now = await run_in_threadpool(
+            upload_store.complete, upload_id, register, body.sha256 if body else None, company_id
+        )
+        if registered_now:
+            pipeline_scheduler.submit(company_id, doc_id, orchestrator.process_invoice)
+
+        return InvoiceUploadResponse(
+            doc_id=doc_id,
+            status="uploaded",
+            message="Invoice received and queued for processing." if registered_now else "Upload already completed."
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        logger.error(f"Upload finalize failed for {upload_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/invoice/{doc_id}", response_model=FinalResult)
-async def get_invoice(doc_id: str):
+async def get_invoice(doc_id: str, company_id: str = Depends(get_company_id)):
     conn = get_snowflake_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute(f"SELECT STANDARDIZED_JSON, CARBON_KG_CO2E, CONFIDENCE_SCORE, AUDIT_FLAGS, RULE_VERSION, FINALIZED_TS FROM {q('FINAL_AUDIT_RESULTS')} WHERE DOC_ID = '{doc_id}'")
+        # The stored VARIANT already is a serialized FinalResult, so hand its JSON
+        # text straight to the client instead of decoding and re-validating it.
+        cursor.execute(f"SELECT TO_JSON(STANDARDIZED_JSON) FROM {q('FINAL_AUDIT_RESULTS')} WHERE DOC_ID = %s AND COMPANY_ID = %s", (doc_id, company_id))
         row = cursor.fetchone()
         
         if not row:
-            cursor.execute(f"SELECT PROCESSING_STATUS FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = '{doc_id}'")
+            cursor.execute(f"SELECT PROCESSING_STATUS FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = %s AND COMPANY_ID = %s", (doc_id, company_id))
             status_row = cursor.fetchone()
             if status_row:
                 raise HTTPException(status_code=404, detail=f"Invoice is processing or failed. Status: {status_row[0]}")
             raise HTTPException(status_code=404, detail="Invoice not found")
             
-        standardized_data = json.loads(row[0])
-        
-        return FinalResult(
-            doc_id=doc_id,
-            extraction=standardized_data.get("extraction"),
-            mapping=standardized_data.get("mapping"),
-            carbon=standardized_data.get("carbon"),
-            audit=standardized_data.get("audit"),
-            finalized_ts=row[5]
-        )
+        return RawJSONResponse(row[0])
     except HTTPException:
         raise
     except Exception as e:
@@ -88,11 +162,14 @@ async def get_invoice(doc_id: str):
         conn.close()
 
 @router.get("/invoices")
-async def list_invoices():
+async def list_invoices(company_id: str = Depends(get_company_id)):
     conn = get_snowflake_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute(f"SELECT DOC_ID, FILE_NAME, PROCESSING_STATUS, UPLOAD_TS FROM {q('RAW_DOCUMENTS')} ORDER BY UPLOAD_TS DESC LIMIT 50")
+        cursor.execute(
+            f"SELECT DOC_ID, FILE_NAME, PROCESSING_STATUS, UPLOAD_TS FROM {q('RAW_DOCUMENTS')} WHERE COMPANY_ID = %s ORDER BY UPLOAD_TS DESC LIMIT 50",
+            (company_id,)
+        )
         rows = cursor.fetchall()
         
         invoices = []
@@ -109,11 +186,11 @@ async def list_invoices():
         conn.close()
 
 @router.get("/status/{doc_id}", response_model=StatusResponse)
-async def get_status(doc_id: str):
+async def get_status(doc_id: str, company_id: str = Depends(get_company_id)):
     conn = get_snowflake_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute(f"SELECT PROCESSING_STATUS, UPLOAD_TS FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = '{doc_id}'")
+        cursor.execute(f"SELECT PROCESSING_STATUS, UPLOAD_TS FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = %s AND COMPANY_ID = %s", (doc_id, company_id))
         row = cursor.fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Invoice not found")
@@ -128,17 +205,21 @@ async def get_status(doc_id: str):
         conn.close()
 
 @router.get("/metrics", response_model=MetricsResponse)
-async def get_metrics():
+async def get_metrics(company_id: str = Depends(get_company_id)):
     conn = get_snowflake_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute(f"SELECT COUNT(*) FROM {q('RAW_DOCUMENTS')}")
+        cursor.execute(f"SELECT COUNT(*) FROM {q('RAW_DOCUMENTS')} WHERE COMPANY_ID = %s", (company_id,))
         total = cursor.fetchone()[0]
         
-        cursor.execute(f"SELECT AVG(CARBON_KG_CO2E) FROM {q('FINAL_AUDIT_RESULTS')}")
+        cursor.execute(f"SELECT AVG(CARBON_KG_CO2E) FROM {q('FINAL_AUDIT_RESULTS')} WHERE COMPANY_ID = %s", (company_id,))
         avg_carbon = cursor.fetchone()[0] or 0.0
         
-        cursor.execute(f"SELECT COUNT(*) FROM {q('ERROR_LOG')}")
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM {q('ERROR_LOG')} e
+            JOIN {q('RAW_DOCUMENTS')} r ON e.DOC_ID = r.DOC_ID
+            WHERE r.COMPANY_ID = %s
+        """, (company_id,))
         errors = cursor.fetchone()[0]
         
         failure_rate = (errors / total * 100) if total > 0 else 0.0
@@ -150,10 +231,11 @@ async def get_metrics():
                 STANDARDIZED_JSON:carbon.naics_code::string as naics,
                 COUNT(*) as cnt 
             FROM {q('FINAL_AUDIT_RESULTS')} 
+            WHERE COMPANY_ID = %s
             GROUP BY 1, 2
             ORDER BY cnt DESC 
             LIMIT 3
-        """)
+        """, (company_id,))
         rows = cursor.fetchall()
         top_categories = [row[0] for row in rows if row[0]]
         top_naics = [row[1] for row in rows if row[1]]
@@ -168,3 +250,72 @@ async def get_metrics():
     finally:
         cursor.close()
         conn.close()
+
+# Operator endpoints: they span every tenant and expose raw dependency errors
+@router.get("/metrics/write-buffer", dependencies=[Depends(require_admin)])
+async def get_write_buffer_metrics():
+    return write_buffer.stats()
+
+@router.get("/health/breakers", dependencies=[Depends(require_admin)])
+async def get_breakers():
+    return {
+        "breakers": {name: breaker.stats() for name, breaker in BREAKERS.items()},
+        "retry_queue": retry_queue.stats()
+    }
+
+@router.get("/metrics/scheduler")
+async def get_scheduler_metrics(company_id: str = Depends(get_company_id)):
+    return {
+        "pipeline": pipeline_scheduler.stats(company_id),
+        "gemini": gemini_quota.stats(company_id),
+        "nominatim": nominatim_quota.stats(company_id)
+    }
+
+@router.get("/analytics", response_model=AnalyticsResponse)
+def get_analytics(
+    group_by: str = Query("month", description="Comma-separated dimensions: month, vendor, naics, category"),
+    start_month: Optional[date] = None,
+    end_month: Optional[date] = None,
+    vendor: Optional[str] = None,
+    naics: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=10000),
+    company_id: str = Depends(get_company_id)
+):
+    dimensions = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dimensions if d not in DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension(s): {', '.join(unknown)}")
+    try:
+        rows = query_analytics(
+            company_id,
+            dimensions,
+            start_month=start_month,
+            end_month=end_month,
+            vendor=vendor,
+            naics_code=naics,
+            limit=limit
+        )
+        return AnalyticsResponse(group_by=dimensions, rows=rows)
+    except Exception as e:
+        logger.error(f"Analytics query failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/export")
+def export_results(
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    level: str = Query("header", pattern="^(header|line)$"),
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    vendor: Optional[str] = None,
+    naics: Optional[str] = None,
+    company_id: str = Depends(get_company_id)
+):
+    filters = ExportFilters(start_date, end_date, vendor, naics, company_id)
+    media_type, ext = EXPORT_FORMATS[format]
+    filename = f"scope3_{level}_export.{ext}"
+    # Sync generator: Starlette iterates it in the threadpool, one Arrow batch at a time
+    return StreamingResponse(
+        stream_export(format, level, filters),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
@@ -0,0 +1,22 @@
+import hmac
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from app.core.config import settings
+
+ADMIN_HEADER = "X-Admin-Token"
+
+
+def is_admin(token: Optional[str]) -> bool:
+    if not settings.ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), settings.ADMIN_TOKEN.encode())
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """FastAPI dependency for operator-only endpoints; they 404 while ADMIN_TOKEN is unset."""
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+import google.api_core.exceptions as google_exceptions
+import geopy.exc as geopy_exceptions
+import snowflake.connector.errors as snowflake_errors
+
+from app.core.config import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Loop time by which the enclosing pipeline stage times out (set by StageTimer.run).
+# Breaker calls give up slightly earlier, so a dependency that hangs is recorded
+# as a failure instead of just being cancelled from outside.
+call_deadline: ContextVar[Optional[float]] = ContextVar("call_deadline", default=None)
+_DEADLINE_MARGIN_S = 0.1
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"{dependency} circuit open; retry in {retry_after:.0f}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one external dependency.
+
+    After `failure_threshold` consecutive failures the breaker opens and every
+    call fails immediately with CircuitOpenError. Once `reset_timeout` has
+    passed it lets a single probe call through (half-open): success closes it,
+    failure re-opens it with the timeout doubled, up to `max_reset_timeout`.
+    Only exceptions matching `failure_types` count; a bad request is not an
+    outage. Thread-safe, since Snowflake and Nominatim are called from
+    executor threads.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_types: Tuple[Type[BaseException], ...],
+        failure_threshold: int,
+        reset_timeout: float,
+        max_reset_timeout: float,
+    ):
+        self.name = name
+        self.failure_types = failure_types
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._reset_timeout = reset_timeout
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self._last_error: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(self._reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+    def is_failure(self, exc: BaseException) -> bool:
+        return isinstance(exc, self.failure_types)
+
+    def before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == OPEN or (state == HALF_OPEN and self._probe_in_flight):
+                self._counters["rejected"] += 1
+                remaining = self._reset_timeout - (time.monotonic() - self._opened_at)
+                raise CircuitOpenError(self.name, max(remaining, 1.0))
+            if state == HALF_OPEN:
+                self._probe_in_flight = True
+            self._counters["calls"] += 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"Circuit '{self.name}' closed")
+            self._state = CLOSED
+            self._failures = 0
+            self._reset_timeout = self.base_reset_timeout
+            self._probe_in_flight = False
+
+    def record_failure(self, exc: BaseException):
+        with self._lock:
+            self._counters["failures"] += 1
+            self._last_error = f"{type(exc).__name__}: {exc}"[:500]
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._reset_timeout = min(self._reset_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self._state == CLOSED and self._failures >= self.failure_threshold:
+                self._open()
+            self._probe_in_flight = False
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._counters["opened"] += 1
+        logger.warning(f"Circuit '{self.name}' opened for {self._reset_timeout:.0f}s after: {self._last_error}")
+
+    def _release_probe(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _settle(self, exc: Optional[BaseException]):
+        if exc is None:
+            self.record_success()
+        elif self.is_failure(exc):
+            self.record_failure(exc)
+        else:
+            # The dependency answered; the request itself was bad
+            self.record_success()
+
+    async def call(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        self.before_call()
+        deadline = call_deadline.get()
+        try:
+            if deadline is None:
+                result = await fn(*args, **kwargs)
+            else:
+                timeout = deadline - asyncio.get_running_loop().time() - _DEADLINE_MARGIN_S
+                result = await asyncio.wait_for(fn(*args, **kwargs), timeout=max(timeout, 0.0))
+        except asyncio.CancelledError:
+            self._release_probe()
+            raise
+        except Exception as e:
+            self._settle(e)
+            raise
+        self._settle(None)
+        return result
+
+    def call_sync(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._settle(e)
+            raise
+        self._settle(None)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self._current_state()
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_after_s": round(max(self._reset_timeout - (time.monotonic() - self._opened_at), 0.0), 1) if state == OPEN else 0.0,
+                "reset_timeout_s": self._reset_timeout,
+                "last_error": self._last_error,
+                **self._counters,
+            }
+
+
+_TRANSIENT = (asyncio.TimeoutError, ConnectionError, OSError)
+
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    failure_types=_TRANSIENT + (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.GatewayTimeout,
+        google_exceptions.RetryError,
+    ),
+    failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.BREAKER_RESET_TIMEOUT_S,
+    max_reset_timeout=settings.BREAKER_MAX_RESET_TIMEOUT_S,
+)
+
+nominatim_breaker = CircuitBreaker(
+    "nominatim",
+    failure_types=_TRANSIENT + (
+        geopy_exceptions.GeocoderTimedOut,
+        geopy_exceptions.GeocoderUnavailable,
+        geopy_exceptions.GeocoderQuotaExceeded,
+    ),
+    failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.BREAKER_RESET_TIMEOUT_S,
+    max_reset_timeout=settings.BREAKER_MAX_RESET_TIMEOUT_S,
+)
+
+# Only connection-level errors; a failing statement (ProgrammingError) is not an outage
+snowflake_breaker = CircuitBreaker(
+    "snowflake",
+    failure_types=_TRANSIENT + (
+        snowflake_errors.OperationalError,
+        snowflake_errors.InterfaceError,
+    ),
+    failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.BREAKER_RESET_TIMEOUT_S,
+    max_reset_timeout=settings.BREAKER_MAX_RESET_TIMEOUT_S,
+)
+
+BREAKERS: Dict[str, CircuitBreaker] = {
+    b.name: b for b in (gemini_breaker, nominatim_breaker, snowflake_breaker)
+}
@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import Dict, List, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -11,7 +11,107 @@ class Settings(BaseSettings):
     SNOWFLAKE_SCHEMA: str
     SNOWFLAKE_ROLE: Optional[str] = None
     GEMINI_API_KEY: str
-    
+
+    # Per-stage timeouts (seconds) for the invoice pipeline
+    STAGE_TIMEOUT_PREPROCESS: float = 60.0
+    STAGE_TIMEOUT_OCR: float = 180.0
+    STAGE_TIMEOUT_MAPPING: float = 90.0
+    STAGE_TIMEOUT_CARBON: float = 60.0
+    STAGE_TIMEOUT_FACTOR_LOOKUP: float = 20.0
+    STAGE_TIMEOUT_GEOCODE: float = 15.0
+    STAGE_TIMEOUT_AUDIT: float = 10.0
+
+    # Document pre-processing before OCR
+    PREPROCESS_ENABLED: bool = True
+    PREPROCESS_TARGET_DPI: int = 200
+    PREPROCESS_MAX_IMAGE_PX: int = 2200
+    PREPROCESS_JPEG_QUALITY: int = 80
+    PREPROCESS_WORKERS: int = 2
+
+    # Streaming OCR: start mapping/geocoding while line items are still being generated
+    OCR_STREAMING: bool = True
+    OCR_STREAM_MAPPING_ITEMS: int = 20
+
+    # FX conversion of invoice spend to USD (the EPA factors are per USD)
+    FX_RATES_PATH: str = "data/fx_rates.csv"
+    FX_MAX_STALENESS_DAYS: int = 7
+
+    # Group-commit write buffer for pipeline results/status updates
+    WRITE_BUFFER_MAX_ROWS: int = 500
+    WRITE_BUFFER_MAX_DELAY_MS: int = 500
+    WRITE_BUFFER_SPILL_PATH: str = "/tmp/aerocarbon_write_buffer.jsonl"
+    WRITE_BUFFER_MAX_ATTEMPTS: int = 5
+    WRITE_BUFFER_DEAD_LETTER_PATH: str = "/tmp/aerocarbon_write_buffer.dead.jsonl"
+
+    # Resumable chunked uploads
+    UPLOAD_SPOOL_DIR: str = "/tmp/aerocarbon_uploads"
+    UPLOAD_CHUNK_SIZE: int = 4 * 1024 * 1024
+    UPLOAD_MAX_BYTES: int = 200 * 1024 * 1024
+    UPLOAD_SESSION_TTL_SECONDS: int = 24 * 3600
+
+    # Tenants (X-Company-ID header) and fair-share pipeline scheduling
+    DEFAULT_COMPANY_ID: str = "DEFAULT_COMPANY"
+    ALLOWED_COMPANY_IDS: List[str] = []
+    # X-Tenant-Token -> companies it may use; empty trusts X-Company-ID (set it behind an auth proxy only)
+    TENANT_TOKENS: Dict[str, List[str]] = {}
+    TENANT_DEFAULT_WEIGHT: float = 1.0
+    TENANT_WEIGHTS: Dict[str, float] = {}
+    TENANT_MAX_CONCURRENCY: int = 2
+    TENANT_CONCURRENCY: Dict[str, int] = {}
+    PIPELINE_MAX_CONCURRENCY: int = 6
+    PIPELINE_DRAIN_TIMEOUT_S: float = 25.0
+    GEMINI_REQUESTS_PER_MINUTE: int = 60
+    GEMINI_BURST: int = 5
+    NOMINATIM_REQUESTS_PER_MINUTE: int = 60
+    # Longest wait for a geocoding slot before logistics are skipped (and flagged); keep it
+    # plus STAGE_TIMEOUT_GEOCODE under STAGE_TIMEOUT_CARBON
+    NOMINATIM_QUEUE_TIMEOUT_S: float = 30.0
+
+    # Audit anomaly checks against per-vendor/NAICS history
+    AUDIT_HIGH_EMISSIONS_KG: float = 10000.0
+    AUDIT_ZSCORE_THRESHOLD: float = 3.0
+    AUDIT_MIN_HISTORY: int = 10
+
+    # Circuit breakers for Gemini / Nominatim / Snowflake
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_TIMEOUT_S: float = 30.0
+    BREAKER_MAX_RESET_TIMEOUT_S: float = 300.0
+
+    # Delayed retry of failed documents, driven by ERROR_LOG
+    RETRY_MAX_ATTEMPTS: int = 5
+    RETRY_BASE_DELAY_S: float = 60.0
+    RETRY_MAX_DELAY_S: float = 3600.0
+    RETRY_POLL_INTERVAL_S: float = 15.0
+    RETRY_BATCH_SIZE: int = 50
+    # Queued/in-progress documents untouched this long at startup, and whose lease has
+    # expired, were stranded by a crash
+    RETRY_RESUME_AFTER_S: float = 900.0
+    # Each worker leases the documents it has queued or running and renews the lease
+    RETRY_LEASE_TTL_S: float = 300.0
+    RETRY_LEASE_HEARTBEAT_S: float = 60.0
+
+    # Admin diagnostics (/admin/diagnostics); the endpoints do not exist unless ADMIN_TOKEN is set
+    ADMIN_TOKEN: Optional[str] = None
+    DIAG_PROFILE_MAX_S: float = 30.0
+    DIAG_PROFILE_INTERVAL_MS: float = 5.0
+    DIAG_TRACEMALLOC_FRAMES: int = 10
+    DIAG_TRACEMALLOC_MAX_S: float = 600.0
+    DIAG_LOOP_LAG_INTERVAL_S: float = 0.5
+    DIAG_LOOP_LAG_WARN_MS: float = 250.0
+    DIAG_MAX_PROFILED_REQUESTS: int = 4
+    DIAG_KEEP_PROFILES: int = 20
+
+    # Directory inbox ingestion (python -m app.services.watcher); inbox directory -> COMPANY_ID
+    WATCH_DIRS: Dict[str, str] = {}
+    WATCH_SOURCE_SYSTEM: str = "FILE_INBOX"
+    WATCH_EXTENSIONS: List[str] = [".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".webp", ".heic"]
+    WATCH_DEBOUNCE_S: float = 5.0
+    WATCH_POLL_INTERVAL_S: float = 30.0
+    WATCH_USE_INOTIFY: bool = True
+    WATCH_BATCH_SIZE: int = 50
+    WATCH_MAX_INFLIGHT: int = 100
+    WATCH_RECONCILE_INTERVAL_S: float = 120.0
+
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 settings = Settings()
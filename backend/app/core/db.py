@@ -1,6 +1,7 @@
 import snowflake.connector
 from snowflake.connector import DictCursor
 from app.core.config import settings
+from app.core.breakers import snowflake_breaker
 import logging
 from typing import Optional
 
@@ -9,7 +10,9 @@ logger = logging.getLogger(__name__)
 
 def get_snowflake_connection():
     try:
-        conn = snowflake.connector.connect(
+        # Fails fast while the breaker is open instead of waiting on a connect timeout
+        conn = snowflake_breaker.call_sync(
+            snowflake.connector.connect,
             user=settings.SNOWFLAKE_USER,
             password=settings.SNOWFLAKE_PASSWORD,
             account=settings.SNOWFLAKE_ACCOUNT,
@@ -26,6 +29,14 @@ def get_snowflake_connection():
 def q(table_name: str) -> str:
     return f"{settings.SNOWFLAKE_DATABASE}.{settings.SNOWFLAKE_SCHEMA}.{table_name}"
 
+# Pair with `contains_pattern` so user input matches literally: `col ILIKE %s {LIKE_ESCAPE}`
+LIKE_ESCAPE = "ESCAPE '\\\\'"
+
+def contains_pattern(text: str) -> str:
+    """LIKE/ILIKE pattern matching `text` anywhere, with its wildcards escaped."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
 def init_db():
     conn = get_snowflake_connection()
     cursor = conn.cursor()
@@ -80,6 +91,7 @@ def init_db():
                     LAST_UPDATED_TS TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
                     CONSTRAINT PK_RAW_DOCUMENTS PRIMARY KEY (DOC_ID)
                 )
+                CLUSTER BY (COMPANY_ID, TO_DATE(UPLOAD_TS))
             """,
             "EXTRACTED_FIELDS": f"""
                 CREATE TABLE IF NOT EXISTS {q('EXTRACTED_FIELDS')} (
@@ -89,6 +101,7 @@ def init_db():
                     EXTRACTION_CONF FLOAT,
                     EXTRACTION_MODEL STRING,
                     VERSION STRING,
+                    PREPROCESS_STATS VARIANT,
                     EXTRACTED_TS TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
                     CONSTRAINT PK_EXTRACTED_FIELDS PRIMARY KEY (ID),
                     CONSTRAINT FK_EXTRACTED_DOC FOREIGN KEY (DOC_ID) REFERENCES {q('RAW_DOCUMENTS')}(DOC_ID)
@@ -98,6 +111,7 @@ def init_db():
                 CREATE TABLE IF NOT EXISTS {q('FINAL_AUDIT_RESULTS')} (
                     ID STRING NOT NULL,
                     DOC_ID STRING NOT NULL,
+                    COMPANY_ID STRING,
                     STANDARDIZED_JSON VARIANT,
                     CARBON_KG_CO2E FLOAT,
                     CONFIDENCE_SCORE FLOAT,
@@ -108,6 +122,7 @@ def init_db():
                     CONSTRAINT PK_FINAL_AUDIT_RESULTS PRIMARY KEY (ID),
                     CONSTRAINT FK_FINAL_DOC FOREIGN KEY (DOC_ID) REFERENCES {q('RAW_DOCUMENTS')}(DOC_ID)
                 )
+                CLUSTER BY (COMPANY_ID, TO_DATE(FINALIZED_TS))
             """,
             "ERROR_LOG": f"""
                 CREATE TABLE IF NOT EXISTS {q('ERROR_LOG')} (
@@ -118,9 +133,35 @@ def init_db():
                     ERROR_MESSAGE STRING,
                     STACK_TRACE STRING,
                     RETRY_COUNT INTEGER DEFAULT 0,
+                    NEXT_ATTEMPT_TS TIMESTAMP_NTZ,
+                    DEPENDENCY STRING,
                     CREATED_TS TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
                     CONSTRAINT PK_ERROR_LOG PRIMARY KEY (ERROR_ID)
                 )
+            """,
+            "SCHEMA_VERSION": f"""
+                CREATE TABLE IF NOT EXISTS {q('SCHEMA_VERSION')} (
+                    VERSION INTEGER NOT NULL,
+                    APPLIED_TS TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+                )
+            """,
+            "EMISSIONS_ROLLUP": f"""
+                CREATE TABLE IF NOT EXISTS {q('EMISSIONS_ROLLUP')} (
+                    COMPANY_ID STRING NOT NULL,
+                    PERIOD_MONTH DATE NOT NULL,
+                    VENDOR STRING NOT NULL,
+                    NAICS_CODE STRING NOT NULL,
+                    SCOPE_CATEGORY STRING NOT NULL,
+                    DOC_COUNT NUMBER DEFAULT 0,
+                    SPEND_TOTAL FLOAT DEFAULT 0,
+                    KG_CO2E_TOTAL FLOAT DEFAULT 0,
+                    SPEND_BASED_KG_CO2E FLOAT DEFAULT 0,
+                    LOGISTICS_KG_CO2E FLOAT DEFAULT 0,
+                    UNCONVERTED_DOC_COUNT NUMBER DEFAULT 0,
+                    LAST_UPDATED_TS TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP(),
+                    CONSTRAINT PK_EMISSIONS_ROLLUP PRIMARY KEY (COMPANY_ID, PERIOD_MONTH, VENDOR, NAICS_CODE, SCOPE_CATEGORY)
+                )
+                CLUSTER BY (COMPANY_ID, PERIOD_MONTH)
             """
         }
 
@@ -133,6 +174,59 @@ def init_db():
                 # Don't strictly raise here if it's just a DDL quirk, 
                 # but might be better to raise if it's critical.
 
+        # Schema changes made after the initial release, numbered so each runs once.
+        # A fresh install runs them too; they are no-ops on fresh tables.
+        migrations = [
+            (1, [
+                f"ALTER TABLE {q('EXTRACTED_FIELDS')} ADD COLUMN IF NOT EXISTS PREPROCESS_STATS VARIANT",
+            ]),
+            # Tenancy: results and rollup are keyed and clustered by COMPANY_ID.
+            # Rows written before tenants existed all belong to the default company.
+            (2, [
+                f"ALTER TABLE {q('FINAL_AUDIT_RESULTS')} ADD COLUMN IF NOT EXISTS COMPANY_ID STRING",
+                f"""UPDATE {q('FINAL_AUDIT_RESULTS')} f SET COMPANY_ID = r.COMPANY_ID
+                    FROM {q('RAW_DOCUMENTS')} r WHERE f.DOC_ID = r.DOC_ID AND f.COMPANY_ID IS NULL""",
+                f"ALTER TABLE {q('EMISSIONS_ROLLUP')} ADD COLUMN IF NOT EXISTS COMPANY_ID STRING NOT NULL DEFAULT '{settings.DEFAULT_COMPANY_ID}'",
+                f"ALTER TABLE {q('RAW_DOCUMENTS')} CLUSTER BY (COMPANY_ID, TO_DATE(UPLOAD_TS))",
+                f"ALTER TABLE {q('FINAL_AUDIT_RESULTS')} CLUSTER BY (COMPANY_ID, TO_DATE(FINALIZED_TS))",
+                f"ALTER TABLE {q('EMISSIONS_ROLLUP')} CLUSTER BY (COMPANY_ID, PERIOD_MONTH)",
+            ]),
+            # Delayed retry queue
+            (3, [
+                f"ALTER TABLE {q('ERROR_LOG')} ADD COLUMN IF NOT EXISTS NEXT_ATTEMPT_TS TIMESTAMP_NTZ",
+                f"ALTER TABLE {q('ERROR_LOG')} ADD COLUMN IF NOT EXISTS DEPENDENCY STRING",
+            ]),
+            # Invoices with no FX rate are counted, not summed
+            (4, [
+                f"ALTER TABLE {q('EMISSIONS_ROLLUP')} ADD COLUMN IF NOT EXISTS UNCONVERTED_DOC_COUNT NUMBER DEFAULT 0",
+            ]),
+            # Final results are upserted on DOC_ID; keep the latest of any earlier duplicates
+            (5, [
+                f"""INSERT OVERWRITE INTO {q('FINAL_AUDIT_RESULTS')}
+                    SELECT * FROM {q('FINAL_AUDIT_RESULTS')}
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY DOC_ID ORDER BY FINALIZED_TS DESC) = 1""",
+            ]),
+            # Worker leases on queued and running documents
+            (6, [
+                f"ALTER TABLE {q('RAW_DOCUMENTS')} ADD COLUMN IF NOT EXISTS OWNER_ID STRING",
+                f"ALTER TABLE {q('RAW_DOCUMENTS')} ADD COLUMN IF NOT EXISTS LEASE_EXPIRES_TS TIMESTAMP_NTZ",
+            ]),
+        ]
+        cursor.execute(f"SELECT COALESCE(MAX(VERSION), 0) FROM {q('SCHEMA_VERSION')}")
+        current = cursor.fetchone()[0]
+        for version, statements in migrations:
+            if version <= current:
+                continue
+            try:
+                for sql in statements:
+                    cursor.execute(sql)
+                cursor.execute(f"INSERT INTO {q('SCHEMA_VERSION')} (VERSION) VALUES (%s)", (version,))
+                logger.info(f"Applied schema migration {version}")
+            except Exception as e:
+                # Later migrations may depend on this one; retried on the next startup
+                logger.error(f"Schema migration {version} failed ({sql}): {e}")
+                break
+
         logger.info("Snowflake schema verified/initialized successfully.")
     except Exception as e:
         logger.error(f"Critical failure during database initialization: {e}")
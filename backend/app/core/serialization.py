@@ -0,0 +1,68 @@
+from array import array
+from decimal import Decimal
+from typing import Any, Dict, Optional, Union
+
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from app.models.line_items import ColumnTable
+
+JSONBytes = Union[bytes, bytearray, memoryview, str]
+
+
+def _default(obj: Any) -> Any:
+    # Pydantic models are encoded by pydantic-core and spliced in as-is
+    if isinstance(obj, BaseModel):
+        return orjson.Fragment(obj.__pydantic_serializer__.to_json(obj))
+    if isinstance(obj, ColumnTable):
+        return obj.to_dicts()
+    if isinstance(obj, array):
+        return obj.tolist()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def loads(data: JSONBytes) -> Any:
+    return orjson.loads(data)
+
+
+def dumps_model(model: BaseModel, reuse: Optional[Dict[str, JSONBytes]] = None) -> bytes:
+    """
+    Serializes a model to JSON bytes. Fields named in `reuse` are written from
+    their already-encoded JSON instead of being serialized a second time.
+    """
+    if not reuse:
+        return model.__pydantic_serializer__.to_json(model)
+    body = {
+        name: orjson.Fragment(reuse[name]) if name in reuse else getattr(model, name)
+        for name in type(model).model_fields
+    }
+    return dumps(body)
+
+
+def to_variant(obj: Any, reuse: Optional[Dict[str, JSONBytes]] = None) -> str:
+    """JSON text for binding into PARSE_JSON(%s) on a VARIANT column."""
+    data = dumps_model(obj, reuse) if isinstance(obj, BaseModel) else dumps(obj)
+    return data.decode("utf-8")
+
+
+class RawJSONResponse(Response):
+    """
+    JSON response that passes already-encoded JSON (e.g. a VARIANT read with
+    TO_JSON) straight through, and encodes anything else with orjson.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return bytes(content)
+        if isinstance(content, str):
+            return content.encode("utf-8")
+        return dumps(content)
@@ -0,0 +1,72 @@
+import hmac
+import re
+from contextvars import ContextVar
+from typing import List, Optional
+
+from fastapi import Header, HTTPException
+
+from app.core.config import settings
+
+TENANT_HEADER = "X-Company-ID"
+TENANT_TOKEN_HEADER = "X-Tenant-Token"
+
+_COMPANY_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# Tenant of the invoice being processed by the current task; read by shared
+# limiters (e.g. the Gemini quota) that sit below the orchestrator.
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=settings.DEFAULT_COMPANY_ID)
+
+
+def tenant_weight(company_id: str) -> float:
+    return max(float(settings.TENANT_WEIGHTS.get(company_id, settings.TENANT_DEFAULT_WEIGHT)), 0.01)
+
+
+def tenant_concurrency(company_id: str) -> int:
+    return max(int(settings.TENANT_CONCURRENCY.get(company_id, settings.TENANT_MAX_CONCURRENCY)), 1)
+
+
+def validate_company_id(company_id: Optional[str]) -> str:
+    company_id = (company_id or settings.DEFAULT_COMPANY_ID).strip()
+    if not _COMPANY_ID_PATTERN.match(company_id):
+        raise ValueError(f"Invalid company id: {company_id!r}")
+    if settings.ALLOWED_COMPANY_IDS and company_id not in settings.ALLOWED_COMPANY_IDS:
+        raise ValueError(f"Unknown company id: {company_id}")
+    return company_id
+
+
+def token_companies(token: Optional[str]) -> Optional[List[str]]:
+    """Companies a TENANT_TOKENS token may act for; None for a missing or unknown token."""
+    if not token:
+        return None
+    companies = None
+    # Every entry is compared, so the time taken does not reveal which token matched
+    for candidate, allowed in settings.TENANT_TOKENS.items():
+        if hmac.compare_digest(token.encode(), candidate.encode()):
+            companies = allowed
+    return companies
+
+
+async def get_company_id(
+    x_company_id: Optional[str] = Header(None),
+    x_tenant_token: Optional[str] = Header(None),
+) -> str:
+    """
+    FastAPI dependency: the tenant every request is scoped to.
+
+    With TENANT_TOKENS set, the caller's X-Tenant-Token decides which companies
+    it may name in X-Company-ID (a token for a single company may omit the
+    header). Without it the header is trusted as-is, which is only safe behind
+    an authenticating proxy that sets or strips X-Company-ID.
+    """
+    if settings.TENANT_TOKENS:
+        companies = token_companies(x_tenant_token)
+        if companies is None:
+            raise HTTPException(status_code=401, detail="Tenant token required")
+        if x_company_id is None and len(companies) == 1:
+            x_company_id = companies[0]
+        elif (x_company_id or settings.DEFAULT_COMPANY_ID).strip() not in companies:
+            raise HTTPException(status_code=403, detail="Tenant token does not grant this company")
+    try:
+        return validate_company_id(x_company_id)
+    except ValueError as e:
+        raise HTTPException(status_code=403, detail=str(e))
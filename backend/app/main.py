@@ -1,16 +1,28 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
 import uvicorn
 import os
+from app.core.config import settings
 from app.core.db import init_db
+from app.core.breakers import CircuitOpenError
 from app.api.routes import router as api_router
+from app.api.diagnostics import router as diagnostics_router
+from app.services.preprocess import preprocessor
+from app.services.write_buffer import write_buffer
+from app.services.vendor_stats import vendor_stats
+from app.services.retry_queue import retry_queue
+from app.services.orchestrator import orchestrator
+from app.services.fx import fx_rates
+from app.services.diagnostics import loop_lag, memory_tracer
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="SCOPE3WH API", version="1.0.0")
+app = FastAPI(title="SCOPE3WH API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS Middleware
 app.add_middleware(
@@ -21,13 +33,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# A dependency behind an open breaker is a temporary outage, not a server error
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return ORJSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(exc.retry_after) + 1)}
+    )
+
 # Startup Event
 @app.on_event("startup")
 async def startup_event():
+    if not settings.TENANT_TOKENS:
+        logger.warning("TENANT_TOKENS is not set; X-Company-ID is trusted as sent and must be set by an authenticating proxy")
     init_db()
+    await write_buffer.start()
+    # FX rate file is parsed once, off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, lambda: fx_rates.table)
+    # Audit history is rebuilt in the background; anomaly checks start once it is loaded
+    vendor_stats.start()
+    # Resubmits documents parked after transient failures once their dependency recovers
+    retry_queue.start(orchestrator.process_invoice)
+    loop_lag.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Drain in-flight pipelines (the rest go back to the retry queue), then flush what they buffered
+    await loop_lag.close()
+    memory_tracer.stop()
+    await retry_queue.close()
+    await orchestrator.drain()
+    await write_buffer.close()
+    preprocessor.shutdown()
 
 # Include Routes
 app.include_router(api_router)
+app.include_router(diagnostics_router)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
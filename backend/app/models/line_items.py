@@ -0,0 +1,178 @@
+from abc import ABC, abstractmethod
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from pydantic_core import core_schema
+
+
+class ColumnTable(ABC):
+    """
+    Base for the column-oriented line containers passed between pipeline stages.
+
+    Numeric columns are stored in `array('d')` and per-invoice constants are kept
+    once instead of per row, so a 10k-line invoice is a handful of buffers rather
+    than 10k dicts. Pydantic sees the table as a list of dicts: it is built from
+    one when validating API/VARIANT input and dumped to one when serializing, and
+    an existing instance passes validation untouched.
+    """
+
+    __slots__ = ()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def row(self, i: int) -> Dict[str, Any]:
+        ...
+
+    @classmethod
+    @abstractmethod
+    def from_dicts(cls, rows: List[Dict[str, Any]]):
+        ...
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [self.row(i) for i in range(len(self))]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.row(i)
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(rows={len(self)})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        from_list = core_schema.no_info_after_validator_function(
+            cls.from_dicts,
+            core_schema.list_schema(core_schema.dict_schema()),
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=from_list,
+            python_schema=core_schema.union_schema([core_schema.is_instance_schema(cls), from_list]),
+            serialization=core_schema.plain_serializer_function_ser_schema(lambda v: v.to_dicts()),
+        )
+
+
+class LineItemTable(ColumnTable):
+    """Standardized line items produced by mapping (`MappingResult.standardized_line_items`)."""
+
+    __slots__ = ("description", "quantity", "unit_price", "total", "unit", "mapped_category", "naics_code")
+
+    def __init__(
+        self,
+        description: Optional[List[Optional[str]]] = None,
+        quantity: Optional[array] = None,
+        unit_price: Optional[array] = None,
+        total: Optional[array] = None,
+        unit: Optional[List[Optional[str]]] = None,
+        mapped_category: Optional[str] = None,
+        naics_code: Optional[str] = None,
+    ):
+        self.description = description if description is not None else []
+        self.quantity = quantity if quantity is not None else array("d")
+        self.unit_price = unit_price if unit_price is not None else array("d")
+        self.total = total if total is not None else array("d")
+        self.unit = unit if unit is not None else []
+        self.mapped_category = mapped_category
+        self.naics_code = naics_code
+
+    def __len__(self) -> int:
+        return len(self.total)
+
+    @classmethod
+    def from_line_items(cls, items: Iterable[Any], mapped_category: Optional[str] = None, naics_code: Optional[str] = None) -> "LineItemTable":
+        table = cls(mapped_category=mapped_category, naics_code=naics_code)
+        for item in items:
+            table.description.append(item.description)
+            table.quantity.append(item.quantity or 0.0)
+            table.unit_price.append(item.unit_price or 0.0)
+            table.total.append(item.total or 0.0)
+            table.unit.append(item.unit)
+        return table
+
+    @classmethod
+    def from_dicts(cls, rows: List[Dict[str, Any]]) -> "LineItemTable":
+        table = cls()
+        for r in rows:
+            table.description.append(r.get("description"))
+            table.quantity.append(r.get("quantity") or 0.0)
+            table.unit_price.append(r.get("unit_price") or 0.0)
+            table.total.append(r.get("total") or 0.0)
+            table.unit.append(r.get("unit"))
+        # Kept once per table, so every row has to carry the same value
+        for key in ("mapped_category", "naics_code"):
+            values = {r.get(key) for r in rows}
+            if len(values) > 1:
+                raise ValueError(f"Line items disagree on {key}: {sorted(map(str, values))}")
+            setattr(table, key, values.pop() if values else None)
+        return table
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {
+            "description": self.description[i],
+            "quantity": self.quantity[i],
+            "unit_price": self.unit_price[i],
+            "total": self.total[i],
+            "unit": self.unit[i],
+            "mapped_category": self.mapped_category,
+            "naics_code": self.naics_code,
+        }
+
+
+class BreakdownTable(ColumnTable):
+    """Per-line emissions produced by the carbon stage (`CarbonResult.line_level_breakdown`)."""
+
+    __slots__ = ("description", "item_emissions", "factor_used")
+
+    def __init__(
+        self,
+        description: Optional[List[Optional[str]]] = None,
+        item_emissions: Optional[array] = None,
+        factor_used: Optional[array] = None,
+    ):
+        self.description = description if description is not None else []
+        self.item_emissions = item_emissions if item_emissions is not None else array("d")
+        self.factor_used = factor_used if factor_used is not None else array("d")
+
+    def __len__(self) -> int:
+        return len(self.item_emissions)
+
+    @classmethod
+    def from_totals(cls, items: LineItemTable, factor: float, totals: Optional[array] = None) -> "BreakdownTable":
+        """`totals` overrides `items.total`, e.g. with the USD-converted column."""
+        totals = items.total if totals is None else totals
+        # The description column is shared with the mapping table, not copied
+        return cls(
+            description=items.description,
+            item_emissions=array("d", [t * factor for t in totals]),
+            factor_used=array("d", [factor]) * len(items),
+        )
+
+    @classmethod
+    def from_dicts(cls, rows: List[Dict[str, Any]]) -> "BreakdownTable":
+        table = cls()
+        for r in rows:
+            table.description.append(r.get("description"))
+            table.item_emissions.append(r.get("item_emissions") or 0.0)
+            table.factor_used.append(r.get("factor_used") or 0.0)
+        return table
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return {
+            "description": self.description[i],
+            "item_emissions": self.item_emissions[i],
+            "factor_used": self.factor_used[i],
+        }
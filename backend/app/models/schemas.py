@@ -1,12 +1,35 @@
 from pydantic import BaseModel, Field
 from typing import List, Optional, Any, Dict
-from datetime import datetime
+from datetime import date, datetime
+from app.models.line_items import LineItemTable, BreakdownTable
 
 class InvoiceUploadResponse(BaseModel):
     doc_id: str
     status: str
     message: str
 
+class UploadInitRequest(BaseModel):
+    file_name: str
+    file_type: Optional[str] = None
+    file_size: int
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int] = []
+    # Set once the upload has been completed into a document
+    doc_id: Optional[str] = None
+
+class ChunkUploadResponse(BaseModel):
+    upload_id: str
+    index: int
+    sha256: str
+    size: int
+
+class UploadCompleteRequest(BaseModel):
+    sha256: Optional[str] = None
+
 class LineItem(BaseModel):
     description: str
     quantity: float
@@ -36,24 +59,46 @@ class ExtractionResult(BaseModel):
     extraction_confidence: float
     is_standard_invoice: bool = True
 
+class PreprocessStats(BaseModel):
+    original_bytes: int
+    processed_bytes: int
+    original_type: str
+    processed_type: str
+    operations: List[str] = []
+    duration_ms: float = 0.0
+
 class MappingResult(BaseModel):
     vendor_canonical: str
-    standardized_line_items: List[Dict[str, Any]]
+    standardized_line_items: LineItemTable
     scope_category: str
     naics_code: Optional[str] = None
     mapping_confidence: float
     rule_version: str
 
+class FxProvenance(BaseModel):
+    """How the invoice amounts were converted to USD before applying the spend factor."""
+    source_currency: str
+    target_currency: str = "USD"
+    rate: float = 1.0  # target units per source unit
+    rate_date: Optional[date] = None
+    table_version: Optional[str] = None
+    status: str = "identity"  # identity | converted | missing (amounts left unconverted)
+
 class CarbonResult(BaseModel):
-    total_kg_co2e: float
-    spend_based_kg_co2e: float
+    # None while the spend could not be converted to USD (fx.status "missing")
+    total_kg_co2e: Optional[float]
+    spend_based_kg_co2e: Optional[float]
+    spend_factor: Optional[float] = None  # kg CO2e per USD
+    spend_usd: Optional[float] = None
+    fx: Optional[FxProvenance] = None
     logistics_kg_co2e: float = 0.0
+    logistics_skipped: Optional[str] = None  # why a known shipping route has no logistics emissions
     distance_km: Optional[float] = None
     scope: str
     category: str
     naics_code: Optional[str] = None
     is_verified_match: bool = False
-    line_level_breakdown: List[Dict[str, Any]]
+    line_level_breakdown: BreakdownTable
 
 class AuditResult(BaseModel):
     is_valid: bool
@@ -75,6 +120,23 @@ class MetricsResponse(BaseModel):
     top_categories: List[str]
     top_naics: List[str]
 
+class AnalyticsRow(BaseModel):
+    period_month: Optional[date] = None
+    vendor: Optional[str] = None
+    naics_code: Optional[str] = None
+    scope_category: Optional[str] = None
+    doc_count: int
+    spend_total: float
+    kg_co2e_total: float
+    spend_based_kg_co2e: float
+    logistics_kg_co2e: float
+    unconverted_doc_count: int = 0  # invoices with no FX rate, left out of the spend and kg totals
+    kg_co2e_per_spend: Optional[float] = None
+
+class AnalyticsResponse(BaseModel):
+    group_by: List[str]
+    rows: List[AnalyticsRow]
+
 class MoodResponse(BaseModel):
     score: int
     label: str
@@ -0,0 +1,233 @@
+import argparse
+import logging
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+from app.core.db import LIKE_ESCAPE, contains_pattern, get_snowflake_connection, q
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Public dimension name -> rollup column
+DIMENSIONS = {
+    "month": "PERIOD_MONTH",
+    "vendor": "VENDOR",
+    "naics": "NAICS_CODE",
+    "category": "SCOPE_CATEGORY",
+}
+
+# One row per finalized document with its rollup key and contribution. Keys are
+# COALESCEd so MERGE can match on plain equality.
+_ROW_SELECT = """
+    SELECT * FROM (
+        SELECT
+            COALESCE(f.COMPANY_ID, '{default_company}') AS COMPANY_ID,
+            DATE_TRUNC('MONTH', COALESCE(
+                TRY_TO_DATE(f.STANDARDIZED_JSON:extraction.invoice_date::STRING),
+                f.FINALIZED_TS::DATE
+            )) AS PERIOD_MONTH,
+            COALESCE(f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING,
+                     f.STANDARDIZED_JSON:extraction.vendor_name::STRING, 'Unknown') AS VENDOR,
+            COALESCE(f.STANDARDIZED_JSON:carbon.naics_code::STRING, 'UNMAPPED') AS NAICS_CODE,
+            COALESCE(f.STANDARDIZED_JSON:carbon.category::STRING, 'Uncategorized') AS SCOPE_CATEGORY,
+            COALESCE(f.STANDARDIZED_JSON:extraction.is_standard_invoice::BOOLEAN, TRUE) AS IS_STANDARD,
+            -- Invoices with no FX rate have no USD spend or emissions yet: they are only counted
+            COALESCE(f.STANDARDIZED_JSON:carbon.fx.status::STRING = 'missing', FALSE) AS UNCONVERTED,
+            -- USD spend; results from before FX conversion only have the invoice-currency total
+            IFF(UNCONVERTED, 0, COALESCE(f.STANDARDIZED_JSON:carbon.spend_usd::FLOAT,
+                                         f.STANDARDIZED_JSON:extraction.grand_total::FLOAT, 0)) AS SPEND,
+            IFF(UNCONVERTED, 0, COALESCE(f.CARBON_KG_CO2E, 0)) AS KG,
+            IFF(UNCONVERTED, 0, COALESCE(f.STANDARDIZED_JSON:carbon.spend_based_kg_co2e::FLOAT, 0)) AS SPEND_BASED_KG,
+            IFF(UNCONVERTED, 0, COALESCE(f.STANDARDIZED_JSON:carbon.logistics_kg_co2e::FLOAT, 0)) AS LOGISTICS_KG
+        FROM {source} f
+        WHERE TRUE {filter}
+        -- Tables written before final rows were upserted may hold a document more than once
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY f.DOC_ID ORDER BY f.FINALIZED_TS DESC) = 1
+    )
+    WHERE IS_STANDARD
+"""
+
+_AGGREGATE = """
+    SELECT
+        x.COMPANY_ID, x.PERIOD_MONTH, x.VENDOR, x.NAICS_CODE, x.SCOPE_CATEGORY,
+        COUNT(*) AS DOC_COUNT,
+        SUM(x.SPEND) AS SPEND_TOTAL,
+        SUM(x.KG) AS KG_CO2E_TOTAL,
+        SUM(x.SPEND_BASED_KG) AS SPEND_BASED_KG_CO2E,
+        SUM(x.LOGISTICS_KG) AS LOGISTICS_KG_CO2E,
+        COUNT_IF(x.UNCONVERTED) AS UNCONVERTED_DOC_COUNT
+    FROM ({rows}) x
+    {join}
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+_METRIC_COLUMNS = ["DOC_COUNT", "SPEND_TOTAL", "KG_CO2E_TOTAL", "SPEND_BASED_KG_CO2E", "LOGISTICS_KG_CO2E",
+                   "UNCONVERTED_DOC_COUNT"]
+_KEY_COLUMNS = ["COMPANY_ID", "PERIOD_MONTH", "VENDOR", "NAICS_CODE", "SCOPE_CATEGORY"]
+
+RollupKey = Tuple[str, date, str, str, str]
+
+
+def _rows(filter: str = "") -> str:
+    return _ROW_SELECT.format(source=q('FINAL_AUDIT_RESULTS'), filter=filter, default_company=settings.DEFAULT_COMPANY_ID)
+
+
+def _keys_values(keys: Sequence[RollupKey]) -> Tuple[str, List[Any]]:
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(keys))
+    sql = (f"(SELECT column1 AS COMPANY_ID, column2::DATE AS PERIOD_MONTH, column3 AS VENDOR, "
+           f"column4 AS NAICS_CODE, column5 AS SCOPE_CATEGORY FROM VALUES {values})")
+    return sql, [v for key in keys for v in key]
+
+
+def rollup_keys(cursor, doc_ids: Sequence[str]) -> List[RollupKey]:
+    """The rollup buckets the documents' current final rows count towards."""
+    if not doc_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(doc_ids))
+    cursor.execute(
+        f"SELECT DISTINCT {', '.join(_KEY_COLUMNS)} FROM ({_rows(f'AND f.DOC_ID IN ({placeholders})')})",
+        list(doc_ids)
+    )
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def refresh_rollup(cursor, doc_ids: Sequence[str], previous_keys: Sequence[RollupKey] = ()):
+    """
+    Recomputes the EMISSIONS_ROLLUP buckets of freshly finalized documents from
+    their final rows, plus `previous_keys` (the buckets a reprocessed document
+    counted towards before). Recomputing rather than adding makes a replayed or
+    repeated refresh harmless; a bucket left without documents is deleted.
+    """
+    keys = sorted(set(previous_keys) | set(rollup_keys(cursor, doc_ids)))
+    if not keys:
+        return
+    keys_sql, key_params = _keys_values(keys)
+    companies = sorted({key[0] for key in keys})
+    company_filter = (f"AND COALESCE(f.COMPANY_ID, '{settings.DEFAULT_COMPANY_ID}') "
+                      f"IN ({', '.join(['%s'] * len(companies))})")
+    join = f"JOIN {keys_sql} k2 ON " + " AND ".join(f"x.{c} = k2.{c}" for c in _KEY_COLUMNS)
+    aggregate = _AGGREGATE.format(rows=_rows(company_filter), join=join)
+
+    on = " AND ".join(f"r.{c} = s.{c}" for c in _KEY_COLUMNS)
+    update = ", ".join(f"r.{c} = s.{c}" for c in _METRIC_COLUMNS)
+    cols = _KEY_COLUMNS + _METRIC_COLUMNS
+    cursor.execute(f"""
+        MERGE INTO {q('EMISSIONS_ROLLUP')} r
+        USING (
+            SELECT {", ".join(f"k.{c}" for c in _KEY_COLUMNS)}, {", ".join(f"a.{c}" for c in _METRIC_COLUMNS)}
+            FROM {keys_sql} k
+            LEFT JOIN ({aggregate}) a ON {" AND ".join(f"a.{c} = k.{c}" for c in _KEY_COLUMNS)}
+        ) s
+        ON {on}
+        WHEN MATCHED AND s.DOC_COUNT IS NULL THEN DELETE
+        WHEN MATCHED THEN UPDATE SET {update}, r.LAST_UPDATED_TS = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED AND s.DOC_COUNT IS NOT NULL THEN INSERT ({", ".join(cols)})
+            VALUES ({", ".join(f"s.{c}" for c in cols)})
+    """, key_params + companies + key_params)
+
+
+def rebuild_rollup():
+    """Recomputes EMISSIONS_ROLLUP from the full FINAL_AUDIT_RESULTS history."""
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        source = _AGGREGATE.format(rows=_rows(), join="")
+        cols = ", ".join(_KEY_COLUMNS + _METRIC_COLUMNS)
+        cursor.execute("BEGIN")
+        cursor.execute(f"DELETE FROM {q('EMISSIONS_ROLLUP')}")
+        cursor.execute(f"INSERT INTO {q('EMISSIONS_ROLLUP')} ({cols}) SELECT {cols} FROM ({source})")
+        cursor.execute("COMMIT")
+        logger.info("EMISSIONS_ROLLUP rebuilt from FINAL_AUDIT_RESULTS")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def build_analytics_query(
+    company_id: str,
+    group_by: List[str],
+    start_month: Optional[date] = None,
+    end_month: Optional[date] = None,
+    vendor: Optional[str] = None,
+    naics_code: Optional[str] = None,
+    limit: int = 500,
+) -> Tuple[str, List[Any]]:
+    unknown = [d for d in group_by if d not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown analytics dimension(s): {', '.join(unknown)}")
+
+    keys = [DIMENSIONS[d] for d in group_by]
+    clauses = ["COMPANY_ID = %s"]
+    params: List[Any] = [company_id]
+    if start_month:
+        clauses.append("PERIOD_MONTH >= DATE_TRUNC('MONTH', %s::DATE)")
+        params.append(start_month)
+    if end_month:
+        clauses.append("PERIOD_MONTH <= DATE_TRUNC('MONTH', %s::DATE)")
+        params.append(end_month)
+    if vendor:
+        clauses.append(f"VENDOR ILIKE %s {LIKE_ESCAPE}")
+        params.append(contains_pattern(vendor))
+    if naics_code:
+        clauses.append("NAICS_CODE = %s")
+        params.append(naics_code)
+    where = f"WHERE {' AND '.join(clauses)}"
+
+    select_keys = "".join(f"{k}, " for k in keys)
+    group = f"GROUP BY {', '.join(keys)}" if keys else ""
+    order = ", ".join(keys) if DIMENSIONS["month"] in keys else "KG_CO2E_TOTAL DESC"
+    sql = f"""
+        SELECT {select_keys}
+            SUM(DOC_COUNT) AS DOC_COUNT,
+            SUM(SPEND_TOTAL) AS SPEND_TOTAL,
+            SUM(KG_CO2E_TOTAL) AS KG_CO2E_TOTAL,
+            SUM(SPEND_BASED_KG_CO2E) AS SPEND_BASED_KG_CO2E,
+            SUM(LOGISTICS_KG_CO2E) AS LOGISTICS_KG_CO2E,
+            SUM(UNCONVERTED_DOC_COUNT) AS UNCONVERTED_DOC_COUNT,
+            SUM(KG_CO2E_TOTAL) / NULLIF(SUM(SPEND_TOTAL), 0) AS KG_CO2E_PER_SPEND
+        FROM {q('EMISSIONS_ROLLUP')}
+        {where}
+        {group}
+        ORDER BY {order}
+        LIMIT {int(limit)}
+    """
+    return sql, params
+
+
+def query_analytics(company_id: str, group_by: List[str], **filters) -> List[Dict[str, Any]]:
+    sql, params = build_analytics_query(company_id, group_by, **filters)
+    keys = [DIMENSIONS[d] for d in group_by]
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        rows = []
+        for r in cursor.fetchall():
+            row = dict(zip([k.lower() for k in keys], r[:len(keys)]))
+            doc_count, spend, kg, spend_kg, logistics_kg, unconverted, intensity = r[len(keys):]
+            row.update({
+                "doc_count": int(doc_count or 0),
+                "spend_total": float(spend or 0.0),
+                "kg_co2e_total": float(kg or 0.0),
+                "spend_based_kg_co2e": float(spend_kg or 0.0),
+                "logistics_kg_co2e": float(logistics_kg or 0.0),
+                "unconverted_doc_count": int(unconverted or 0),
+                "kg_co2e_per_spend": float(intensity) if intensity is not None else None,
+            })
+            rows.append(row)
+        return rows
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the EMISSIONS_ROLLUP table.")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the rollup from full history")
+    args = parser.parse_args()
+    if args.rebuild:
+        rebuild_rollup()
@@ -1,5 +1,8 @@
-from app.models.schemas import AuditResult, ExtractionResult, CarbonResult
-from typing import List
+from app.models.schemas import AuditResult, ExtractionResult, CarbonResult, MappingResult
+from app.core.config import settings
+from app.core.tenancy import current_tenant
+from app.services.vendor_stats import vendor_stats, invoice_facts
+from typing import List, Optional
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -9,7 +12,11 @@ class AuditLayer:
     def __init__(self):
         self.confidence_threshold = 0.8
 
-    async def audit(self, extraction: ExtractionResult, carbon: CarbonResult) -> AuditResult:
+    async def pre_audit(self, extraction: ExtractionResult) -> AuditResult:
+        """
+        Checks that only depend on the extraction, so they can run alongside
+        mapping instead of waiting for the carbon stage.
+        """
         flags = []
         is_valid = True
 
@@ -33,11 +40,7 @@ class AuditLayer:
                 flags.append(f"Math Mismatch: Subtotal+Tax ({calculated_total}) != Total ({extraction.grand_total})")
                 is_valid = False
 
-            # 3. Check for Anomalies (e.g. extremely high emissions)
-            if carbon.total_kg_co2e > 10000: # Arbitrary threshold for this example
-                flags.append(f"High Emissions Alert: {carbon.total_kg_co2e} kgCO2e")
-
-            # 4. Check for Missing Critical Fields
+            # 3. Check for Missing Critical Fields
             if not extraction.vendor_name:
                 flags.append("Missing Vendor Name")
                 is_valid = False
@@ -56,4 +59,58 @@ class AuditLayer:
             logger.error(f"Audit failed: {e}")
             raise
 
+    async def audit(
+        self,
+        extraction: ExtractionResult,
+        carbon: CarbonResult,
+        pre_audit: Optional[AuditResult] = None,
+        mapping: Optional[MappingResult] = None,
+        doc_id: Optional[str] = None,
+        company_id: Optional[str] = None
+    ) -> AuditResult:
+        if pre_audit is None:
+            pre_audit = await self.pre_audit(extraction)
+
+        if not extraction.is_standard_invoice:
+            return pre_audit
+
+        flags = list(pre_audit.audit_flags)
+        is_valid = pre_audit.is_valid
+
+        try:
+            # 4. Check for Anomalies (e.g. extremely high emissions)
+            if carbon.total_kg_co2e is not None and carbon.total_kg_co2e > settings.AUDIT_HIGH_EMISSIONS_KG:
+                flags.append(f"High Emissions Alert: {carbon.total_kg_co2e} kgCO2e")
+
+            # 5. Spend that could not be converted to USD has no emissions yet (the factor is per USD)
+            if carbon.fx and carbon.fx.status == "missing":
+                flags.append(
+                    f"FX Rate Missing: {carbon.fx.source_currency} spend dated {extraction.invoice_date} "
+                    f"was not converted to USD; emissions not calculated"
+                )
+
+            # 6. A shipping route whose emissions could not be calculated counts as 0 kg in the totals
+            if carbon.logistics_skipped:
+                flags.append(f"Logistics Not Calculated: {carbon.logistics_skipped}")
+
+            # 7. Compare against this vendor's / NAICS code's history and check for duplicates (O(1))
+            history_flags, duplicate = vendor_stats.check(
+                company_id or current_tenant.get(),
+                invoice_facts(extraction, carbon, mapping),
+                doc_id
+            )
+            flags.extend(history_flags)
+            if duplicate:
+                is_valid = False
+
+            return AuditResult(
+                is_valid=is_valid,
+                audit_flags=flags,
+                confidence_score=pre_audit.confidence_score
+            )
+
+        except Exception as e:
+            logger.error(f"Audit failed: {e}")
+            raise
+
 audit_layer = AuditLayer()
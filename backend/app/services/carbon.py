@@ -1,8 +1,13 @@
-from app.models.schemas import CarbonResult, MappingResult, ExtractionResult
-from typing import List, Dict, Any, Optional
+from app.models.schemas import CarbonResult, MappingResult, ExtractionResult, FxProvenance
+from app.models.line_items import BreakdownTable, LineItemTable
+from typing import List, Dict, Any, Optional, Tuple
 import logging
 from app.core.db import get_snowflake_connection, q
 from app.core.config import settings
+from app.core.breakers import nominatim_breaker
+from app.services.stages import StageTimer
+from app.services.fx import fx_rates
+from app.services.scheduler import nominatim_quota
 from geopy.geocoders import Nominatim
 from geopy.distance import geodesic
 import asyncio
@@ -10,6 +15,24 @@ import asyncio
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class CarbonPrefetch:
+    """
+    Factor lookup and geocoding started ahead of `calculate`, e.g. while the
+    OCR response is still streaming. Each task is keyed by its inputs, and
+    `calculate` only uses it if the final extraction/mapping agree.
+    """
+
+    def __init__(self):
+        self.route: Optional[Tuple[Optional[str], Optional[str]]] = None
+        self.route_task: Optional[asyncio.Task] = None
+        self.factor_key: Optional[Tuple[Optional[str], Optional[str]]] = None
+        self.factor_task: Optional[asyncio.Task] = None
+
+    def cancel(self):
+        for task in (self.route_task, self.factor_task):
+            if task is not None and not task.done():
+                task.cancel()
+
 class CarbonEngine:
     def __init__(self):
         # Fallback factors if database lookup fails
@@ -21,118 +44,192 @@ class CarbonEngine:
         }
         self.geocoder = Nominatim(user_agent="scope3wh_carbon_engine")
 
-    async def calculate(self, mapping: MappingResult, extraction: ExtractionResult) -> CarbonResult:
+    def _lookup_factor(self, naics_code: Optional[str], scope_category: str):
+        """Returns (factor, naics_code, category, is_verified) for the mapped NAICS code."""
         conn = None
         cursor = None
         factor = 0.03 # Default fallback
-        naics_code = mapping.naics_code
-        category = mapping.scope_category
+        category = scope_category
         is_verified = False
-        grand_total = extraction.grand_total
+
+        if not naics_code:
+            return factor, naics_code, category, is_verified
+
+        try:
+            conn = get_snowflake_connection()
+            cursor = conn.cursor()
+            
+            query = f"""
+                SELECT "Supply Chain Emission Factors with Margins", "2017 NAICS Title"
+                FROM {q('EMISSIONS_DATA')} 
+                WHERE "2017 NAICS Code" = %s 
+                LIMIT 1
+            """
+            cursor.execute(query, (naics_code,))
+            row = cursor.fetchone()
+            if row:
+                factor = float(row[0])
+                category = row[1]
+                is_verified = True
+                logger.info(f"Verified high-fidelity factor for NAICS {naics_code}: {factor}")
+            else:
+                # Fuzzy search backup
+                query_title = f"""
+                    SELECT "Supply Chain Emission Factors with Margins", "2017 NAICS Code", "2017 NAICS Title"
+                    FROM {q('EMISSIONS_DATA')} 
+                    WHERE "2017 NAICS Title" ILIKE %s 
+                    LIMIT 1
+                """
+                cursor.execute(query_title, (f"%{scope_category}%",))
+                row_t = cursor.fetchone()
+                if row_t:
+                    factor = float(row_t[0])
+                    naics_code = str(row_t[1])
+                    category = row_t[2]
+                    is_verified = True
+
+        except Exception as db_e:
+            logger.error(f"Database lookup failed: {db_e}")
+        finally:
+            if cursor: cursor.close()
+            if conn: conn.close()
+
+        return factor, naics_code, category, is_verified
+
+    async def _geocode(self, address: Optional[str]):
+        if not address:
+            return None
+        # Nominatim is sync, so run it in a worker thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, nominatim_breaker.call_sync, self.geocoder.geocode, address)
+
+    @staticmethod
+    def route(vendor_address: Optional[str], receiver_address: Optional[str],
+              origin_address: Optional[str] = None, destination_address: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+        """Shipping origin/destination, falling back to vendor -> receiver; (None, None) unless both are known."""
+        origin = origin_address or vendor_address
+        destination = destination_address or receiver_address
+        if not (origin and destination):
+            return None, None
+        return origin, destination
+
+    async def _geocode_stage(self, timer: StageTimer, name: str, address: Optional[str]):
+        if not address:
+            return None
+        # Concurrent geocodes (origin/destination, other invoices) share the 1 req/s policy limit.
+        # The wait has its own budget, so a backlog does not eat the geocode's timeout.
+        try:
+            await asyncio.wait_for(nominatim_quota.acquire(), settings.NOMINATIM_QUEUE_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.warning(f"Carbon sub-stage '{name}' skipped: Nominatim quota backlog")
+            return None
+        return await self._safe_stage(timer, name, self._geocode(address), settings.STAGE_TIMEOUT_GEOCODE)
+
+    async def _locate(self, timer: StageTimer, origin: Optional[str], destination: Optional[str]):
+        return tuple(await asyncio.gather(
+            self._geocode_stage(timer, "carbon.geocode_origin", origin),
+            self._geocode_stage(timer, "carbon.geocode_destination", destination),
+        ))
+
+    async def _factor(self, timer: StageTimer, naics_code: Optional[str], scope_category: str):
+        loop = asyncio.get_running_loop()
+        default_lookup = (0.03, naics_code, scope_category, False)
+        return await self._safe_stage(
+            timer, "carbon.factor_lookup",
+            loop.run_in_executor(None, self._lookup_factor, naics_code, scope_category),
+            settings.STAGE_TIMEOUT_FACTOR_LOOKUP, default_lookup
+        )
+
+    def prefetch_route(self, prefetch: CarbonPrefetch, timer: StageTimer, origin: Optional[str], destination: Optional[str]):
+        prefetch.route = (origin, destination)
+        prefetch.route_task = asyncio.ensure_future(self._locate(timer, origin, destination))
+
+    def prefetch_factor(self, prefetch: CarbonPrefetch, timer: StageTimer, naics_code: Optional[str], scope_category: str):
+        prefetch.factor_key = (naics_code, scope_category)
+        prefetch.factor_task = asyncio.ensure_future(self._factor(timer, naics_code, scope_category))
+
+    async def _safe_stage(self, timer: StageTimer, name: str, awaitable, timeout: float, default=None):
+        try:
+            return await timer.run(name, awaitable, timeout)
+        except Exception as e:
+            logger.warning(f"Carbon sub-stage '{name}' failed: {e}")
+            return default
+
+    async def calculate(self, mapping: MappingResult, extraction: ExtractionResult, timer: Optional[StageTimer] = None,
+                        prefetch: Optional[CarbonPrefetch] = None, fx: Optional[FxProvenance] = None) -> CarbonResult:
+        """`fx` is the provenance of an earlier run, reused so a recomputation converts at the same rate."""
+        timer = timer or StageTimer("carbon")
+        # EPA factors are kg CO2e per USD, so spend is converted first
+        fx = fx_rates.resolve(extraction.currency, extraction.invoice_date, fx)
         
         try:
-            # 1. High-fidelity lookup via NAICS Code
-            if naics_code:
-                try:
-                    conn = get_snowflake_connection()
-                    cursor = conn.cursor()
-                    
-                    query = f"""
-                        SELECT "Supply Chain Emission Factors with Margins", "2017 NAICS Title"
-                        FROM {q('EMISSIONS_DATA')} 
-                        WHERE "2017 NAICS Code" = %s 
-                        LIMIT 1
-                    """
-                    cursor.execute(query, (naics_code,))
-                    row = cursor.fetchone()
-                    if row:
-                        factor = float(row[0])
-                        category = row[1]
-                        is_verified = True
-                        logger.info(f"Verified high-fidelity factor for NAICS {naics_code}: {factor}")
-                    else:
-                        # Fuzzy search backup
-                        query_title = f"""
-                            SELECT "Supply Chain Emission Factors with Margins", "2017 NAICS Code", "2017 NAICS Title"
-                            FROM {q('EMISSIONS_DATA')} 
-                            WHERE "2017 NAICS Title" ILIKE %s 
-                            LIMIT 1
-                        """
-                        cursor.execute(query_title, (f"%{mapping.scope_category}%",))
-                        row_t = cursor.fetchone()
-                        if row_t:
-                            factor = float(row_t[0])
-                            naics_code = str(row_t[1])
-                            category = row_t[2]
-                            is_verified = True
-
-                except Exception as db_e:
-                    logger.error(f"Database lookup failed: {db_e}")
-                finally:
-                    if cursor: cursor.close()
-                    if conn: conn.close()
-
-            spend_based_emissions = grand_total * factor
+            shipping = extraction.shipping_details
+            origin, destination = self.route(
+                extraction.vendor_address, extraction.receiver_address,
+                shipping.origin_address if shipping else None,
+                shipping.destination_address if shipping else None,
+            )
+
+            # Factor lookup and both geocodes are independent, so run them concurrently,
+            # reusing whatever was already started while the extraction streamed in
+            prefetch = prefetch or CarbonPrefetch()
+            factor_task = prefetch.factor_task if prefetch.factor_key == (mapping.naics_code, mapping.scope_category) else None
+            route_task = prefetch.route_task if prefetch.route == (origin, destination) else None
+            for stale in (prefetch.factor_task, prefetch.route_task):
+                if stale is not None and stale not in (factor_task, route_task):
+                    stale.cancel()
+
+            lookup, (loc_origin, loc_dest) = await asyncio.gather(
+                factor_task or self._factor(timer, mapping.naics_code, mapping.scope_category),
+                route_task or self._locate(timer, origin, destination),
+            )
+            factor, naics_code, category, is_verified = lookup
+
+            spend_usd, spend_based_emissions, line_breakdowns = self._spend_based(
+                factor, extraction, mapping.standardized_line_items, fx
+            )
             
             # 2. Logistics/Shipping Calculation via Geocoding
             logistics_emissions = 0.0
             distance_km = None
+            logistics_skipped = None
             
-            origin = None
-            destination = None
-            
-            if extraction.shipping_details:
-                origin = extraction.shipping_details.origin_address
-                destination = extraction.shipping_details.destination_address
-            
-            # Fallback to vendor address -> receiver address if shipping details are missing
-            if not origin: origin = extraction.vendor_address
-            if not destination: destination = extraction.receiver_address
-            
-            if origin and destination:
+            if origin and destination and not (loc_origin and loc_dest):
+                # A known route that could not be located is not a zero-emission shipment
+                logistics_skipped = "shipping route could not be geocoded"
+            elif loc_origin and loc_dest:
                 try:
-                    # Geocoding is slow, so we do it in a thread if possible or just await it
-                    # Note: Nominatim is sync, but we'll wrap it
-                    loop = asyncio.get_event_loop()
-                    loc_origin = await loop.run_in_executor(None, lambda: self.geocoder.geocode(origin))
-                    loc_dest = await loop.run_in_executor(None, lambda: self.geocoder.geocode(destination))
+                    distance_km = geodesic((loc_origin.latitude, loc_origin.longitude), 
+                                           (loc_dest.latitude, loc_dest.longitude)).kilometers
+                    
+                    # Calculate emissions based on distance and weight
+                    # Logistics Factor: ~0.15 kg CO2e per tonne-km (Road)
+                    weight_kg = (extraction.shipping_details.weight_kg if extraction.shipping_details else None) or 10.0 # Default 10kg
+                    tonne_km = (weight_kg / 1000.0) * distance_km
+                    
+                    # Adjust factor by method
+                    method_factor = 0.15 # Road default
+                    method = (extraction.shipping_details.shipping_method or "Ground").lower() if extraction.shipping_details else "ground"
+                    if "air" in method: method_factor = 0.8
+                    elif "sea" in method or "ocean" in method: method_factor = 0.02
                     
-                    if loc_origin and loc_dest:
-                        distance_km = geodesic((loc_origin.latitude, loc_origin.longitude), 
-                                               (loc_dest.latitude, loc_dest.longitude)).kilometers
-                        
-                        # Calculate emissions based on distance and weight
-                        # Logistics Factor: ~0.15 kg CO2e per tonne-km (Road)
-                        weight_kg = (extraction.shipping_details.weight_kg if extraction.shipping_details else None) or 10.0 # Default 10kg
-                        tonne_km = (weight_kg / 1000.0) * distance_km
-                        
-                        # Adjust factor by method
-                        method_factor = 0.15 # Road default
-                        method = (extraction.shipping_details.shipping_method or "Ground").lower() if extraction.shipping_details else "ground"
-                        if "air" in method: method_factor = 0.8
-                        elif "sea" in method or "ocean" in method: method_factor = 0.02
-                        
-                        logistics_emissions = tonne_km * method_factor
-                        logger.info(f"Logistics calculation: {distance_km:.2f}km, {weight_kg}kg, {method} -> {logistics_emissions:.4f}kg CO2e")
+                    logistics_emissions = tonne_km * method_factor
+                    logger.info(f"Logistics calculation: {distance_km:.2f}km, {weight_kg}kg, {method} -> {logistics_emissions:.4f}kg CO2e")
                 except Exception as geo_e:
                     logger.warning(f"Geocoding/Logistics calculation failed: {geo_e}")
+                    logistics_emissions, distance_km = 0.0, None
+                    logistics_skipped = f"logistics calculation failed: {geo_e}"
 
-            total_kg_co2e = spend_based_emissions + logistics_emissions
-            
-            line_breakdowns = []
-            for item in mapping.standardized_line_items:
-                item_total = item.get("total", 0)
-                item_emissions = item_total * factor
-                line_breakdowns.append({
-                    "description": item.get("description"),
-                    "item_emissions": item_emissions,
-                    "factor_used": factor
-                })
+            total_kg_co2e = None if spend_based_emissions is None else spend_based_emissions + logistics_emissions
 
             return CarbonResult(
                 total_kg_co2e=total_kg_co2e,
                 spend_based_kg_co2e=spend_based_emissions,
+                spend_factor=factor,
+                spend_usd=spend_usd,
+                fx=fx,
                 logistics_kg_co2e=logistics_emissions,
+                logistics_skipped=logistics_skipped,
                 distance_km=distance_km,
                 scope="Scope 3",
                 category=category,
@@ -145,4 +242,52 @@ class CarbonEngine:
             logger.error(f"Carbon calculation failed: {e}")
             raise
 
+    @staticmethod
+    def _spend_based(factor: float, extraction: ExtractionResult, line_items: LineItemTable, fx: FxProvenance
+                     ) -> Tuple[Optional[float], Optional[float], BreakdownTable]:
+        """
+        (spend_usd, spend-based kg, line breakdown). Without an FX rate all three
+        are left empty: the factor is per USD, so kg computed from the invoice
+        currency would be wrong by the exchange rate. The audit flags the
+        invoice and the recompute job fills them in once the rate file covers it.
+        """
+        spend_usd = fx_rates.to_usd(extraction.grand_total, fx)
+        if spend_usd is None:
+            return None, None, BreakdownTable()
+        return spend_usd, spend_usd * factor, BreakdownTable.from_totals(line_items, factor, fx_rates.convert(line_items.total, fx))
+
+    def recompute_spend(self, carbon: CarbonResult, mapping: MappingResult, extraction: ExtractionResult) -> CarbonResult:
+        """
+        Re-derives the spend-based part of a stored result offline: same factor,
+        stored FX provenance (resolved from the local rate table for results
+        that predate it), stored logistics emissions. No geocoding, no factor
+        lookup.
+        """
+        if carbon.spend_factor is not None:
+            factor = carbon.spend_factor
+        elif len(carbon.line_level_breakdown):
+            factor = carbon.line_level_breakdown.factor_used[0]
+        elif carbon.spend_based_kg_co2e is None:
+            factor = 0.0
+        elif carbon.spend_usd:
+            factor = carbon.spend_based_kg_co2e / carbon.spend_usd
+        elif extraction.grand_total:
+            # Results from before FX conversion applied the factor to the raw total
+            factor = carbon.spend_based_kg_co2e / extraction.grand_total
+        else:
+            factor = 0.0
+
+        fx = fx_rates.resolve(extraction.currency, extraction.invoice_date, carbon.fx)
+        spend_usd, spend_based_emissions, line_breakdowns = self._spend_based(
+            factor, extraction, mapping.standardized_line_items, fx
+        )
+        return carbon.model_copy(update={
+            "total_kg_co2e": None if spend_based_emissions is None else spend_based_emissions + carbon.logistics_kg_co2e,
+            "spend_based_kg_co2e": spend_based_emissions,
+            "spend_factor": factor,
+            "spend_usd": spend_usd,
+            "fx": fx,
+            "line_level_breakdown": line_breakdowns,
+        })
+
 carbon_engine = CarbonEngine()
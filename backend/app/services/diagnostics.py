@@ -0,0 +1,378 @@
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.stages import inflight
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DiagnosticsBusy(Exception):
+    """Another profile/trace is already running; callers map this to 409."""
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame, root: Optional[str] = None) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    if root:
+        labels.append(root)
+    return ";".join(reversed(labels))
+
+
+def collapsed_text(stacks: Counter) -> str:
+    """Brendan Gregg's collapsed format, as read by flamegraph.pl and speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# --- whole-process sampling CPU profile ----------------------------------
+
+_profile_lock = threading.Lock()
+
+
+def sample_process(seconds: float, interval_ms: float) -> Dict[str, Any]:
+    """
+    Samples every thread's stack for `seconds` (blocking; run it in an
+    executor). Costs one `sys._current_frames()` walk per interval and is
+    capped by DIAG_PROFILE_MAX_S, so it can run against live traffic.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise DiagnosticsBusy("A CPU profile is already running")
+    try:
+        seconds = min(max(seconds, 0.1), settings.DIAG_PROFILE_MAX_S)
+        interval = max(interval_ms, 1.0) / 1000.0
+        me = threading.get_ident()
+        names = {}
+        stacks: Counter = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stacks[_collapse(frame, f"thread:{names.get(ident, ident)}")] += 1
+            samples += 1
+            time.sleep(interval)
+        return {"seconds": seconds, "interval_ms": interval * 1000, "samples": samples, "stacks": stacks}
+    finally:
+        _profile_lock.release()
+
+
+# --- per-request opt-in profiling ----------------------------------------
+
+# Profile key of the request/invoice the current task works for; tasks it
+# spawns inherit it and are attributed to the same profile.
+profile_key: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("profile_key", default=None)
+
+
+class _Session:
+    def __init__(self, key: str):
+        self.key = key
+        self.started = time.time()
+        self.duration_s = 0.0
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self.stage_ms: Dict[str, float] = {}
+
+
+class RequestProfiler:
+    """
+    Opt-in sampling profiles of single requests/invoices on the event loop.
+
+    While at least one session is open a daemon thread samples the loop
+    thread every DIAG_PROFILE_INTERVAL_MS and charges the stack to the
+    session of the task that is running at that instant; tasks spawned
+    inside a session are tracked through a task factory. Work of other
+    invoices interleaved on the same loop therefore does not end up in the
+    profile. At most DIAG_MAX_PROFILED_REQUESTS sessions run at once, and
+    finished profiles are kept in a short ring buffer.
+    """
+
+    def __init__(self, max_sessions: int, keep: int, interval_ms: float):
+        self.max_sessions = max_sessions
+        self.interval = max(interval_ms, 1.0) / 1000.0
+        self._sessions: Dict[str, _Session] = {}
+        self._tasks: "weakref.WeakKeyDictionary[asyncio.Task, str]" = weakref.WeakKeyDictionary()
+        self._requested: Dict[str, float] = {}
+        self._done: Deque[_Session] = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._previous_factory = None
+
+    # Requests opt their invoice in; the orchestrator opens the session when it starts on it
+    def request(self, doc_id: str):
+        self._requested[doc_id] = time.time()
+
+    def requested(self, doc_id: str) -> bool:
+        return self._requested.pop(doc_id, None) is not None
+
+    def _install(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._previous_factory = loop.get_task_factory()
+        loop.set_task_factory(self._task_factory)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        key = profile_key.get()
+        if key is not None:
+            self._tasks[task] = key
+        return task
+
+    @asynccontextmanager
+    async def session(self, key: str, strict: bool = True):
+        """Profiles the enclosed block; with `strict=False` a full profiler just runs it unprofiled."""
+        with self._lock:
+            busy = key in self._sessions or len(self._sessions) >= self.max_sessions
+            if not busy:
+                self._install()
+                session = _Session(key)
+                self._sessions[key] = session
+        if busy:
+            message = f"Cannot profile {key}: {len(self._sessions)} profiles already running"
+            if strict:
+                raise DiagnosticsBusy(message)
+            logger.warning(message)
+            yield None
+            return
+        self._tasks[asyncio.current_task()] = key
+        token = profile_key.set(key)
+        started = time.perf_counter()
+        self._ensure_sampler()
+        try:
+            yield session
+        finally:
+            profile_key.reset(token)
+            session.duration_s = round(time.perf_counter() - started, 3)
+            with self._lock:
+                self._sessions.pop(key, None)
+                self._done.append(session)
+            logger.info(f"Profile {key}: {session.samples} samples over {session.duration_s}s")
+
+    def _ensure_sampler(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+            self._thread.start()
+
+    def _sample_loop(self):
+        # asyncio's map of loop -> running task; read from this thread, a sample may be one step stale
+        current_tasks = asyncio.tasks._current_tasks
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+            task = current_tasks.get(self._loop)
+            key = self._tasks.get(task) if task is not None else None
+            frame = sys._current_frames().get(self._loop_thread)
+            with self._lock:
+                session = self._sessions.get(key) if key else None
+                if session is not None and frame is not None:
+                    session.stacks[_collapse(frame)] += 1
+                    session.samples += 1
+            time.sleep(self.interval)
+
+    def profiles(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            done = list(self._done)
+            running = list(self._sessions.values())
+        return [
+            {"key": s.key, "running": s in running, "started": s.started, "duration_s": s.duration_s,
+             "samples": s.samples, "stage_ms": s.stage_ms}
+            for s in running + done[::-1]
+        ]
+
+    def get(self, key: str) -> Optional[_Session]:
+        with self._lock:
+            for s in list(self._sessions.values()) + list(self._done)[::-1]:
+                if s.key == key:
+                    return s
+        return None
+
+
+# --- tracemalloc snapshots ------------------------------------------------
+
+class MemoryTracer:
+    """tracemalloc with a baseline snapshot; stops itself after DIAG_TRACEMALLOC_MAX_S."""
+
+    def __init__(self, max_seconds: float):
+        self.max_seconds = max_seconds
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._started_here = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def start(self, frames: int) -> Dict[str, Any]:
+        if tracemalloc.is_tracing():
+            raise DiagnosticsBusy("tracemalloc is already tracing")
+        tracemalloc.start(max(1, min(frames, 50)))
+        self._started_here = True
+        self._baseline = tracemalloc.take_snapshot()
+        self._timer = asyncio.get_running_loop().call_later(self.max_seconds, self.stop)
+        logger.warning(f"tracemalloc started ({frames} frames); stops automatically in {self.max_seconds:.0f}s")
+        return self.status()
+
+    def diff(self, top: int, key_type: str = "lineno", rebase: bool = False) -> Dict[str, Any]:
+        if not tracemalloc.is_tracing() or self._baseline is None:
+            raise DiagnosticsBusy("tracemalloc is not running; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        stats = snapshot.compare_to(self._baseline, key_type)
+        if rebase:
+            self._baseline = snapshot
+        return {
+            **self.status(),
+            "top": [
+                {
+                    "where": str(stat.traceback[0]) if stat.traceback else "?",
+                    "traceback": stat.traceback.format()[-6:] if key_type == "traceback" else None,
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "size_kb": round(stat.size / 1024, 1),
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:top]
+            ],
+        }
+
+    def stop(self) -> Dict[str, Any]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._started_here and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("tracemalloc stopped")
+        self._started_here = False
+        self._baseline = None
+        return self.status()
+
+    def status(self) -> Dict[str, Any]:
+        traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "traced_kb": round(traced / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "rss_bytes": _rss_bytes(),
+        }
+
+
+# --- asyncio task dump ----------------------------------------------------
+
+def dump_tasks(stack_depth: int = 3) -> Dict[str, Any]:
+    """Every task on the running loop with where it is suspended, plus in-flight invoices by stage."""
+    current = asyncio.current_task()
+    tasks = []
+    for task in asyncio.all_tasks():
+        if task is current:
+            continue
+        coro = task.get_coro()
+        frames = task.get_stack(limit=stack_depth) if stack_depth else []
+        tasks.append({
+            "name": task.get_name(),
+            "coro": getattr(coro, "__qualname__", repr(coro)),
+            "awaiting": [f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_lineno})" for f in frames],
+        })
+    tasks.sort(key=lambda t: t["name"])
+    return {"task_count": len(tasks), "pipelines": inflight.snapshot(), "tasks": tasks}
+
+
+# --- event-loop lag -------------------------------------------------------
+
+class LoopLagMonitor:
+    """
+    Sleeps DIAG_LOOP_LAG_INTERVAL_S at a time and records how late it wakes
+    up: the time the loop was blocked by synchronous work. One timer per
+    interval, so it stays on in production.
+    """
+
+    def __init__(self, interval: float, warn_ms: float, window: int = 600):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._max_ms = 0.0
+        self._over = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="diagnostics:loop-lag")
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag_ms = max(time.perf_counter() - expected, 0.0) * 1000
+            self._samples.append(lag_ms)
+            self._max_ms = max(self._max_ms, lag_ms)
+            if lag_ms >= self.warn_ms:
+                self._over += 1
+                logger.warning(f"Event loop blocked for {lag_ms:.0f}ms ({len(inflight)} invoices in flight)")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self._samples)
+
+        def pct(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 2) if ordered else 0.0
+
+        return {
+            "interval_s": self.interval,
+            "samples": len(ordered),
+            "lag_p50_ms": pct(0.50),
+            "lag_p95_ms": pct(0.95),
+            "lag_p99_ms": pct(0.99),
+            "lag_max_ms": round(self._max_ms, 2),
+            "over_warn_threshold": self._over,
+        }
+
+
+request_profiler = RequestProfiler(
+    max_sessions=settings.DIAG_MAX_PROFILED_REQUESTS,
+    keep=settings.DIAG_KEEP_PROFILES,
+    interval_ms=settings.DIAG_PROFILE_INTERVAL_MS,
+)
+memory_tracer = MemoryTracer(max_seconds=settings.DIAG_TRACEMALLOC_MAX_S)
+loop_lag = LoopLagMonitor(
+    interval=settings.DIAG_LOOP_LAG_INTERVAL_S,
+    warn_ms=settings.DIAG_LOOP_LAG_WARN_MS,
+)
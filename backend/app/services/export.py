@@ -0,0 +1,266 @@
+import argparse
+import io
+import logging
+import sys
+from datetime import date
+from typing import Any, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from app.core.db import LIKE_ESCAPE, contains_pattern, get_snowflake_connection, q
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+HEADER_SCHEMA = pa.schema([
+    ("DOC_ID", pa.string()),
+    ("COMPANY_ID", pa.string()),
+    ("VENDOR_NAME", pa.string()),
+    ("VENDOR_CANONICAL", pa.string()),
+    ("INVOICE_NUMBER", pa.string()),
+    ("INVOICE_DATE", pa.date32()),
+    ("CURRENCY", pa.string()),
+    ("GRAND_TOTAL", pa.float64()),
+    ("SPEND_USD", pa.float64()),
+    ("FX_RATE", pa.float64()),
+    ("FX_RATE_DATE", pa.date32()),
+    ("NAICS_CODE", pa.string()),
+    ("CATEGORY", pa.string()),
+    ("SCOPE", pa.string()),
+    ("CARBON_KG_CO2E", pa.float64()),
+    ("SPEND_BASED_KG_CO2E", pa.float64()),
+    ("LOGISTICS_KG_CO2E", pa.float64()),
+    ("CONFIDENCE_SCORE", pa.float64()),
+    ("RULE_VERSION", pa.string()),
+    ("FACTOR_VERSION", pa.string()),
+    ("FINALIZED_TS", pa.timestamp("us")),
+])
+
+LINE_SCHEMA = pa.schema([
+    ("DOC_ID", pa.string()),
+    ("COMPANY_ID", pa.string()),
+    ("VENDOR_CANONICAL", pa.string()),
+    ("INVOICE_NUMBER", pa.string()),
+    ("INVOICE_DATE", pa.date32()),
+    ("CURRENCY", pa.string()),
+    ("NAICS_CODE", pa.string()),
+    ("CATEGORY", pa.string()),
+    ("LINE_NO", pa.int64()),
+    ("DESCRIPTION", pa.string()),
+    ("LINE_TOTAL", pa.float64()),
+    ("ITEM_KG_CO2E", pa.float64()),
+    ("FACTOR_USED", pa.float64()),
+    ("FINALIZED_TS", pa.timestamp("us")),
+])
+
+_HEADER_COLUMNS = """
+    f.DOC_ID::STRING AS DOC_ID,
+    f.COMPANY_ID::STRING AS COMPANY_ID,
+    f.STANDARDIZED_JSON:extraction.vendor_name::STRING AS VENDOR_NAME,
+    f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING AS VENDOR_CANONICAL,
+    f.STANDARDIZED_JSON:extraction.invoice_number::STRING AS INVOICE_NUMBER,
+    TRY_TO_DATE(f.STANDARDIZED_JSON:extraction.invoice_date::STRING) AS INVOICE_DATE,
+    f.STANDARDIZED_JSON:extraction.currency::STRING AS CURRENCY,
+    f.STANDARDIZED_JSON:extraction.grand_total::FLOAT AS GRAND_TOTAL,
+    f.STANDARDIZED_JSON:carbon.spend_usd::FLOAT AS SPEND_USD,
+    IFF(f.STANDARDIZED_JSON:carbon.fx.status::STRING = 'missing', NULL,
+        f.STANDARDIZED_JSON:carbon.fx.rate::FLOAT) AS FX_RATE,
+    TRY_TO_DATE(f.STANDARDIZED_JSON:carbon.fx.rate_date::STRING) AS FX_RATE_DATE,
+    f.STANDARDIZED_JSON:carbon.naics_code::STRING AS NAICS_CODE,
+    f.STANDARDIZED_JSON:carbon.category::STRING AS CATEGORY,
+    f.STANDARDIZED_JSON:carbon.scope::STRING AS SCOPE,
+    f.CARBON_KG_CO2E::FLOAT AS CARBON_KG_CO2E,
+    f.STANDARDIZED_JSON:carbon.spend_based_kg_co2e::FLOAT AS SPEND_BASED_KG_CO2E,
+    f.STANDARDIZED_JSON:carbon.logistics_kg_co2e::FLOAT AS LOGISTICS_KG_CO2E,
+    f.CONFIDENCE_SCORE::FLOAT AS CONFIDENCE_SCORE,
+    f.RULE_VERSION::STRING AS RULE_VERSION,
+    f.FACTOR_VERSION::STRING AS FACTOR_VERSION,
+    f.FINALIZED_TS AS FINALIZED_TS
+"""
+
+_LINE_COLUMNS = """
+    f.DOC_ID::STRING AS DOC_ID,
+    f.COMPANY_ID::STRING AS COMPANY_ID,
+    f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING AS VENDOR_CANONICAL,
+    f.STANDARDIZED_JSON:extraction.invoice_number::STRING AS INVOICE_NUMBER,
+    TRY_TO_DATE(f.STANDARDIZED_JSON:extraction.invoice_date::STRING) AS INVOICE_DATE,
+    f.STANDARDIZED_JSON:extraction.currency::STRING AS CURRENCY,
+    f.STANDARDIZED_JSON:carbon.naics_code::STRING AS NAICS_CODE,
+    f.STANDARDIZED_JSON:carbon.category::STRING AS CATEGORY,
+    li.INDEX::INTEGER AS LINE_NO,
+    li.VALUE:description::STRING AS DESCRIPTION,
+    GET(f.STANDARDIZED_JSON:mapping.standardized_line_items, li.INDEX):total::FLOAT AS LINE_TOTAL,
+    li.VALUE:item_emissions::FLOAT AS ITEM_KG_CO2E,
+    li.VALUE:factor_used::FLOAT AS FACTOR_USED,
+    f.FINALIZED_TS AS FINALIZED_TS
+"""
+
+
+class ExportFilters:
+    def __init__(
+        self,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        vendor: Optional[str] = None,
+        naics_code: Optional[str] = None,
+        company_id: Optional[str] = None,
+    ):
+        self.company_id = company_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.vendor = vendor
+        self.naics_code = naics_code
+
+    def where_clause(self) -> Tuple[str, List[Any]]:
+        clauses = []
+        params: List[Any] = []
+        if self.company_id:
+            clauses.append("f.COMPANY_ID = %s")
+            params.append(self.company_id)
+        if self.start_date:
+            clauses.append("TRY_TO_DATE(f.STANDARDIZED_JSON:extraction.invoice_date::STRING) >= %s")
+            params.append(self.start_date)
+        if self.end_date:
+            clauses.append("TRY_TO_DATE(f.STANDARDIZED_JSON:extraction.invoice_date::STRING) <= %s")
+            params.append(self.end_date)
+        if self.vendor:
+            clauses.append(
+                f"(f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING ILIKE %s {LIKE_ESCAPE}"
+                f" OR f.STANDARDIZED_JSON:extraction.vendor_name::STRING ILIKE %s {LIKE_ESCAPE})"
+            )
+            params.extend([contains_pattern(self.vendor)] * 2)
+        if self.naics_code:
+            clauses.append("f.STANDARDIZED_JSON:carbon.naics_code::STRING = %s")
+            params.append(self.naics_code)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+
+def build_export_query(level: str, filters: ExportFilters) -> Tuple[str, List[Any], pa.Schema]:
+    where, params = filters.where_clause()
+    if level == "line":
+        sql = f"""
+            SELECT {_LINE_COLUMNS}
+            FROM {q('FINAL_AUDIT_RESULTS')} f,
+                 LATERAL FLATTEN(input => f.STANDARDIZED_JSON:carbon.line_level_breakdown) li
+            {where}
+        """
+        return sql, params, LINE_SCHEMA
+    if level == "header":
+        sql = f"""
+            SELECT {_HEADER_COLUMNS}
+            FROM {q('FINAL_AUDIT_RESULTS')} f
+            {where}
+        """
+        return sql, params, HEADER_SCHEMA
+    raise ValueError(f"Unknown export level: {level}")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object the Arrow writers flush into; drained after every batch."""
+
+    def __init__(self):
+        super().__init__()
+        self._parts: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _conform(batch: pa.Table, schema: pa.Schema) -> pa.Table:
+    # Snowflake may pick different physical types per result chunk (e.g. NUMBER scale),
+    # so every batch is cast to the fixed export schema before writing.
+    return batch.select(schema.names).cast(schema, safe=False)
+
+
+def iter_arrow_batches(level: str, filters: ExportFilters) -> Iterator[pa.Table]:
+    sql, params, schema = build_export_query(level, filters)
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        for batch in cursor.fetch_arrow_batches():
+            yield _conform(batch, schema)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def stream_export(fmt: str, level: str, filters: ExportFilters) -> Iterator[bytes]:
+    """
+    Yields the export as encoded chunks, one per Snowflake Arrow batch, so only
+    a single batch is held in memory at any time.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    _, _, schema = build_export_query(level, filters)
+    sink = _ChunkSink()
+    if fmt == "csv":
+        writer = pa_csv.CSVWriter(sink, schema)
+    else:
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+
+    rows = 0
+    try:
+        for table in iter_arrow_batches(level, filters):
+            writer.write_table(table)
+            rows += table.num_rows
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+
+    tail = sink.drain()
+    if tail:
+        yield tail
+    logger.info(f"Export complete: format={fmt}, level={level}, rows={rows}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Export finalized emissions from FINAL_AUDIT_RESULTS.")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--level", choices=["header", "line"], default="header")
+    parser.add_argument("--start-date", type=date.fromisoformat)
+    parser.add_argument("--end-date", type=date.fromisoformat)
+    parser.add_argument("--vendor")
+    parser.add_argument("--naics")
+    parser.add_argument("--company", help="Restrict to one COMPANY_ID (defaults to all tenants)")
+    parser.add_argument("--out", help="Output file (defaults to stdout)")
+    args = parser.parse_args(argv)
+
+    filters = ExportFilters(args.start_date, args.end_date, args.vendor, args.naics, args.company)
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        for chunk in stream_export(args.format, args.level, filters):
+            out.write(chunk)
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
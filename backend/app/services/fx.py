@@ -0,0 +1,196 @@
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.models.schemas import FxProvenance
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_CURRENCY = "USD"
+_BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FxRateUnavailable(Exception):
+    def __init__(self, currency: str, on: date, reason: str):
+        super().__init__(f"No {currency} rate for {on.isoformat()}: {reason}")
+        self.currency = currency
+        self.on = on
+
+
+class FxRateTable:
+    """
+    Historical daily FX rates, held as two parallel arrays per currency:
+    `array('l')` of sorted date ordinals and `array('d')` of USD per unit.
+
+    A lookup bisects the dates for the latest rate on or before the invoice
+    date (weekends and holidays have no fixing), and refuses rates older than
+    `max_staleness_days`. Converting a whole column is one lookup and one
+    pass over the array.
+
+    The rates file is a CSV with a `date,currency,rate` header, where `rate`
+    is units of the currency per 1 USD (the usual quote, e.g. JPY 149.8).
+    """
+
+    def __init__(self, rates: Dict[str, Tuple[array, array]], version: Optional[str], max_staleness_days: int):
+        self._rates = rates
+        self.version = version
+        self.max_staleness_days = max_staleness_days
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[date, str, float]], version: Optional[str] = None,
+                  max_staleness_days: int = 7) -> "FxRateTable":
+        by_currency: Dict[str, Dict[int, float]] = {}
+        for on, currency, per_usd in rows:
+            if per_usd <= 0:
+                continue
+            # A repeated date keeps the last fixing
+            by_currency.setdefault(currency.strip().upper(), {})[on.toordinal()] = 1.0 / per_usd
+        rates = {}
+        for currency, series in by_currency.items():
+            ordinals = sorted(series)
+            rates[currency] = (array("l", ordinals), array("d", (series[o] for o in ordinals)))
+        return cls(rates, version, max_staleness_days)
+
+    @classmethod
+    def load(cls, path: str, max_staleness_days: int = 7) -> "FxRateTable":
+        with open(path, "rb") as fh:
+            raw = fh.read()
+        version = f"{os.path.basename(path)}@{hashlib.sha256(raw).hexdigest()[:12]}"
+
+        def rows():
+            for n, row in enumerate(csv.DictReader(raw.decode("utf-8").splitlines()), start=2):
+                try:
+                    yield date.fromisoformat(row["date"].strip()), row["currency"], float(row["rate"])
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping malformed FX row {n} in {path}: {e}")
+
+        table = cls.from_rows(rows(), version, max_staleness_days)
+        logger.info(f"Loaded FX rates {version}: {len(table)} fixings for {len(table.currencies())} currencies")
+        return table
+
+    def __len__(self) -> int:
+        return sum(len(dates) for dates, _ in self._rates.values())
+
+    def currencies(self) -> List[str]:
+        return sorted(self._rates)
+
+    def lookup(self, currency: str, on: date) -> Tuple[float, date]:
+        """Returns (USD per unit, fixing date) of the latest rate on or before `on`."""
+        currency = currency.strip().upper()
+        if currency == BASE_CURRENCY:
+            return 1.0, on
+        series = self._rates.get(currency)
+        if series is None:
+            raise FxRateUnavailable(currency, on, "currency not in rate table")
+        dates, rates = series
+        i = bisect_right(dates, on.toordinal()) - 1
+        if i < 0:
+            raise FxRateUnavailable(currency, on, f"table starts {date.fromordinal(dates[0]).isoformat()}")
+        if on.toordinal() - dates[i] > self.max_staleness_days:
+            raise FxRateUnavailable(currency, on, f"latest fixing is {date.fromordinal(dates[i]).isoformat()}")
+        return rates[i], date.fromordinal(dates[i])
+
+    def resolve(self, currency: Optional[str], invoice_date: Optional[str]) -> FxProvenance:
+        """Conversion to USD for one invoice; never raises, a missing rate is recorded as status 'missing'."""
+        currency = (currency or BASE_CURRENCY).strip().upper() or BASE_CURRENCY
+        if currency == BASE_CURRENCY:
+            return FxProvenance(source_currency=currency)
+        try:
+            on = date.fromisoformat((invoice_date or "")[:10])
+            rate, rate_date = self.lookup(currency, on)
+        except (ValueError, FxRateUnavailable) as e:
+            logger.warning(f"FX conversion skipped for {currency} invoice dated {invoice_date}: {e}")
+            return FxProvenance(source_currency=currency, table_version=self.version, status="missing")
+        return FxProvenance(
+            source_currency=currency, rate=rate, rate_date=rate_date,
+            table_version=self.version, status="converted",
+        )
+
+    @staticmethod
+    def to_usd(amount: Optional[float], provenance: FxProvenance) -> Optional[float]:
+        """USD amount, or None when no rate was found (an unconverted amount is not USD)."""
+        if amount is None or provenance.status == "missing":
+            return None
+        return amount * provenance.rate
+
+    @staticmethod
+    def convert(amounts: array, provenance: FxProvenance) -> array:
+        """Converts a whole amount column with the invoice's rate."""
+        if provenance.status == "missing":
+            raise ValueError(f"No USD rate for {provenance.source_currency}; amounts cannot be converted")
+        if provenance.rate == 1.0:
+            return amounts
+        return array("d", map(provenance.rate.__mul__, amounts))
+
+
+class FxRates:
+    """Lazily loaded, process-wide rate table; an absent file leaves only USD convertible."""
+
+    def __init__(self, path: str, max_staleness_days: int):
+        self.path = path
+        self.max_staleness_days = max_staleness_days
+        self._table: Optional[FxRateTable] = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self) -> FxRateTable:
+        if self._table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._load()
+        return self._table
+
+    def _load(self) -> FxRateTable:
+        try:
+            return FxRateTable.load(self.path, self.max_staleness_days)
+        except FileNotFoundError:
+            logger.warning(f"FX rate file {self.path} not found; non-USD invoices will have no USD spend")
+            return FxRateTable({}, None, self.max_staleness_days)
+
+    def reload(self):
+        table = self._load()
+        with self._lock:
+            self._table = table
+
+    def resolve(self, currency: Optional[str], invoice_date: Optional[str],
+                stored: Optional[FxProvenance] = None) -> FxProvenance:
+        """
+        Conversion for one invoice. A `stored` provenance from an earlier run
+        is reused as-is when it converted the same currency, so recomputing a
+        result neither needs the rate file nor picks up revised fixings.
+        """
+        currency = (currency or BASE_CURRENCY).strip().upper() or BASE_CURRENCY
+        if stored is not None and stored.status != "missing" and stored.source_currency == currency:
+            return stored
+        return self.table.resolve(currency, invoice_date)
+
+    def to_usd(self, amount: Optional[float], provenance: FxProvenance) -> Optional[float]:
+        return FxRateTable.to_usd(amount, provenance)
+
+    def convert(self, amounts: array, provenance: FxProvenance) -> array:
+        return FxRateTable.convert(amounts, provenance)
+
+
+# A relative FX_RATES_PATH is relative to the backend directory, not the working directory
+fx_rates = FxRates(
+    os.path.join(_BACKEND_DIR, settings.FX_RATES_PATH),
+    settings.FX_MAX_STALENESS_DAYS,
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up the USD conversion for a currency and invoice date.")
+    parser.add_argument("currency")
+    parser.add_argument("invoice_date")
+    args = parser.parse_args()
+
+    print(fx_rates.resolve(args.currency, args.invoice_date).model_dump_json(indent=2))
@@ -0,0 +1,156 @@
+import json
+import logging
+from typing import Any, Iterable, List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = " \t\r\n"
+
+# Event kinds returned by StreamingObjectParser.feed
+FIELD = "field"
+ITEM = "item"
+ARRAY_DONE = "array_done"
+
+
+class StreamingObjectParser:
+    """
+    Incremental parser for one top-level JSON object arriving in text chunks.
+
+    `feed()` scans only the new characters and returns events as soon as they
+    are complete:
+
+      ("field", key, value)        a top-level member other than a streamed array
+      ("item", key, index, value)  one element of a streamed array (e.g. line_items)
+      ("array_done", key, count)   a streamed array closed
+
+    Anything before the first "{" (such as a code fence) is skipped, as is
+    anything after the closing "}". The parser never re-reads earlier text,
+    so a whole response costs O(n). Values are decoded with `json.loads` on
+    their own span; `document()` returns the complete object text for the
+    authoritative parse at the end.
+    """
+
+    def __init__(self, stream_arrays: Iterable[str] = ()):
+        self.stream_arrays = set(stream_arrays)
+        self._text = ""
+        self._pos = 0
+        self._start: Optional[int] = None
+        self._end: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key: Optional[str] = None
+        self._key_start: Optional[int] = None
+        self._expect_value = False
+        self._value_start: Optional[int] = None
+        self._streaming: Optional[str] = None
+        self._item_start: Optional[int] = None
+        self._item_count = 0
+
+    @property
+    def done(self) -> bool:
+        return self._end is not None
+
+    def document(self) -> str:
+        if self._start is None:
+            return self._text
+        return self._text[self._start:self._end + 1 if self._end is not None else None]
+
+    def _decode(self, start: int, end: int) -> Tuple[bool, Any]:
+        try:
+            return True, json.loads(self._text[start:end])
+        except ValueError as e:
+            logger.debug(f"Skipping undecodable streamed value: {e}")
+            return False, None
+
+    def _finish_member(self, end: int, events: List[tuple]):
+        if self._key is not None and self._value_start is not None:
+            if self._key in self.stream_arrays and self._text[self._value_start] == "[":
+                events.append((ARRAY_DONE, self._key, self._item_count))
+            else:
+                ok, value = self._decode(self._value_start, end)
+                if ok:
+                    events.append((FIELD, self._key, value))
+        self._key = None
+        self._expect_value = False
+        self._value_start = None
+
+    def _finish_item(self, end: int, events: List[tuple]):
+        if self._item_start is not None:
+            ok, value = self._decode(self._item_start, end)
+            if ok:
+                events.append((ITEM, self._streaming, self._item_count, value))
+            self._item_count += 1
+        self._item_start = None
+
+    def feed(self, chunk: str) -> List[tuple]:
+        events: List[tuple] = []
+        if self.done or not chunk:
+            return events
+        self._text += chunk
+        text = self._text
+        i = self._pos
+        n = len(text)
+
+        while i < n and not self.done:
+            c = text[i]
+
+            if self._start is None:
+                if c == "{":
+                    self._start = i
+                    self._depth = 1
+                i += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(text[self._key_start:i + 1])
+                        self._key_start = None
+                i += 1
+                continue
+
+            if c in _WHITESPACE:
+                i += 1
+                continue
+
+            depth = self._depth
+            if depth == 1 and self._expect_value and self._value_start is None:
+                self._value_start = i
+                if c == "[" and self._key in self.stream_arrays:
+                    self._streaming = self._key
+                    self._item_count = 0
+            elif self._streaming and depth == 2 and self._item_start is None and c not in ",]":
+                self._item_start = i
+
+            if c == '"':
+                self._in_string = True
+                if depth == 1 and not self._expect_value:
+                    self._key_start = i
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._streaming and self._depth == 1:
+                    self._finish_item(i, events)
+                    self._streaming = None
+                elif self._depth == 0:
+                    self._finish_member(i, events)
+                    self._end = i
+            elif c == ",":
+                if self._streaming and depth == 2:
+                    self._finish_item(i, events)
+                elif depth == 1:
+                    self._finish_member(i, events)
+            elif c == ":" and depth == 1:
+                self._expect_value = True
+            i += 1
+
+        self._pos = i
+        return events
@@ -1,10 +1,12 @@
 import google.generativeai as genai
 from app.core.config import settings
+from app.core.breakers import gemini_breaker
+from app.services.scheduler import gemini_quota
 from app.models.schemas import MappingResult, ExtractionResult, LineItem
-from typing import List, Dict, Any
+from app.models.line_items import LineItemTable
+from typing import List, Dict, Any, Optional
 import json
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -48,20 +50,25 @@ class MappingAgent:
         )
         self.rule_version = "2.0.0 (Semantic)"
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-    async def map_invoice(self, extraction: ExtractionResult) -> MappingResult:
+    async def classify(self, vendor_name: str, line_items: List[LineItem], grand_total: Optional[float]) -> Dict[str, Any]:
+        """
+        Asks Gemini for the NAICS code of an invoice. Only needs the vendor and
+        (some of) the line items, so the orchestrator can call it with the
+        first items of a streamed extraction before the totals are known.
+        """
         response_text = ""
         try:
             # Prepare extraction data for Gemini
             extraction_data = {
-                "vendor_name": extraction.vendor_name,
-                "line_items": [item.model_dump() for item in extraction.line_items],
-                "grand_total": extraction.grand_total
+                "vendor_name": vendor_name,
+                "line_items": [item.model_dump() for item in line_items],
+                "grand_total": grand_total
             }
 
             prompt = f"Identify the NAICS code for this invoice data: {json.dumps(extraction_data)}"
 
-            response = await self.model.generate_content_async(prompt)
+            await gemini_quota.acquire()
+            response = await gemini_breaker.call(self.model.generate_content_async, prompt)
             response_text = response.text
             
             # Robust extraction of JSON from response (handling potential backticks)
@@ -71,32 +78,34 @@ class MappingAgent:
             elif "```" in clean_json:
                 clean_json = clean_json.split("```")[-1].split("```")[0].strip()
             
-            mapping_data = json.loads(clean_json)
-            
-            naics_code = mapping_data.get("naics_code")
-            naics_title = mapping_data.get("naics_title")
-            canonical_vendor = mapping_data.get("vendor_canonical", extraction.vendor_name)
-            confidence = mapping_data.get("mapping_confidence", 0.7)
-
-            # Standardize Line Items (Add emission factor keys placeholders)
-            standardized_items = []
-            for item in extraction.line_items:
-                std_item = item.model_dump()
-                std_item["mapped_category"] = naics_title
-                std_item["naics_code"] = naics_code
-                standardized_items.append(std_item)
-
-            return MappingResult(
-                vendor_canonical=canonical_vendor,
-                standardized_line_items=standardized_items,
-                scope_category=naics_title,
-                naics_code=naics_code,
-                mapping_confidence=confidence,
-                rule_version=self.rule_version
-            )
+            return json.loads(clean_json)
 
         except Exception as e:
             logger.error(f"Semantic mapping failed: {e}. Raw Response: {response_text}")
             raise
 
+    def build_result(self, extraction: ExtractionResult, mapping_data: Dict[str, Any]) -> MappingResult:
+        naics_code = mapping_data.get("naics_code")
+        naics_title = mapping_data.get("naics_title")
+        canonical_vendor = mapping_data.get("vendor_canonical", extraction.vendor_name)
+        confidence = mapping_data.get("mapping_confidence", 0.7)
+
+        # Standardize Line Items (column table; NAICS fields are shared by every row)
+        standardized_items = LineItemTable.from_line_items(
+            extraction.line_items, mapped_category=naics_title, naics_code=naics_code
+        )
+
+        return MappingResult(
+            vendor_canonical=canonical_vendor,
+            standardized_line_items=standardized_items,
+            scope_category=naics_title,
+            naics_code=naics_code,
+            mapping_confidence=confidence,
+            rule_version=self.rule_version
+        )
+
+    async def map_invoice(self, extraction: ExtractionResult) -> MappingResult:
+        mapping_data = await self.classify(extraction.vendor_name, extraction.line_items, extraction.grand_total)
+        return self.build_result(extraction, mapping_data)
+
 mapping_agent = MappingAgent()
@@ -1,10 +1,13 @@
 import google.generativeai as genai
 from app.core.config import settings
+from app.core.breakers import gemini_breaker
+from app.services.scheduler import gemini_quota
 from app.models.schemas import ExtractionResult
+from app.services.json_stream import StreamingObjectParser, FIELD, ITEM, ARRAY_DONE
+from typing import Any, Dict, List, Optional
 import json
 import logging
-import asyncio
-from tenacity import retry, stop_after_attempt, wait_exponential
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +24,18 @@ generation_config = {
     "response_mime_type": "application/json",
 }
 
+class ExtractionListener:
+    """Receives a streamed extraction piece by piece; the default ignores everything."""
+
+    def on_field(self, key: str, value: Any):
+        pass
+
+    def on_line_item(self, index: int, item: Dict[str, Any]):
+        pass
+
+    def on_line_items_done(self, count: int):
+        pass
+
 class OCRAgent:
     def __init__(self):
         self.model = genai.GenerativeModel(
@@ -31,15 +46,23 @@ class OCRAgent:
             Your task is to extract structured data from invoice images or PDF content.
             Return STRICT JSON only. No markdown formatting, no comments.
             
-            Required JSON Structure:
+            Required JSON Structure (emit the keys in exactly this order):
             {
+                "is_standard_invoice": boolean (true if the document is a valid invoice, false otherwise),
                 "vendor_name": "string",
                 "vendor_address": "string (optional)",
                 "receiver_name": "string (the company receiving the invoice)",
                 "receiver_address": "string (optional)",
+                "shipping_details": {
+                    "origin_address": "string (optional - where the goods are shipped from)",
+                    "destination_address": "string (optional - where the goods are delivered)",
+                    "shipping_method": "string (e.g., Ground, Air, Sea)",
+                    "weight_kg": float
+                },
                 "invoice_number": "string",
                 "invoice_date": "YYYY-MM-DD",
                 "currency": "ISO 4217 code",
+                "grand_total": float (the amount due as printed on the invoice),
                 "line_items": [
                     {
                         "description": "string",
@@ -49,83 +72,117 @@ class OCRAgent:
                         "unit": "string (optional)"
                     }
                 ],
-                "shipping_details": {
-                    "origin_address": "string (optional - where the goods are shipped from)",
-                    "destination_address": "string (optional - where the goods are delivered)",
-                    "shipping_method": "string (e.g., Ground, Air, Sea)",
-                    "weight_kg": float
-                },
                 "subtotal": float,
                 "tax": float,
-                "grand_total": float,
-                "extraction_confidence": float (0.0 to 1.0),
-                "is_standard_invoice": boolean (true if the document is a valid invoice, false otherwise)
+                "extraction_confidence": float (0.0 to 1.0)
             }
             
             Guidelines:
             1. If the provided document is NOT an invoice (e.g., it is a general document, a photo, or an unreadable file), set "is_standard_invoice" to false and fill other fields with null or 0.
             2. Normalize dates to YYYY-MM-DD.
             3. If a field is missing, use null or 0.0 for numbers.
+            4. Keep the key order above: the response is parsed while it streams, so header fields (including grand_total) must come before line items.
             """
         )
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-    async def extract(self, file_content: bytes, file_type: str) -> ExtractionResult:
+    def _parts(self, file_content: bytes, file_type: str) -> List[Any]:
+        # Snowflake returns bytearray for BINARY fields, but Gemini/Pydantic often expect bytes
+        if isinstance(file_content, bytearray):
+            file_content = bytes(file_content)
+        # Prepare content parts
+        # Note: For PDF/Image handling, we assume file_content is bytes.
+        # In a real scenario, we might need to upload to File API or encode appropriately.
+        # For this simplified version, we'll try to pass it directly if supported or assume text if extracted beforehand.
+        # Gemini 1.5/2.5 accepts parts.
+        
+        parts = []
+        if file_type == "application/pdf":
+             parts.append({"mime_type": "application/pdf", "data": file_content})
+        elif file_type.startswith("image/"):
+            parts.append({"mime_type": file_type, "data": file_content})
+        else:
+             # Fallback for text/other (handle potential binary decoding errors)
+             try:
+                 parts.append(file_content.decode("utf-8"))
+             except UnicodeDecodeError:
+                 parts.append("[Unreadable Binary Content]")
+        return parts
+
+    def _parse(self, json_str: str) -> ExtractionResult:
         try:
-            # Snowflake returns bytearray for BINARY fields, but Gemini/Pydantic often expect bytes
-            if isinstance(file_content, bytearray):
-                file_content = bytes(file_content)
-            # Prepare content parts
-            # Note: For PDF/Image handling, we assume file_content is bytes.
-            # In a real scenario, we might need to upload to File API or encode appropriately.
-            # For this simplified version, we'll try to pass it directly if supported or assume text if extracted beforehand.
-            # Gemini 1.5/2.5 accepts parts.
-            
-            parts = []
-            if file_type == "application/pdf":
-                 parts.append({"mime_type": "application/pdf", "data": file_content})
-            elif file_type.startswith("image/"):
-                parts.append({"mime_type": file_type, "data": file_content})
-            else:
-                 # Fallback for text/other (handle potential binary decoding errors)
-                 try:
-                     parts.append(file_content.decode("utf-8"))
-                 except UnicodeDecodeError:
-                     parts.append("[Unreadable Binary Content]")
-
-            prompt = "Extract invoice data from the provided file."
-
-            response = await self.model.generate_content_async([prompt, *parts])
+            if "```json" in json_str:
+                json_str = json_str.split("```json")[-1].split("```")[0].strip()
+            elif "```" in json_str:
+                json_str = json_str.split("```")[-1].split("```")[0].strip()
             
-            # Parse JSON
-            try:
-                json_str = response.text
-                if "```json" in json_str:
-                    json_str = json_str.split("```json")[-1].split("```")[0].strip()
-                elif "```" in json_str:
-                    json_str = json_str.split("```")[-1].split("```")[0].strip()
-                
-                data = json.loads(json_str)
-                # Validate with Pydantic
-                result = ExtractionResult(**data)
-                return result
-            except (json.JSONDecodeError, Exception) as parse_err:
-                logger.error(f"Failed to parse AI response: {parse_err}")
-                return ExtractionResult(
-                    vendor_name="Unknown",
-                    invoice_number="N/A",
-                    invoice_date="1970-01-01",
-                    currency="USD",
-                    line_items=[],
-                    subtotal=0,
-                    tax=0,
-                    grand_total=0,
-                    extraction_confidence=0.0,
-                    is_standard_invoice=False
-                )
+            data = json.loads(json_str)
+            # Validate with Pydantic
+            result = ExtractionResult(**data)
+            return result
+        except (json.JSONDecodeError, Exception) as parse_err:
+            logger.error(f"Failed to parse AI response: {parse_err}")
+            return ExtractionResult(
+                vendor_name="Unknown",
+                invoice_number="N/A",
+                invoice_date="1970-01-01",
+                currency="USD",
+                line_items=[],
+                subtotal=0,
+                tax=0,
+                grand_total=0,
+                extraction_confidence=0.0,
+                is_standard_invoice=False
+            )
+
+    async def extract(self, file_content: bytes, file_type: str, listener: Optional[ExtractionListener] = None) -> ExtractionResult:
+        """
+        Extracts the invoice. With OCR_STREAMING the response is streamed and
+        `listener` hears about header fields and each finished line item while
+        the rest is still being generated; the returned result is always
+        parsed from the complete response.
+        """
+        try:
+            contents = ["Extract invoice data from the provided file.", *self._parts(file_content, file_type)]
+
+            await gemini_quota.acquire()
+            if not settings.OCR_STREAMING:
+                response = await gemini_breaker.call(self.model.generate_content_async, contents)
+                return self._parse(response.text)
+
+            json_str = await gemini_breaker.call(self._stream, contents, listener or ExtractionListener())
+            return self._parse(json_str)
 
         except Exception as e:
             logger.error(f"OCR Extraction failed: {e}")
             raise
 
+    async def _stream(self, contents: List[Any], listener: ExtractionListener) -> str:
+        parser = StreamingObjectParser(stream_arrays=("line_items",))
+        started = time.perf_counter()
+        first_item_ms = None
+
+        response = await self.model.generate_content_async(contents, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks carrying only a finish reason / safety ratings have no text
+                continue
+            for event in parser.feed(text):
+                if event[0] == FIELD:
+                    listener.on_field(event[1], event[2])
+                elif event[0] == ITEM and isinstance(event[3], dict):
+                    if first_item_ms is None:
+                        first_item_ms = (time.perf_counter() - started) * 1000
+                    listener.on_line_item(event[2], event[3])
+                elif event[0] == ARRAY_DONE:
+                    listener.on_line_items_done(event[2])
+
+        if first_item_ms is not None:
+            logger.info(
+                f"OCR stream: first line item after {first_item_ms:.0f}ms, "
+                f"complete after {(time.perf_counter() - started) * 1000:.0f}ms"
+            )
+        return parser.document()
+
 ocr_agent = OCRAgent()
@@ -1,61 +1,204 @@
 import asyncio
 import logging
-import json
 from datetime import datetime
+from typing import Any, Dict, List, Optional
 from app.core.db import get_snowflake_connection, q
-from app.models.schemas import InvoiceUploadResponse, FinalResult
-from app.services.ocr import ocr_agent
+from app.models.schemas import InvoiceUploadResponse, FinalResult, ExtractionResult, MappingResult, LineItem
+from app.services.ocr import ocr_agent, ExtractionListener
+from app.services.preprocess import preprocessor
 from app.services.mapping import mapping_agent
-from app.services.carbon import carbon_engine
+from app.services.carbon import carbon_engine, CarbonPrefetch
 from app.services.audit import audit_layer
+from app.services.vendor_stats import vendor_stats, invoice_facts
+from app.services.write_buffer import write_buffer
 from app.core.config import settings
+from app.core.serialization import to_variant
+from app.services.stages import StageTimer, gather_stages, inflight
+from app.services.diagnostics import request_profiler
+from app.services.retry_queue import classify_failure, retry_delay
+from app.services.scheduler import pipeline_scheduler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _discard(task: Optional[asyncio.Task]):
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        # Mark a failed early stage as handled; the pipeline did not need it
+        task.exception()
+
+
+class _EarlyStages(ExtractionListener):
+    """
+    Starts the stages that only need part of a streamed OCR response.
+
+    The OCR prompt puts the addresses, shipping details and grand total
+    before the line items, so geocoding starts with the first line item; NAICS
+    classification starts once OCR_STREAM_MAPPING_ITEMS line items (or all of
+    them, if fewer) have arrived, and the emission factor lookup as soon as it
+    returns. All of it overlaps with the rest of the generation. Nothing
+    starts for documents the model has already flagged as non-invoices.
+
+    The early classification only becomes the mapping if it saw everything
+    `map_invoice` would have sent; otherwise it just served to prefetch a
+    factor, and the full extraction is classified again.
+    """
+
+    def __init__(self, timer: StageTimer):
+        self.timer = timer
+        self.header: Dict[str, Any] = {}
+        self.items: List[LineItem] = []
+        self.carbon = CarbonPrefetch()
+        self.classify_task: Optional[asyncio.Task] = None
+        # What the early classification was given
+        self.classified_items = 0
+        self.classified_total: Any = None
+
+    def _standard(self) -> bool:
+        return self.header.get("is_standard_invoice") is not False
+
+    def on_field(self, key: str, value: Any):
+        self.header[key] = value
+        if key == "shipping_details":
+            self._start_route()
+
+    def on_line_item(self, index: int, item: Dict[str, Any]):
+        try:
+            self.items.append(LineItem(**item))
+        except Exception:
+            # Left to the full parse at the end
+            return
+        self._start_route()
+        if len(self.items) >= settings.OCR_STREAM_MAPPING_ITEMS:
+            self._start_classify()
+
+    def on_line_items_done(self, count: int):
+        self._start_route()
+        self._start_classify()
+
+    def _start_route(self):
+        if self.carbon.route_task is not None or not self._standard():
+            return
+        shipping = self.header.get("shipping_details")
+        shipping = shipping if isinstance(shipping, dict) else {}
+        origin, destination = carbon_engine.route(
+            self.header.get("vendor_address"), self.header.get("receiver_address"),
+            shipping.get("origin_address"), shipping.get("destination_address"),
+        )
+        if origin:
+            carbon_engine.prefetch_route(self.carbon, self.timer, origin, destination)
+
+    def _start_classify(self):
+        vendor_name = self.header.get("vendor_name")
+        if self.classify_task is not None or not self._standard() or not self.items or not vendor_name:
+            return
+        self.classified_items = len(self.items)
+        self.classified_total = self.header.get("grand_total")
+        self.classify_task = asyncio.ensure_future(self.timer.run(
+            "mapping.classify",
+            mapping_agent.classify(vendor_name, list(self.items), self.classified_total),
+            settings.STAGE_TIMEOUT_MAPPING,
+        ))
+        self.classify_task.add_done_callback(self._start_factor)
+
+    def _start_factor(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        data = task.result()
+        carbon_engine.prefetch_factor(self.carbon, self.timer, data.get("naics_code"), data.get("naics_title"))
+
+    def _complete(self, extraction: ExtractionResult) -> bool:
+        """Whether the early classification saw the same inputs `map_invoice` would send."""
+        return (
+            self.classified_items >= len(extraction.line_items)
+            and self.header.get("vendor_name") == extraction.vendor_name
+            and (extraction.grand_total is None or self.classified_total == extraction.grand_total)
+        )
+
+    async def mapping(self, extraction: ExtractionResult) -> MappingResult:
+        if self.classify_task is None or not self._complete(extraction):
+            # A still-running early classification is left to finish for its factor prefetch
+            return await mapping_agent.map_invoice(extraction)
+        try:
+            data = await self.classify_task
+        except Exception as e:
+            logger.warning(f"Early classification failed ({e}); classifying the full extraction")
+            return await mapping_agent.map_invoice(extraction)
+        return mapping_agent.build_result(extraction, data)
+
+    def cancel(self):
+        _discard(self.classify_task)
+        _discard(self.carbon.route_task)
+        _discard(self.carbon.factor_task)
+
+
 class Orchestrator:
     def __init__(self):
         pass
 
-    async def process_invoice(self, doc_id: str):
+    def _fetch_document(self, doc_id: str):
         conn = get_snowflake_connection()
         cursor = conn.cursor()
-        
         try:
-            logger.info(f"Starting processing for DOC_ID: {doc_id}")
-            
             # Ensure context
             cursor.execute(f"USE DATABASE {settings.SNOWFLAKE_DATABASE}")
             cursor.execute(f"USE SCHEMA {settings.SNOWFLAKE_SCHEMA}")
             cursor.execute(f"USE WAREHOUSE {settings.SNOWFLAKE_WAREHOUSE}")
 
-            # Fetch Raw Document
-            cursor.execute(f"SELECT RAW_BINARY, FILE_TYPE FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = '{doc_id}'")
+            cursor.execute(f"SELECT RAW_BINARY, FILE_TYPE, COMPANY_ID FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = %s", (doc_id,))
             row = cursor.fetchone()
             if not row:
                 raise ValueError(f"Document {doc_id} not found")
-            
-            raw_binary, file_type = row
+            return row
+        finally:
+            cursor.close()
+            conn.close()
+
+    async def process_invoice(self, doc_id: str, retry_count: int = 0) -> str:
+        """Runs the pipeline for one document; returns its resulting PROCESSING_STATUS."""
+        # Profiled only when the upload opted in (X-Profile with an admin token)
+        if request_profiler.requested(doc_id):
+            async with request_profiler.session(f"invoice:{doc_id}", strict=False) as profile:
+                return await self._process_invoice(doc_id, retry_count, profile)
+        return await self._process_invoice(doc_id, retry_count)
+
+    async def _process_invoice(self, doc_id: str, retry_count: int = 0, profile=None) -> str:
+        # Results and status changes go through the write buffer, so no Snowflake
+        # connection is held while the invoice waits on OCR/mapping.
+        stage = "fetch"
+        early = None
+        try:
+            logger.info(f"Starting processing for DOC_ID: {doc_id}" + (f" (retry {retry_count})" if retry_count else ""))
+
+            # Fetch Raw Document
+            loop = asyncio.get_running_loop()
+            raw_binary, file_type, company_id = await loop.run_in_executor(None, self._fetch_document, doc_id)
             
             # Update Status: Processing
-            self._update_status(cursor, doc_id, "ocr_processing")
+            write_buffer.set_status(doc_id, "ocr_processing")
+
+            timer = StageTimer(doc_id)
+            inflight.register(doc_id, company_id, timer)
+            early = _EarlyStages(timer)
 
-            # 1. OCR Stage
-            extraction = await ocr_agent.extract(raw_binary, file_type)
+            # 1. Pre-processing (downscale/grayscale/deskew/crop, PDF cleanup) + OCR Stage
+            # (falls back to the original bytes on error or timeout)
+            stage = "ocr"
+            ocr_binary, ocr_file_type, preprocess_stats = await timer.run("preprocess", preprocessor.preprocess(raw_binary, file_type))
+            extraction = await timer.run("ocr", ocr_agent.extract(ocr_binary, ocr_file_type, early), settings.STAGE_TIMEOUT_OCR)
             
-            # 2. Store Extracted Data 
-            # Note: Using INSERT ... SELECT because Snowflake doesn't allow PARSE_JSON in VALUES clause
-            cursor.execute(f"""
-                INSERT INTO {q('EXTRACTED_FIELDS')} (ID, DOC_ID, EXTRACTED_JSON, EXTRACTION_CONF, EXTRACTION_MODEL, VERSION)
-                SELECT %s, %s, PARSE_JSON(%s), %s, %s, %s
-            """, (f"{doc_id}_ext", doc_id, extraction.model_dump_json(), extraction.extraction_confidence, 'gemini-2.0-flash', '1.0'))
+            # 2. Store Extracted Data (encoded once, reused inside the final result below)
+            extraction_json = to_variant(extraction)
+            write_buffer.add_extracted(doc_id, extraction_json, extraction.extraction_confidence, 'gemini-2.0-flash', '1.0', to_variant(preprocess_stats))
             
-            self._update_status(cursor, doc_id, "ocr_complete")
-            await asyncio.sleep(1) # Safety delay for API rate limits
+            write_buffer.set_status(doc_id, "ocr_complete")
 
             if not extraction.is_standard_invoice:
                 # Bypass stages for non-standard documents
-                from app.models.schemas import MappingResult, CarbonResult
+                from app.models.schemas import CarbonResult
                 mapping = MappingResult(
                     vendor_canonical="Unknown",
                     standardized_line_items=[],
@@ -70,17 +213,36 @@ class Orchestrator:
                     category="N/A",
                     line_level_breakdown=[]
                 )
+                pre_audit = None
             else:
-                # 3. Mapping Stage
-                mapping = await mapping_agent.map_invoice(extraction)
-                self._update_status(cursor, doc_id, "mapped")
+                # 3. Mapping Stage (usually already classified while OCR streamed),
+                # alongside the audit checks that don't need carbon output
+                stage = "mapping"
+                mapping, pre_audit = await gather_stages(
+                    timer,
+                    ("mapping", early.mapping(extraction), settings.STAGE_TIMEOUT_MAPPING),
+                    ("pre_audit", audit_layer.pre_audit(extraction), settings.STAGE_TIMEOUT_AUDIT),
+                )
+                write_buffer.set_status(doc_id, "mapped")
 
-                # 4. Carbon Calculation Stage
-                carbon = await carbon_engine.calculate(mapping, extraction)
+                # 4. Carbon Calculation Stage (factor lookup and geocoding run concurrently inside,
+                # reusing the ones started during OCR)
+                stage = "carbon"
+                carbon = await timer.run(
+                    "carbon", carbon_engine.calculate(mapping, extraction, timer, early.carbon), settings.STAGE_TIMEOUT_CARBON
+                )
 
             # 5. Audit Stage
-            audit = await audit_layer.audit(extraction, carbon)
-            self._update_status(cursor, doc_id, "audited")
+            stage = "audit"
+            audit = await timer.run(
+                "audit",
+                audit_layer.audit(extraction, carbon, pre_audit, mapping=mapping, doc_id=doc_id, company_id=company_id),
+                settings.STAGE_TIMEOUT_AUDIT
+            )
+            write_buffer.set_status(doc_id, "audited")
+            timer.log_summary()
+            if profile is not None:
+                profile.stage_ms = timer.durations()
 
             # 6. Finalize
             final_result = FinalResult(
@@ -92,41 +254,65 @@ class Orchestrator:
                 finalized_ts=datetime.now()
             )
             
-            # Note: Using INSERT ... SELECT for Final Results
-            cursor.execute(f"""
-                INSERT INTO {q('FINAL_AUDIT_RESULTS')} (ID, DOC_ID, STANDARDIZED_JSON, CARBON_KG_CO2E, CONFIDENCE_SCORE, AUDIT_FLAGS, RULE_VERSION, FACTOR_VERSION)
-                SELECT %s, %s, PARSE_JSON(%s), %s, %s, PARSE_JSON(%s), %s, %s
-            """, (
-                f'{doc_id}_fin', 
-                doc_id, 
-                final_result.model_dump_json(), 
-                carbon.total_kg_co2e, 
-                audit.confidence_score, 
-                json.dumps(audit.audit_flags), 
-                mapping.rule_version, 
+            # Final row, rollup refresh and "finalized" status are committed together by the buffer
+            write_buffer.add_final(
+                doc_id,
+                company_id,
+                to_variant(final_result, reuse={"extraction": extraction_json}),
+                carbon.total_kg_co2e,
+                audit.confidence_score,
+                to_variant(audit.audit_flags),
+                mapping.rule_version,
                 'v1.0'
-            ))
+            )
+            write_buffer.set_status(doc_id, "finalized")
+            if extraction.is_standard_invoice:
+                vendor_stats.observe(company_id, doc_id, invoice_facts(extraction, carbon, mapping))
 
-            self._update_status(cursor, doc_id, "finalized")
             logger.info(f"Processing complete for DOC_ID: {doc_id}")
+            return "finalized"
 
+        except asyncio.CancelledError:
+            self.record_interrupted(doc_id, stage, retry_count)
+            raise
         except Exception as e:
-            logger.error(f"Pipeline failed for {doc_id}: {e}")
-            self._log_error(cursor, doc_id, str(e))
-            self._update_status(cursor, doc_id, "failed")
+            return self._record_failure(doc_id, stage, e, retry_count)
         finally:
-            cursor.close()
-            conn.close()
+            inflight.unregister(doc_id)
+            if early is not None:
+                early.cancel()
+
+    def _record_failure(self, doc_id: str, stage: str, exc: Exception, retry_count: int) -> str:
+        """Parks the document in the retry queue on transient errors, fails it otherwise; returns the new status."""
+        error_code, dependency, retryable = classify_failure(stage, exc)
+        # Waiting out an open breaker does not use up one of the document's attempts
+        attempts = retry_count if error_code == "CIRCUIT_OPEN" else retry_count + 1
+        if retryable and attempts <= settings.RETRY_MAX_ATTEMPTS:
+            delay = retry_delay(attempts, exc)
+            logger.warning(f"Pipeline failed for {doc_id} in {stage} ({error_code}): {exc}; retry {attempts} in {delay:.0f}s")
+            write_buffer.add_error(doc_id, stage, str(exc), error_code, attempts, dependency, delay)
+            write_buffer.set_status(doc_id, "retry_scheduled")
+            return "retry_scheduled"
+        else:
+            logger.error(f"Pipeline failed for {doc_id} in {stage} ({error_code}): {exc}")
+            write_buffer.add_error(doc_id, stage, str(exc), error_code, retry_count, dependency)
+            write_buffer.set_status(doc_id, "failed")
+            return "failed"
 
-    def _update_status(self, cursor, doc_id, status):
-        cursor.execute(f"UPDATE {q('RAW_DOCUMENTS')} SET PROCESSING_STATUS = %s, LAST_UPDATED_TS = CURRENT_TIMESTAMP() WHERE DOC_ID = %s", (status, doc_id))
+    def record_interrupted(self, doc_id: str, stage: str, retry_count: int):
+        """Hands a pipeline cut short by shutdown to the retry queue, without using up an attempt."""
+        logger.warning(f"Pipeline for {doc_id} interrupted in {stage}; rescheduled")
+        write_buffer.add_error(doc_id, stage, "Pipeline interrupted by shutdown", "INTERRUPTED", retry_count, None, 0)
+        write_buffer.set_status(doc_id, "retry_scheduled")
 
-    def _log_error(self, cursor, doc_id, error_msg):
-        import uuid
-        error_id = str(uuid.uuid4())
-        cursor.execute(f"""
-            INSERT INTO {q('ERROR_LOG')} (ERROR_ID, DOC_ID, STAGE, ERROR_MESSAGE)
-            VALUES (%s, %s, %s, %s)
-        """, (error_id, doc_id, 'pipeline', error_msg))
+    async def drain(self, timeout: float = settings.PIPELINE_DRAIN_TIMEOUT_S):
+        """
+        Shutdown: lets running pipelines finish for up to `timeout` seconds.
+        Pipelines cancelled after that and documents that were still queued
+        are parked in the retry queue, so the next process picks them up.
+        """
+        for doc_id, job in await pipeline_scheduler.close(timeout):
+            # Retry-queue jobs carry the document's attempt count
+            self.record_interrupted(doc_id, "queued", getattr(job, "keywords", {}).get("retry_count", 0))
 
 orchestrator = Orchestrator()
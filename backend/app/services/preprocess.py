@@ -0,0 +1,270 @@
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import NameObject
+
+from app.core.config import settings
+from app.models.schemas import PreprocessStats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    # HEIC phone photos; without the plugin they are sent to OCR unchanged
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+_DESKEW_MAX_ANGLE = 5.0
+_DESKEW_STEP = 0.25
+# A scanned page is blank only if under this fraction of its pixels is dark and none of them touch
+_BLANK_DARK_LEVEL = 128
+_BLANK_MAX_DARK_FRACTION = 1e-4
+
+# Content-stream operators that put marks on a page (text, vector paths, shadings, inline images)
+_MARKING_OPERATORS = {
+    b"Tj", b"TJ", b"'", b'"',
+    b"S", b"s", b"f", b"F", b"f*", b"B", b"B*", b"b", b"b*",
+    b"sh", b"INLINE IMAGE",
+}
+
+
+def _deskew_angle(gray: Image.Image) -> float:
+    """Projection-profile skew estimate: the angle whose row sums are most peaked."""
+    small = gray.copy()
+    small.thumbnail((800, 800))
+    ink = small.point(lambda p: 255 if p < 128 else 0)
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-_DESKEW_MAX_ANGLE, _DESKEW_MAX_ANGLE + _DESKEW_STEP, _DESKEW_STEP):
+        rows = np.asarray(ink.rotate(float(angle), fillcolor=0), dtype=np.float32).sum(axis=1)
+        score = float(np.square(np.diff(rows)).sum())
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def _crop_whitespace(gray: Image.Image, margin: int = 12) -> Image.Image:
+    bbox = ImageOps.invert(gray).point(lambda p: 255 if p > 40 else 0).getbbox()
+    if not bbox:
+        return gray
+    left, top, right, bottom = bbox
+    return gray.crop((
+        max(left - margin, 0), max(top - margin, 0),
+        min(right + margin, gray.width), min(bottom + margin, gray.height),
+    ))
+
+
+def _downscale(img: Image.Image, source_dpi: Optional[float], target_dpi: int, max_px: int) -> Image.Image:
+    scale = 1.0
+    if source_dpi and source_dpi > target_dpi:
+        scale = target_dpi / source_dpi
+    long_edge = max(img.size) * scale
+    if long_edge > max_px:
+        scale *= max_px / long_edge
+    if scale >= 0.99:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.LANCZOS)
+
+
+def _preprocess_image(content: bytes, target_dpi: int, max_px: int, quality: int) -> Tuple[bytes, str, List[str]]:
+    ops: List[str] = []
+    img = Image.open(io.BytesIO(content))
+    if getattr(img, "n_frames", 1) > 1:
+        # Multi-page TIFF/WebP: the JPEG output would keep only the first page
+        return b"", "", ["skipped:multi_frame"]
+    dpi = img.info.get("dpi", (None, None))[0]
+    img = ImageOps.exif_transpose(img)
+
+    gray = img.convert("L")
+    ops.append("grayscale")
+
+    gray = _downscale(gray, dpi, target_dpi, max_px)
+    if max(gray.size) < max(img.size):
+        ops.append(f"downscale:{img.width}x{img.height}->{gray.width}x{gray.height}")
+
+    angle = _deskew_angle(gray)
+    if abs(angle) >= _DESKEW_STEP:
+        gray = gray.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+        ops.append(f"deskew:{angle:+.2f}")
+
+    cropped = _crop_whitespace(gray)
+    if cropped.size != gray.size:
+        ops.append("crop")
+    gray = cropped
+
+    out = io.BytesIO()
+    gray.save(out, format="JPEG", quality=quality, optimize=True, dpi=(target_dpi, target_dpi))
+    ops.append(f"jpeg:q{quality}")
+    return out.getvalue(), "image/jpeg", ops
+
+
+def _has_ink(img: Image.Image) -> bool:
+    """
+    Any mark on a scanned image, judged at full resolution: a single line of
+    sparse text is a tiny fraction of a page, so averages over a thumbnail
+    cannot tell it from an empty sheet. Isolated dark pixels are scanner
+    noise; two dark pixels next to each other are ink.
+    """
+    dark = np.asarray(img.convert("L")) < _BLANK_DARK_LEVEL
+    if dark.mean() >= _BLANK_MAX_DARK_FRACTION:
+        return True
+    return bool(
+        (dark[1:, :] & dark[:-1, :]).any()
+        or (dark[:, 1:] & dark[:, :-1]).any()
+        or (dark[1:, 1:] & dark[:-1, :-1]).any()
+        or (dark[1:, :-1] & dark[:-1, 1:]).any()
+    )
+
+
+def _is_blank_page(page) -> bool:
+    """
+    True only for pages whose every mark has been checked: nothing drawn but
+    raster images, and those carry no ink (blank scanner sheets).
+    Text, vector paths (including text drawn as outlines), shadings, form
+    XObjects and annotations such as filled form fields all count as content,
+    whether or not any text can be extracted from them.
+    """
+    if page.get("/Annots"):
+        return False
+    contents = page.get_contents()
+    if contents is None:
+        return True
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources is not None else None
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    for operands, operator in contents.operations:
+        if operator in _MARKING_OPERATORS:
+            return False
+        if operator == b"Do":
+            xobject = xobjects.get(operands[0]) if operands else None
+            if xobject is None or xobject.get_object().get("/Subtype") != "/Image":
+                return False
+    return not any(_has_ink(image.image) for image in page.images)
+
+
+def _preprocess_pdf(content: bytes, target_dpi: int, quality: int) -> Tuple[bytes, str, List[str]]:
+    ops: List[str] = []
+    reader = PdfReader(io.BytesIO(content))
+    writer = PdfWriter()
+
+    blank = [i for i, page in enumerate(reader.pages) if _is_blank_page(page)]
+    if len(blank) == len(reader.pages):
+        blank = blank[1:]  # never hand OCR an empty document
+    for i, page in enumerate(reader.pages):
+        if i not in blank:
+            writer.add_page(page)
+    if blank:
+        ops.append(f"drop_blank_pages:{len(blank)}")
+
+    resampled = 0
+    for page in writer.pages:
+        # Drop resources OCR never looks at; /Annots stays, it carries filled form field values
+        for key in ("/Thumb", "/PieceInfo", "/AA"):
+            if key in page:
+                del page[NameObject(key)]
+        page_w_in = float(page.mediabox.width) / 72.0
+        for image in page.images:
+            img = image.image
+            if not page_w_in or img.width / page_w_in <= target_dpi * 1.1:
+                continue
+            scale = target_dpi / (img.width / page_w_in)
+            new = img.convert("L").resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            image.replace(new, quality=quality)
+            resampled += 1
+        page.compress_content_streams()
+    if resampled:
+        ops.append(f"resample_images:{resampled}@{target_dpi}dpi")
+
+    writer.metadata = None
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    ops.append("strip_resources")
+
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue(), "application/pdf", ops
+
+
+def _preprocess_sync(content: bytes, file_type: str, target_dpi: int, max_px: int, quality: int) -> Dict[str, Any]:
+    """Runs in a worker process; returns plain data so the result pickles cheaply."""
+    start = time.perf_counter()
+    if file_type == "application/pdf":
+        data, out_type, ops = _preprocess_pdf(content, target_dpi, quality)
+    else:
+        data, out_type, ops = _preprocess_image(content, target_dpi, max_px, quality)
+    return {
+        "data": data,
+        "file_type": out_type,
+        "operations": ops,
+        "duration_ms": (time.perf_counter() - start) * 1000,
+    }
+
+
+class Preprocessor:
+    """
+    Shrinks documents before they are sent to Gemini. CPU-heavy image work runs
+    in a process pool so it neither blocks the event loop nor contends for the GIL.
+    The original bytes are kept whenever processing fails or would not shrink them.
+    """
+
+    def __init__(self):
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=settings.PREPROCESS_WORKERS)
+        return self._pool
+
+    def supports(self, file_type: str) -> bool:
+        return file_type == "application/pdf" or file_type.startswith("image/")
+
+    async def preprocess(self, content: bytes, file_type: str) -> Tuple[bytes, str, PreprocessStats]:
+        if isinstance(content, bytearray):
+            content = bytes(content)
+        stats = PreprocessStats(original_bytes=len(content), processed_bytes=len(content), original_type=file_type, processed_type=file_type)
+        if not settings.PREPROCESS_ENABLED or not self.supports(file_type):
+            return content, file_type, stats
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(
+                    self._executor(), _preprocess_sync, content, file_type,
+                    settings.PREPROCESS_TARGET_DPI, settings.PREPROCESS_MAX_IMAGE_PX, settings.PREPROCESS_JPEG_QUALITY
+                ),
+                timeout=settings.STAGE_TIMEOUT_PREPROCESS
+            )
+        except Exception as e:
+            logger.warning(f"Pre-processing failed, sending original document: {e!r}")
+            stats.operations = ["skipped:error"]
+            return content, file_type, stats
+
+        stats.duration_ms = result["duration_ms"]
+        if any(op.startswith("skipped:") for op in result["operations"]):
+            stats.operations = result["operations"]
+            return content, file_type, stats
+        if len(result["data"]) >= len(content):
+            stats.operations = ["skipped:no_gain"]
+            return content, file_type, stats
+
+        stats.processed_bytes = len(result["data"])
+        stats.processed_type = result["file_type"]
+        stats.operations = result["operations"]
+        logger.info(f"Pre-processed {file_type}: {stats.original_bytes} -> {stats.processed_bytes} bytes ({', '.join(stats.operations)})")
+        return result["data"], result["file_type"], stats
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+preprocessor = Preprocessor()
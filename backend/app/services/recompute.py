@@ -0,0 +1,107 @@
+import argparse
+import logging
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.core.db import get_snowflake_connection, q
+from app.core.serialization import to_variant
+from app.models.schemas import FinalResult
+from app.services.analytics import rebuild_rollup
+from app.services.carbon import carbon_engine
+from app.services.write_buffer import _statement_batches
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_FETCH_ROWS = 500
+_WRITE_ROWS = 200
+_TOLERANCE_KG = 1e-6
+
+
+def _same_kg(a: Optional[float], b: Optional[float]) -> bool:
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= _TOLERANCE_KG
+
+
+def _write(cursor, rows: List[Sequence[Any]]):
+    for batch in _statement_batches(rows, _WRITE_ROWS):
+        values = ", ".join(["(%s, %s, %s)"] * len(batch))
+        cursor.execute(f"""
+            UPDATE {q('FINAL_AUDIT_RESULTS')} f
+            SET STANDARDIZED_JSON = PARSE_JSON(s.column2), CARBON_KG_CO2E = s.column3
+            FROM (SELECT column1, column2, column3 FROM VALUES {values}) s
+            WHERE f.DOC_ID = s.column1
+        """, [v for row in batch for v in row])
+
+
+def recompute_results(company_id: Optional[str] = None, since: Optional[date] = None, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Re-derives the spend-based emissions of finalized invoices, e.g. after the
+    FX conversion fix, without calling Gemini, Nominatim or any rate service:
+    each result is recomputed from its stored extraction, mapping, factor and
+    FX provenance (see `CarbonEngine.recompute_spend`). Changed rows are
+    rewritten in place and the analytics rollup is rebuilt once at the end.
+    """
+    clauses = ["COALESCE(f.STANDARDIZED_JSON:extraction.is_standard_invoice::BOOLEAN, TRUE)"]
+    params: List[Any] = []
+    if company_id:
+        clauses.append("f.COMPANY_ID = %s")
+        params.append(company_id)
+    if since:
+        clauses.append("f.FINALIZED_TS >= %s")
+        params.append(since)
+
+    counts = {"scanned": 0, "changed": 0, "unconverted": 0, "errors": 0}
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    write_cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT f.DOC_ID, f.STANDARDIZED_JSON
+            FROM {q('FINAL_AUDIT_RESULTS')} f
+            WHERE {' AND '.join(clauses)}
+            ORDER BY f.FINALIZED_TS
+        """, params)
+        while True:
+            batch = cursor.fetchmany(_FETCH_ROWS)
+            if not batch:
+                break
+            updates = []
+            for doc_id, payload in batch:
+                counts["scanned"] += 1
+                try:
+                    final = FinalResult.model_validate_json(payload)
+                    carbon = carbon_engine.recompute_spend(final.carbon, final.mapping, final.extraction)
+                except Exception as e:
+                    counts["errors"] += 1
+                    logger.warning(f"Could not recompute {doc_id}: {e}")
+                    continue
+                if carbon.fx.status == "missing":
+                    counts["unconverted"] += 1
+                if (_same_kg(carbon.total_kg_co2e, final.carbon.total_kg_co2e)
+                        and final.carbon.fx == carbon.fx and final.carbon.spend_usd == carbon.spend_usd):
+                    continue
+                counts["changed"] += 1
+                updates.append((doc_id, to_variant(final.model_copy(update={"carbon": carbon})), carbon.total_kg_co2e))
+            if updates and not dry_run:
+                _write(write_cursor, updates)
+        logger.info(f"Recompute {'(dry run) ' if dry_run else ''}finished: {counts}")
+    finally:
+        write_cursor.close()
+        cursor.close()
+        conn.close()
+
+    if counts["changed"] and not dry_run:
+        rebuild_rollup()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute spend-based emissions of finalized invoices from stored data.")
+    parser.add_argument("--company", default=None, help="Only this COMPANY_ID (default: all tenants)")
+    parser.add_argument("--since", type=date.fromisoformat, default=None, help="Only results finalized on or after this date")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+
+    print(recompute_results(args.company, args.since, args.dry_run))
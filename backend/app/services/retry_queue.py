@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import logging
+import os
+import random
+import socket
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.core.breakers import BREAKERS, OPEN, HALF_OPEN, CircuitOpenError
+from app.core.config import settings
+from app.core.db import get_snowflake_connection, q
+from app.services.scheduler import pipeline_scheduler
+from app.services.stages import StageTimeoutError
+from app.services.write_buffer import write_buffer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Identifies this process in RAW_DOCUMENTS.OWNER_ID while it holds a document's lease
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Documents per lease UPDATE, well under Snowflake's statement size cap
+_LEASE_BATCH = 1000
+
+# A lease that is missing or has run out
+_LEASE_EXPIRED = "(r.LEASE_EXPIRES_TS IS NULL OR r.LEASE_EXPIRES_TS < CURRENT_TIMESTAMP())"
+
+# Pipeline stage -> external dependency it waits on
+_STAGE_DEPENDENCY = {
+    "fetch": "snowflake",
+    "ocr": "gemini",
+    "mapping": "gemini",
+}
+
+
+def classify_failure(stage: str, exc: BaseException) -> Tuple[str, Optional[str], bool]:
+    """Returns (error_code, dependency, retryable) for a pipeline failure."""
+    if isinstance(exc, CircuitOpenError):
+        return "CIRCUIT_OPEN", exc.dependency, True
+    if isinstance(exc, StageTimeoutError):
+        return "STAGE_TIMEOUT", _STAGE_DEPENDENCY.get(exc.stage), True
+    for breaker in BREAKERS.values():
+        if breaker.is_failure(exc):
+            return "DEPENDENCY_UNAVAILABLE", _STAGE_DEPENDENCY.get(stage, breaker.name), True
+    return "PIPELINE_ERROR", None, False
+
+
+def retry_delay(retry_count: int, exc: BaseException) -> float:
+    """Seconds until the next attempt: the breaker's own timer if it is open, else jittered exponential backoff."""
+    if isinstance(exc, CircuitOpenError):
+        return exc.retry_after + random.uniform(0, settings.RETRY_POLL_INTERVAL_S)
+    delay = min(settings.RETRY_BASE_DELAY_S * 2 ** max(retry_count - 1, 0), settings.RETRY_MAX_DELAY_S)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class RetryQueue:
+    """
+    Resubmits documents whose pipeline failed on a transient error.
+
+    The queue lives in Snowflake: a failed document is parked with status
+    'retry_scheduled' and an ERROR_LOG row carrying stage, error code, retry
+    count, dependency and NEXT_ATTEMPT_TS. This loop polls for due documents
+    and hands them back to the fair-share scheduler, but only while the
+    breaker of the dependency they failed on lets traffic through: nothing
+    while it is open, a single probe document while it is half-open.
+
+    Every document this process has queued or running is leased to it
+    (OWNER_ID, LEASE_EXPIRES_TS on RAW_DOCUMENTS) and the lease is renewed
+    every RETRY_LEASE_HEARTBEAT_S, so a crashed worker's documents can be told
+    apart from another live worker's backlog.
+    """
+
+    def __init__(self, poll_interval: float, batch_size: int):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._job: Optional[Callable[..., Awaitable[Any]]] = None
+        self._inflight: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._metrics = {"polls": 0, "resubmitted": 0, "resumed": 0, "deferred": 0, "poll_errors": 0,
+                         "lease_renewals": 0, "lease_errors": 0}
+
+    def start(self, job: Callable[..., Awaitable[Any]]):
+        """`job(doc_id, retry_count=n)` re-runs the pipeline for one document."""
+        self._job = job
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+
+    async def _run(self):
+        try:
+            await self.resume_stranded()
+        except Exception as e:
+            logger.warning(f"Resuming stranded documents failed: {e}")
+        while not self._closing:
+            try:
+                await self.poll()
+            except Exception as e:
+                self._metrics["poll_errors"] += 1
+                logger.warning(f"Retry queue poll failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _renew(self, doc_ids: List[str]):
+        conn = get_snowflake_connection()
+        cursor = conn.cursor()
+        try:
+            for start in range(0, len(doc_ids), _LEASE_BATCH):
+                batch = doc_ids[start:start + _LEASE_BATCH]
+                cursor.execute(f"""
+                    UPDATE {q('RAW_DOCUMENTS')}
+                    SET OWNER_ID = %s, LEASE_EXPIRES_TS = DATEADD(second, %s, CURRENT_TIMESTAMP())::TIMESTAMP_NTZ
+                    WHERE DOC_ID IN ({", ".join(["%s"] * len(batch))})
+                """, [WORKER_ID, int(settings.RETRY_LEASE_TTL_S), *batch])
+        finally:
+            cursor.close()
+            conn.close()
+
+    async def _heartbeat(self):
+        while not self._closing:
+            held = sorted(pipeline_scheduler.held())
+            if held and BREAKERS["snowflake"].state != OPEN:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self._renew, held)
+                    self._metrics["lease_renewals"] += 1
+                except Exception as e:
+                    self._metrics["lease_errors"] += 1
+                    logger.warning(f"Renewing leases on {len(held)} documents failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.RETRY_LEASE_HEARTBEAT_S)
+            except asyncio.TimeoutError:
+                pass
+
+    def _due(self, limit: int) -> List[tuple]:
+        conn = get_snowflake_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"""
+                SELECT e.DOC_ID, r.COMPANY_ID, e.STAGE, e.ERROR_CODE, e.RETRY_COUNT, e.DEPENDENCY
+                FROM (
+                    SELECT DOC_ID, STAGE, ERROR_CODE, RETRY_COUNT, DEPENDENCY, NEXT_ATTEMPT_TS
+                    FROM {q('ERROR_LOG')}
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY DOC_ID ORDER BY CREATED_TS DESC) = 1
+                ) e
+                JOIN {q('RAW_DOCUMENTS')} r ON r.DOC_ID = e.DOC_ID
+                WHERE r.PROCESSING_STATUS = 'retry_scheduled'
+                  AND e.NEXT_ATTEMPT_TS <= CURRENT_TIMESTAMP()
+                ORDER BY e.NEXT_ATTEMPT_TS
+                LIMIT {int(limit)}
+            """)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    async def poll(self) -> int:
+        self._metrics["polls"] += 1
+        # Nothing can be fetched (or re-run) while Snowflake itself is down
+        if BREAKERS["snowflake"].state == OPEN:
+            return 0
+        rows = await asyncio.get_running_loop().run_in_executor(None, self._due, self.batch_size)
+
+        probes: Set[str] = set()
+        submitted = 0
+        for doc_id, company_id, stage, error_code, retry_count, dependency in rows:
+            if doc_id in self._inflight:
+                continue
+            breaker = BREAKERS.get(dependency)
+            if breaker is not None:
+                state = breaker.state
+                if state == OPEN or (state == HALF_OPEN and dependency in probes):
+                    self._metrics["deferred"] += 1
+                    continue
+                if state == HALF_OPEN:
+                    probes.add(dependency)
+
+            self._inflight.add(doc_id)
+            write_buffer.set_status(doc_id, "retry_queued")
+            pipeline_scheduler.submit(company_id, doc_id, functools.partial(self._attempt, retry_count=retry_count or 0))
+            submitted += 1
+            logger.info(f"Resubmitting {doc_id} after {error_code} in {stage} (retry {retry_count})")
+
+        self._metrics["resubmitted"] += submitted
+        return submitted
+
+    def _stranded(self, limit: int) -> List[tuple]:
+        conn = get_snowflake_connection()
+        cursor = conn.cursor()
+        try:
+            # Claim them first, so workers starting together do not resume the same documents.
+            # Inbox watcher documents without errors are resumed by the watcher itself.
+            cursor.execute(f"""
+                UPDATE {q('RAW_DOCUMENTS')} r
+                SET OWNER_ID = %s, LEASE_EXPIRES_TS = DATEADD(second, %s, CURRENT_TIMESTAMP())::TIMESTAMP_NTZ
+                FROM (
+                    SELECT r.DOC_ID
+                    FROM {q('RAW_DOCUMENTS')} r
+                    LEFT JOIN (
+                        SELECT DOC_ID
+                        FROM {q('ERROR_LOG')}
+                        QUALIFY ROW_NUMBER() OVER (PARTITION BY DOC_ID ORDER BY CREATED_TS DESC) = 1
+                    ) e ON e.DOC_ID = r.DOC_ID
+                    WHERE r.LAST_UPDATED_TS < DATEADD(second, -%s, CURRENT_TIMESTAMP())
+                      AND {_LEASE_EXPIRED}
+                      AND (
+                          (r.PROCESSING_STATUS IN ('uploaded', 'ocr_processing', 'ocr_complete', 'mapped', 'audited')
+                           AND e.DOC_ID IS NULL AND COALESCE(r.SOURCE_SYSTEM, '') <> %s)
+                          OR r.PROCESSING_STATUS = 'retry_queued'
+                      )
+                    ORDER BY r.UPLOAD_TS
+                    LIMIT {int(limit)}
+                ) c
+                WHERE r.DOC_ID = c.DOC_ID AND {_LEASE_EXPIRED}
+            """, (WORKER_ID, int(settings.RETRY_LEASE_TTL_S), int(settings.RETRY_RESUME_AFTER_S), settings.WATCH_SOURCE_SYSTEM))
+            cursor.execute(f"""
+                SELECT r.DOC_ID, r.COMPANY_ID, r.PROCESSING_STATUS, COALESCE(e.RETRY_COUNT, 0)
+                FROM {q('RAW_DOCUMENTS')} r
+                LEFT JOIN (
+                    SELECT DOC_ID, RETRY_COUNT
+                    FROM {q('ERROR_LOG')}
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY DOC_ID ORDER BY CREATED_TS DESC) = 1
+                ) e ON e.DOC_ID = r.DOC_ID
+                WHERE r.OWNER_ID = %s
+                  AND r.LAST_UPDATED_TS < DATEADD(second, -%s, CURRENT_TIMESTAMP())
+                  AND r.PROCESSING_STATUS IN ('uploaded', 'ocr_processing', 'ocr_complete', 'mapped', 'audited', 'retry_queued')
+                ORDER BY r.UPLOAD_TS
+            """, (WORKER_ID, int(settings.RETRY_RESUME_AFTER_S)))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    async def resume_stranded(self, limit: int = 10000) -> int:
+        """
+        Resubmits documents a crashed process left behind: queued or mid-pipeline
+        with no error history, or claimed by a retry that never started. Only
+        documents whose status has not changed for RETRY_RESUME_AFTER_S and
+        whose lease has expired count, so documents another live worker still
+        has queued or running are left alone.
+        """
+        rows = await asyncio.get_running_loop().run_in_executor(None, self._stranded, limit)
+        held = pipeline_scheduler.held()
+        resumed = 0
+        for doc_id, company_id, status, retry_count in rows:
+            if doc_id in self._inflight or doc_id in held:
+                continue
+            self._inflight.add(doc_id)
+            write_buffer.set_status(doc_id, "retry_queued")
+            pipeline_scheduler.submit(company_id, doc_id, functools.partial(self._attempt, retry_count=retry_count))
+            resumed += 1
+        if resumed:
+            self._metrics["resumed"] += resumed
+            logger.info(f"Resumed {resumed} stranded documents")
+        return resumed
+
+    async def _attempt(self, doc_id: str, retry_count: int):
+        try:
+            await self._job(doc_id, retry_count=retry_count)
+        finally:
+            self._inflight.discard(doc_id)
+
+    async def close(self):
+        self._closing = True
+        if self._wakeup:
+            self._wakeup.set()
+        for task in (self._task, self._heartbeat_task):
+            if task:
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._heartbeat_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._metrics, "inflight": len(self._inflight)}
+
+
+retry_queue = RetryQueue(
+    poll_interval=settings.RETRY_POLL_INTERVAL_S,
+    batch_size=settings.RETRY_BATCH_SIZE,
+)
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from app.core.config import settings
+from app.core.tenancy import current_tenant, tenant_concurrency, tenant_weight
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_LATENCY_WINDOW = 500
+
+
+def _percentile(samples: Deque[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct * len(ordered)))]
+
+
+class WeightedFairQueue:
+    """
+    Start-time fair queuing over per-tenant FIFO queues.
+
+    Each item is tagged with a virtual finish time
+    `max(vtime, tenant's last finish) + cost / weight` and `pop()` serves the
+    eligible tenant whose head item has the smallest tag. A tenant's backlog
+    only pushes out its own tags, so a tenant that shows up behind a bulk
+    upload is served next instead of after it, and under contention tenants
+    get service in proportion to their weights.
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, Deque[Tuple[float, float, Any]]] = {}
+        self._last_finish: Dict[str, float] = {}
+        self._vtime = 0.0
+
+    def push(self, tenant: str, item: Any, cost: float = 1.0):
+        start = max(self._vtime, self._last_finish.get(tenant, 0.0))
+        finish = start + cost / tenant_weight(tenant)
+        self._last_finish[tenant] = finish
+        self._queues.setdefault(tenant, deque()).append((start, finish, item))
+
+    def pop(self, eligible: Optional[Callable[[str], bool]] = None) -> Optional[Tuple[str, Any]]:
+        best: Optional[str] = None
+        best_finish = 0.0
+        for tenant, queue in self._queues.items():
+            if eligible is not None and not eligible(tenant):
+                continue
+            if best is None or queue[0][1] < best_finish:
+                best, best_finish = tenant, queue[0][1]
+        if best is None:
+            return None
+        queue = self._queues[best]
+        start, _, item = queue.popleft()
+        if not queue:
+            del self._queues[best]
+        self._vtime = max(self._vtime, start)
+        return best, item
+
+    def depth(self, tenant: str) -> int:
+        return len(self._queues.get(tenant, ()))
+
+    def tenants(self):
+        return list(self._queues)
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+
+class PipelineScheduler:
+    """
+    Runs invoice pipelines with weighted fair queuing across tenants.
+
+    At most `max_concurrency` pipelines run at once, and each tenant is
+    further capped at its own concurrency (TENANT_CONCURRENCY, default
+    TENANT_MAX_CONCURRENCY). Free slots go to the tenant with the smallest
+    virtual finish tag, so a month-end bulk upload is interleaved with other
+    tenants' invoices instead of running ahead of them.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._queue = WeightedFairQueue()
+        self._running: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._completed: Dict[str, int] = {}
+        self._failed: Dict[str, int] = {}
+        self._wait_s: Dict[str, Deque[float]] = {}
+        self._total_s: Dict[str, Deque[float]] = {}
+        # doc_id -> number of its jobs queued or running
+        self._held: Dict[str, int] = {}
+        self._closing = False
+
+    def submit(self, company_id: str, doc_id: str, job: Callable[[str], Awaitable[Any]]) -> int:
+        """Queues `job(doc_id)` for the tenant; returns the tenant's queue depth."""
+        self._queue.push(company_id, (doc_id, job, time.monotonic()))
+        self._held[doc_id] = self._held.get(doc_id, 0) + 1
+        self._dispatch()
+        return self._queue.depth(company_id)
+
+    def _eligible(self, tenant: str) -> bool:
+        return self._running.get(tenant, 0) < tenant_concurrency(tenant)
+
+    def _dispatch(self):
+        if self._closing:
+            return
+        loop = asyncio.get_running_loop()
+        while sum(self._running.values()) < self.max_concurrency:
+            popped = self._queue.pop(self._eligible)
+            if popped is None:
+                return
+            tenant, (doc_id, job, submitted) = popped
+            self._running[tenant] = self._running.get(tenant, 0) + 1
+            task = loop.create_task(self._run(tenant, doc_id, job, submitted), name=f"pipeline:{doc_id}")
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, tenant: str, doc_id: str, job: Callable[[str], Awaitable[Any]], submitted: float):
+        started = time.monotonic()
+        self._wait_s.setdefault(tenant, deque(maxlen=_LATENCY_WINDOW)).append(started - submitted)
+        # Copied into every task spawned below, so quota limiters see the tenant
+        token = current_tenant.set(tenant)
+        try:
+            await job(doc_id)
+            self._completed[tenant] = self._completed.get(tenant, 0) + 1
+        except Exception as e:
+            self._failed[tenant] = self._failed.get(tenant, 0) + 1
+            logger.error(f"Scheduled pipeline for {doc_id} ({tenant}) failed: {e}")
+        finally:
+            current_tenant.reset(token)
+            self._total_s.setdefault(tenant, deque(maxlen=_LATENCY_WINDOW)).append(time.monotonic() - submitted)
+            self._running[tenant] -= 1
+            if not self._running[tenant]:
+                del self._running[tenant]
+            self._release(doc_id)
+            self._dispatch()
+
+    def _release(self, doc_id: str):
+        self._held[doc_id] -= 1
+        if not self._held[doc_id]:
+            del self._held[doc_id]
+
+    def held(self) -> Set[str]:
+        """Documents with a pipeline queued or running in this process."""
+        return set(self._held)
+
+    async def close(self, drain_timeout: float = 0.0) -> List[Tuple[str, Callable[[str], Awaitable[Any]]]]:
+        """
+        Stops dispatching, gives running pipelines up to `drain_timeout`
+        seconds to finish and cancels the rest. Returns the (doc_id, job)
+        pairs that were still queued, which never started.
+        """
+        self._closing = True
+        queued = []
+        while True:
+            popped = self._queue.pop()
+            if popped is None:
+                break
+            doc_id, job, _ = popped[1]
+            self._release(doc_id)
+            queued.append((doc_id, job))
+        if queued:
+            logger.warning(f"Scheduler shutting down with {len(queued)} queued documents")
+        if self._tasks and drain_timeout > 0:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout)
+            if pending:
+                logger.warning(f"{len(pending)} pipelines still running after {drain_timeout:.0f}s; cancelling")
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        return queued
+
+    def stats(self, company_id: Optional[str] = None) -> Dict[str, Any]:
+        tenants = set(self._queue.tenants()) | set(self._running) | set(self._total_s)
+        if company_id is not None:
+            tenants &= {company_id}
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": sum(self._running.values()),
+            "queued": len(self._queue),
+            "tenants": {
+                t: {
+                    "weight": tenant_weight(t),
+                    "max_concurrency": tenant_concurrency(t),
+                    "queued": self._queue.depth(t),
+                    "running": self._running.get(t, 0),
+                    "completed": self._completed.get(t, 0),
+                    "failed": self._failed.get(t, 0),
+                    "queue_wait_p50_ms": _percentile(self._wait_s.get(t, deque()), 0.50) * 1000,
+                    "queue_wait_p95_ms": _percentile(self._wait_s.get(t, deque()), 0.95) * 1000,
+                    "latency_p50_ms": _percentile(self._total_s.get(t, deque()), 0.50) * 1000,
+                    "latency_p95_ms": _percentile(self._total_s.get(t, deque()), 0.95) * 1000,
+                }
+                for t in sorted(tenants)
+            },
+        }
+
+
+class RequestQuota:
+    """
+    Token bucket for a shared upstream request quota (Gemini, Nominatim).
+
+    Calls proceed immediately while tokens are available and nobody is
+    waiting; otherwise they queue per tenant (taken from `current_tenant`)
+    and tokens are handed out by weighted fair queuing, so each tenant's
+    share of the quota under contention follows its weight.
+    """
+
+    def __init__(self, requests_per_minute: int, burst: int):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(max(burst, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters = WeightedFairQueue()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._granted: Dict[str, int] = {}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _grant(self, tenant: str):
+        self._tokens -= 1
+        self._granted[tenant] = self._granted.get(tenant, 0) + 1
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        tenant = current_tenant.get()
+        self._refill()
+        if not len(self._waiters) and self._tokens >= 1:
+            self._grant(tenant)
+            return
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.push(tenant, waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        await waiter
+
+    async def _dispatch(self):
+        while len(self._waiters):
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            tenant, waiter = self._waiters.pop()
+            # Cancelled waiters (e.g. a stage timeout) don't consume a token
+            if waiter.done():
+                continue
+            self._grant(tenant)
+            waiter.set_result(None)
+
+    def stats(self, company_id: Optional[str] = None) -> Dict[str, Any]:
+        granted = self._granted if company_id is None else {company_id: self._granted.get(company_id, 0)}
+        return {
+            "requests_per_minute": self.rate * 60,
+            "waiting": len(self._waiters),
+            "granted": dict(granted),
+        }
+
+
+pipeline_scheduler = PipelineScheduler(max_concurrency=settings.PIPELINE_MAX_CONCURRENCY)
+gemini_quota = RequestQuota(
+    requests_per_minute=settings.GEMINI_REQUESTS_PER_MINUTE,
+    burst=settings.GEMINI_BURST,
+)
+# Nominatim's usage policy allows one request per second, without bursts
+nominatim_quota = RequestQuota(
+    requests_per_minute=settings.NOMINATIM_REQUESTS_PER_MINUTE,
+    burst=1,
+)
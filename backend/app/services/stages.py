@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+from app.core.breakers import call_deadline
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StageTimeoutError(Exception):
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"Stage '{stage}' timed out after {timeout:.1f}s")
+        self.stage = stage
+        self.timeout = timeout
+
+
+class StageTimer:
+    """
+    Records start/end offsets of every pipeline stage relative to the start of
+    the invoice, so overlapping (concurrent) stages can be told apart from the
+    serial ones when reading the timing summary. Sub-stages use dotted names
+    ("carbon.geocode_origin"); only leaf stages count towards the serial total.
+    """
+
+    def __init__(self, doc_id: str):
+        self.doc_id = doc_id
+        self.started = time.perf_counter()
+        self.spans: Dict[str, Tuple[float, float]] = {}
+        self.active: Dict[str, float] = {}
+
+    async def run(self, name: str, awaitable: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+        start = time.perf_counter()
+        self.active[name] = start
+        token = None
+        try:
+            if timeout:
+                # Seen by breaker calls inside the stage (copied into the task wait_for creates).
+                # Not narrowed to an enclosing stage's deadline: early stages are spawned
+                # from inside OCR but outlive it under their own timeout.
+                token = call_deadline.set(asyncio.get_running_loop().time() + timeout)
+                return await asyncio.wait_for(awaitable, timeout=timeout)
+            return await awaitable
+        except asyncio.TimeoutError:
+            raise StageTimeoutError(name, timeout)
+        finally:
+            if token is not None:
+                call_deadline.reset(token)
+            self.active.pop(name, None)
+            self.spans[name] = (start - self.started, time.perf_counter() - self.started)
+
+    def running(self) -> Dict[str, float]:
+        """Stages still in progress -> seconds they have been running."""
+        now = time.perf_counter()
+        return {name: round(now - start, 3) for name, start in list(self.active.items())}
+
+    def durations(self) -> Dict[str, float]:
+        return {name: round((end - start) * 1000, 1) for name, (start, end) in self.spans.items()}
+
+    def summary(self) -> Dict[str, Any]:
+        wall = time.perf_counter() - self.started
+        leaves = [
+            name for name in self.spans
+            if not any(other.startswith(name + ".") for other in self.spans)
+        ]
+        serial = sum(self.spans[n][1] - self.spans[n][0] for n in leaves)
+        return {
+            "stages_ms": self.durations(),
+            "serial_ms": round(serial * 1000, 1),
+            "wall_ms": round(wall * 1000, 1),
+        }
+
+    def log_summary(self):
+        s = self.summary()
+        stages = ", ".join(f"{k}={v}ms" for k, v in s["stages_ms"].items())
+        logger.info(f"Stage timings for {self.doc_id}: {stages} | serial={s['serial_ms']}ms wall={s['wall_ms']}ms")
+
+
+class InflightRegistry:
+    """In-flight invoices and their stage timers, for the diagnostics task dump."""
+
+    def __init__(self):
+        self._timers: Dict[str, Tuple[str, StageTimer]] = {}
+
+    def register(self, doc_id: str, company_id: str, timer: StageTimer):
+        self._timers[doc_id] = (company_id, timer)
+
+    def unregister(self, doc_id: str):
+        self._timers.pop(doc_id, None)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.perf_counter()
+        out = [
+            {
+                "doc_id": doc_id,
+                "company_id": company_id,
+                "elapsed_s": round(now - timer.started, 3),
+                "running_stages": timer.running(),
+                "completed_stages_ms": timer.durations(),
+            }
+            for doc_id, (company_id, timer) in list(self._timers.items())
+        ]
+        return sorted(out, key=lambda p: -p["elapsed_s"])
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+
+inflight = InflightRegistry()
+
+
+async def gather_stages(timer: StageTimer, *stages: Tuple[str, Awaitable[Any], Optional[float]]) -> List[Any]:
+    """Runs independent stages concurrently; the first failure cancels the rest."""
+    tasks = [asyncio.ensure_future(timer.run(name, aw, timeout)) for name, aw, timeout in stages]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        raise
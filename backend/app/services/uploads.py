@@ -0,0 +1,317 @@
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import uuid
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import aiofiles
+
+from app.core.config import settings
+from app.core.db import get_snowflake_connection, q
+from app.services.write_buffer import _statement_batches
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """Client-side problem with a chunked upload; `status_code` maps to the HTTP response."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def register_document(
+    doc_id: str,
+    file_name: str,
+    file_type: str,
+    content: Union[bytes, bytearray],
+    file_hash: Optional[str] = None,
+    source_system: str = "WEB_UPLOAD",
+    *,
+    company_id: str,
+):
+    """Inserts the RAW_DOCUMENTS row that the orchestrator picks up."""
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        # Explicitly USE context just in case session lost it
+        cursor.execute(f"USE DATABASE {settings.SNOWFLAKE_DATABASE}")
+        cursor.execute(f"USE SCHEMA {settings.SNOWFLAKE_SCHEMA}")
+        cursor.execute(f"USE WAREHOUSE {settings.SNOWFLAKE_WAREHOUSE}")
+
+        cursor.execute(
+            f"INSERT INTO {q('RAW_DOCUMENTS')} (DOC_ID, COMPANY_ID, SOURCE_SYSTEM, FILE_NAME, FILE_TYPE, RAW_BINARY, FILE_SIZE_BYTES, FILE_HASH, PROCESSING_STATUS) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (doc_id, company_id, source_system, file_name, file_type, content, len(content), file_hash, "uploaded")
+        )
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def register_documents(
+    documents: Sequence[Tuple[str, str, str, Union[bytes, bytearray], str]],
+    source_system: str,
+    company_id: str,
+    max_rows: int = 50,
+):
+    """
+    Bulk variant of `register_document` for feeds: one multi-row INSERT per
+    batch of (doc_id, file_name, file_type, content, file_hash), split so no
+    statement outgrows Snowflake's statement size limit.
+    """
+    rows = [
+        (doc_id, company_id, source_system, file_name, file_type, content, len(content), file_hash, "uploaded")
+        for doc_id, file_name, file_type, content, file_hash in documents
+    ]
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        for batch in _statement_batches(rows, max_rows):
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+            cursor.execute(
+                f"INSERT INTO {q('RAW_DOCUMENTS')} (DOC_ID, COMPANY_ID, SOURCE_SYSTEM, FILE_NAME, FILE_TYPE, RAW_BINARY, FILE_SIZE_BYTES, FILE_HASH, PROCESSING_STATUS) VALUES {values}",
+                [v for row in batch for v in row]
+            )
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def document_registered(doc_id: str) -> bool:
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT 1 FROM {q('RAW_DOCUMENTS')} WHERE DOC_ID = %s LIMIT 1", (doc_id,))
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+class ChunkedUploadStore:
+    """
+    Disk-backed sessions for resumable uploads.
+
+    Each session is a directory holding `meta.json` plus one file per received
+    chunk. Chunks are streamed to disk as they arrive and hashed incrementally,
+    so a worker never holds more than the part of one chunk it is writing.
+    Parallel PUTs only ever write their own chunk file, so they never contend
+    on a shared metadata file.
+
+    Completion runs under an exclusive lock on the session (`complete.lock`,
+    shared by all workers on the host) and records the assigned DOC_ID in
+    `meta.json` before the document is registered. A repeated or concurrent
+    complete therefore returns the same DOC_ID instead of registering the file
+    twice. The completed session is kept, without its chunks, until it expires.
+    """
+
+    def __init__(self, root: str, chunk_size: int, max_bytes: int, ttl_seconds: int):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+    def _dir(self, upload_id: str) -> str:
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            raise UploadError("Invalid upload id", 404)
+        return os.path.join(self.root, upload_id)
+
+    def _chunk_path(self, upload_id: str, index: int) -> str:
+        return os.path.join(self._dir(upload_id), f"{index:06d}.part")
+
+    def _load_meta(self, upload_id: str, company_id: Optional[str] = None) -> Dict:
+        path = os.path.join(self._dir(upload_id), "meta.json")
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError("Upload session not found or expired", 404)
+        # Another tenant's session is indistinguishable from a missing one
+        if company_id is not None and meta.get("company_id") != company_id:
+            raise UploadError("Upload session not found or expired", 404)
+        return meta
+
+    def _save_meta(self, upload_id: str, meta: Dict):
+        path = os.path.join(self._dir(upload_id), "meta.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def create(self, company_id: str, file_name: str, file_type: str, file_size: int) -> Dict:
+        if file_size <= 0:
+            raise UploadError("File is empty")
+        if file_size > self.max_bytes:
+            raise UploadError(f"File exceeds the {self.max_bytes} byte upload limit", 413)
+
+        self.purge_expired()
+        upload_id = str(uuid.uuid4())
+        meta = {
+            "upload_id": upload_id,
+            "company_id": company_id,
+            "file_name": file_name,
+            "file_type": file_type or "application/octet-stream",
+            "file_size": file_size,
+            "chunk_size": self.chunk_size,
+            "total_chunks": math.ceil(file_size / self.chunk_size),
+            "created_ts": time.time(),
+        }
+        path = self._dir(upload_id)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return meta
+
+    def received_chunks(self, upload_id: str) -> List[int]:
+        path = self._dir(upload_id)
+        return sorted(int(name[:-5]) for name in os.listdir(path) if name.endswith(".part"))
+
+    def status(self, upload_id: str, company_id: Optional[str] = None) -> Dict:
+        meta = self._load_meta(upload_id, company_id)
+        return {**meta, "received_chunks": self.received_chunks(upload_id)}
+
+    def _expected_size(self, meta: Dict, index: int) -> int:
+        if index == meta["total_chunks"] - 1:
+            return meta["file_size"] - index * meta["chunk_size"]
+        return meta["chunk_size"]
+
+    async def write_chunk(
+        self,
+        upload_id: str,
+        index: int,
+        body: AsyncIterator[bytes],
+        expected_sha256: Optional[str] = None,
+        company_id: Optional[str] = None,
+    ) -> Tuple[str, int]:
+        meta = self._load_meta(upload_id, company_id)
+        if meta.get("doc_id"):
+            raise UploadError(f"Upload already completed as document {meta['doc_id']}", 409)
+        if not 0 <= index < meta["total_chunks"]:
+            raise UploadError(f"Chunk index {index} out of range (0..{meta['total_chunks'] - 1})")
+        expected_size = self._expected_size(meta, index)
+
+        final_path = self._chunk_path(upload_id, index)
+        tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for piece in body:
+                    written += len(piece)
+                    if written > expected_size:
+                        raise UploadError(f"Chunk {index} is larger than the expected {expected_size} bytes")
+                    digest.update(piece)
+                    await f.write(piece)
+            if written != expected_size:
+                raise UploadError(f"Chunk {index} has {written} bytes, expected {expected_size}")
+
+            sha = digest.hexdigest()
+            if expected_sha256 and expected_sha256.lower() != sha:
+                raise UploadError(f"Chunk {index} checksum mismatch", 422)
+
+            # Atomic publish: a chunk only counts as received once fully written
+            os.replace(tmp_path, final_path)
+            return sha, written
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def complete(
+        self,
+        upload_id: str,
+        register: Callable[[str, Dict, bytearray, str], None],
+        expected_sha256: Optional[str] = None,
+        company_id: Optional[str] = None,
+    ) -> Tuple[str, bool]:
+        """
+        Assembles the upload and hands it to `register(doc_id, meta, content, sha)`
+        exactly once. Returns (doc_id, registered_now); a repeat complete gets the
+        original DOC_ID with registered_now False.
+        """
+        self._load_meta(upload_id, company_id)
+        with open(os.path.join(self._dir(upload_id), "complete.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            meta = self._load_meta(upload_id, company_id)
+            if meta.get("registered"):
+                return meta["doc_id"], False
+            if meta.get("doc_id") and document_registered(meta["doc_id"]):
+                # A previous complete registered it but died before recording that
+                meta["registered"] = True
+                self._save_meta(upload_id, meta)
+                return meta["doc_id"], False
+
+            meta, content, sha = self.assemble(upload_id, expected_sha256, company_id)
+            if not meta.get("doc_id"):
+                meta["doc_id"] = str(uuid.uuid4())
+                self._save_meta(upload_id, meta)
+            register(meta["doc_id"], meta, content, sha)
+            del content
+
+            meta["registered"] = True
+            self._save_meta(upload_id, meta)
+            for index in self.received_chunks(upload_id):
+                os.remove(self._chunk_path(upload_id, index))
+            return meta["doc_id"], True
+
+    def assemble(self, upload_id: str, expected_sha256: Optional[str] = None, company_id: Optional[str] = None) -> Tuple[Dict, bytearray, str]:
+        """
+        Concatenates the chunks into the final document and verifies the file hash.
+        The Snowflake connector binds BINARY values whole, so this is the one
+        point where the complete file is held in memory.
+        """
+        meta = self._load_meta(upload_id, company_id)
+        missing = sorted(set(range(meta["total_chunks"])) - set(self.received_chunks(upload_id)))
+        if missing:
+            raise UploadError(f"Upload incomplete, missing chunks: {missing[:20]}", 409)
+
+        content = bytearray(meta["file_size"])
+        view = memoryview(content)
+        digest = hashlib.sha256()
+        offset = 0
+        for index in range(meta["total_chunks"]):
+            with open(self._chunk_path(upload_id, index), "rb") as f:
+                while True:
+                    n = f.readinto(view[offset:offset + (1 << 20)])
+                    if not n:
+                        break
+                    digest.update(view[offset:offset + n])
+                    offset += n
+
+        view.release()
+
+        sha = digest.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != sha:
+            raise UploadError("File checksum mismatch", 422)
+        return meta, content, sha
+
+    def discard(self, upload_id: str):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def purge_expired(self):
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue
+
+
+upload_store = ChunkedUploadStore(
+    root=settings.UPLOAD_SPOOL_DIR,
+    chunk_size=settings.UPLOAD_CHUNK_SIZE,
+    max_bytes=settings.UPLOAD_MAX_BYTES,
+    ttl_seconds=settings.UPLOAD_SESSION_TTL_SECONDS,
+)
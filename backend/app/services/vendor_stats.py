@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from app.core.config import settings
+from app.core.db import get_snowflake_connection, q
+from app.models.schemas import CarbonResult, ExtractionResult, MappingResult
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_HISTORY_FETCH_ROWS = 10000
+# Placeholders OCR emits for a missing invoice number; never treated as duplicates
+_MISSING_INVOICE_NUMBERS = {"", "n/a", "na", "none", "null", "unknown", "0"}
+
+
+class RunningStats:
+    """Welford's online mean/variance."""
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x: float):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def zscore(self, x: float) -> Optional[float]:
+        std = self.std
+        return (x - self.mean) / std if std > 0 else None
+
+
+class P2Quantile:
+    """
+    P-square streaming quantile estimate (Jain & Chlamtac): five markers,
+    O(1) memory and update, no stored samples.
+    """
+
+    __slots__ = ("p", "heights", "pos", "desired", "incr")
+
+    def __init__(self, p: float):
+        self.p = p
+        self.heights: List[float] = []
+        self.pos = [1, 2, 3, 4, 5]
+        self.desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+        self.incr = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x: float):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            self.pos[i] += 1
+        for i in range(5):
+            self.desired[i] += self.incr[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - self.pos[i]
+            if (d >= 1 and self.pos[i + 1] - self.pos[i] > 1) or (d <= -1 and self.pos[i - 1] - self.pos[i] < -1):
+                step = 1 if d > 0 else -1
+                candidate = self._parabolic(i, step)
+                if not h[i - 1] < candidate < h[i + 1]:
+                    candidate = h[i] + step * (h[i + step] - h[i]) / (self.pos[i + step] - self.pos[i])
+                h[i] = candidate
+                self.pos[i] += step
+
+    def _parabolic(self, i: int, d: int) -> float:
+        h, n = self.heights, self.pos
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> Optional[float]:
+        h = self.heights
+        if not h:
+            return None
+        if len(h) < 5 or self.pos[4] == 5:
+            return h[min(len(h) - 1, round((len(h) - 1) * self.p))]
+        return h[2]
+
+
+class MetricStats:
+    """Running moments plus p05/p50/p95 sketches for one metric of one vendor or NAICS code."""
+
+    __slots__ = ("moments", "p05", "p50", "p95")
+
+    def __init__(self):
+        self.moments = RunningStats()
+        self.p05 = P2Quantile(0.05)
+        self.p50 = P2Quantile(0.50)
+        self.p95 = P2Quantile(0.95)
+
+    def add(self, x: float):
+        self.moments.add(x)
+        self.p05.add(x)
+        self.p50.add(x)
+        self.p95.add(x)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        return {
+            "n": self.moments.n,
+            "mean": self.moments.mean,
+            "std": self.moments.std,
+            "p05": self.p05.value(),
+            "p50": self.p50.value(),
+            "p95": self.p95.value(),
+        }
+
+
+class InvoiceFacts(NamedTuple):
+    vendor: str
+    naics_code: str
+    invoice_number: str
+    spend: Optional[float]  # None when there was no FX rate to convert it to USD
+    kg_per_dollar: Optional[float]
+
+
+def _vendor_key(canonical: Optional[str], vendor_name: Optional[str]) -> str:
+    """The canonical vendor, else the vendor name as extracted; `_VENDOR_KEY_SQL` is the same rule for the rebuild."""
+    canonical = (canonical or "").strip()
+    if _normalize(canonical) not in ("", "unknown"):
+        return canonical
+    return (vendor_name or "").strip() or "Unknown"
+
+
+# Characters str.strip() also removes; Snowflake reads the backslash escapes in the literal
+_TRIM = "' \\t\\r\\n'"
+_VENDOR_KEY_SQL = f"""
+    CASE
+        WHEN LOWER(TRIM(f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING, {_TRIM})) NOT IN ('', 'unknown')
+            THEN TRIM(f.STANDARDIZED_JSON:mapping.vendor_canonical::STRING, {_TRIM})
+        WHEN TRIM(f.STANDARDIZED_JSON:extraction.vendor_name::STRING, {_TRIM}) <> ''
+            THEN TRIM(f.STANDARDIZED_JSON:extraction.vendor_name::STRING, {_TRIM})
+        ELSE 'Unknown'
+    END"""
+
+
+def invoice_facts(extraction: ExtractionResult, carbon: CarbonResult, mapping: Optional[MappingResult] = None) -> InvoiceFacts:
+    # Keyed like the history rebuild in `_load_history`, so live and reloaded stats agree
+    vendor = _vendor_key(mapping.vendor_canonical if mapping else None, extraction.vendor_name)
+    # USD, so invoices in different currencies share one history; results from
+    # before FX conversion only have the invoice-currency total
+    if carbon.fx and carbon.fx.status == "missing":
+        spend = None
+    else:
+        spend = float((carbon.spend_usd if carbon.spend_usd is not None else extraction.grand_total) or 0.0)
+    return InvoiceFacts(
+        vendor=vendor,
+        naics_code=carbon.naics_code or "UNMAPPED",
+        invoice_number=_invoice_number(extraction.invoice_number),
+        spend=spend,
+        kg_per_dollar=carbon.total_kg_co2e / spend if spend is not None and spend > 0 else None,
+    )
+
+
+def _normalize(value: str) -> str:
+    return " ".join(value.lower().split())
+
+
+def _invoice_number(value: Optional[str]) -> str:
+    value = (value or "").strip()
+    return "" if _normalize(value) in _MISSING_INVOICE_NUMBERS else value
+
+
+def _invoice_key(company_id: str, vendor: str, invoice_number: str) -> int:
+    digest = hashlib.blake2b(
+        f"{company_id}\x1f{_normalize(vendor)}\x1f{_normalize(invoice_number)}".encode(),
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+class VendorStatsStore:
+    """
+    In-memory history per (company, vendor) and (company, NAICS code): running
+    mean/variance and quantile sketches of spend and kg CO2e per dollar, plus a
+    hashed (company, vendor, invoice_number) -> DOC_ID index for duplicates.
+
+    Checks and updates are O(1) per invoice. The store is updated as documents
+    finalize and rebuilt from FINAL_AUDIT_RESULTS in one streaming pass at
+    startup; until that pass completes, history-based checks are skipped.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, str, str, str], MetricStats] = {}
+        self._invoices: Dict[int, str] = {}
+        self.ready = False
+        self._rebuilding = False
+        self._pending: List[Tuple[str, str, InvoiceFacts]] = []
+        self._pending_ids: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def _metric(self, company_id: str, scope: str, key: str, metric: str, create: bool = False) -> Optional[MetricStats]:
+        k = (company_id, scope, _normalize(key), metric)
+        stats = self._metrics.get(k)
+        if stats is None and create:
+            stats = self._metrics[k] = MetricStats()
+        return stats
+
+    def observe(self, company_id: str, doc_id: str, facts: InvoiceFacts):
+        if self._rebuilding:
+            self._pending.append((company_id, doc_id, facts))
+            self._pending_ids.add(doc_id)
+        self._observe(company_id, doc_id, facts)
+
+    def _observe(self, company_id: str, doc_id: str, facts: InvoiceFacts):
+        if facts.invoice_number:
+            key = _invoice_key(company_id, facts.vendor, facts.invoice_number)
+            first = self._invoices.setdefault(key, doc_id)
+            if first != doc_id:
+                return  # a duplicate must not count twice towards the vendor's history
+        for scope, name in (("vendor", facts.vendor), ("naics", facts.naics_code)):
+            if facts.spend is not None:
+                self._metric(company_id, scope, name, "spend", create=True).add(facts.spend)
+            if facts.kg_per_dollar is not None:
+                self._metric(company_id, scope, name, "kg_per_dollar", create=True).add(facts.kg_per_dollar)
+
+    def check(self, company_id: str, facts: InvoiceFacts, doc_id: Optional[str] = None) -> Tuple[List[str], bool]:
+        """Returns (flags, is_duplicate) for an invoice about to be finalized."""
+        flags: List[str] = []
+        duplicate = False
+        if facts.invoice_number:
+            first = self._invoices.get(_invoice_key(company_id, facts.vendor, facts.invoice_number))
+            if first and first != doc_id:
+                duplicate = True
+                flags.append(f"Duplicate Invoice: {facts.invoice_number} from {facts.vendor} already processed as {first}")
+
+        if not self.ready:
+            return flags, duplicate
+
+        for scope, name in (("vendor", facts.vendor), ("naics", facts.naics_code)):
+            spend = self._metric(company_id, scope, name, "spend")
+            if facts.spend is not None and spend and spend.moments.n >= settings.AUDIT_MIN_HISTORY:
+                z = spend.moments.zscore(facts.spend)
+                if z is not None and abs(z) >= settings.AUDIT_ZSCORE_THRESHOLD:
+                    flags.append(
+                        f"Spend Outlier ({scope} {name}): {facts.spend:.2f} is {z:+.1f} std from "
+                        f"mean {spend.moments.mean:.2f} over {spend.moments.n} invoices"
+                    )
+
+            intensity = self._metric(company_id, scope, name, "kg_per_dollar")
+            if facts.kg_per_dollar is not None and intensity and intensity.moments.n >= settings.AUDIT_MIN_HISTORY:
+                p05, p95 = intensity.p05.value(), intensity.p95.value()
+                # Outside the historical p05-p95 band widened by its own width
+                band = p95 - p05
+                if band > 0 and not p05 - band <= facts.kg_per_dollar <= p95 + band:
+                    flags.append(
+                        f"Carbon Intensity Outlier ({scope} {name}): {facts.kg_per_dollar:.4f} kgCO2e/$ "
+                        f"outside historical p05-p95 {p05:.4f}-{p95:.4f}"
+                    )
+        return flags, duplicate
+
+    def summary(self, company_id: str, scope: str, key: str) -> Dict[str, Dict[str, Optional[float]]]:
+        out = {}
+        for metric in ("spend", "kg_per_dollar"):
+            stats = self._metric(company_id, scope, key, metric)
+            if stats:
+                out[metric] = stats.summary()
+        return out
+
+    # --- bulk rebuild ----------------------------------------------------
+
+    def _load_history(self) -> "VendorStatsStore":
+        fresh = VendorStatsStore()
+        conn = get_snowflake_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"""
+                SELECT
+                    COALESCE(f.COMPANY_ID, '{settings.DEFAULT_COMPANY_ID}'),
+                    f.DOC_ID,
+                    {_VENDOR_KEY_SQL},
+                    COALESCE(f.STANDARDIZED_JSON:carbon.naics_code::STRING, 'UNMAPPED'),
+                    f.STANDARDIZED_JSON:extraction.invoice_number::STRING,
+                    IFF(f.STANDARDIZED_JSON:carbon.fx.status::STRING = 'missing', NULL,
+                        COALESCE(f.STANDARDIZED_JSON:carbon.spend_usd::FLOAT,
+                                 f.STANDARDIZED_JSON:extraction.grand_total::FLOAT, 0)),
+                    COALESCE(f.CARBON_KG_CO2E, 0)
+                FROM {q('FINAL_AUDIT_RESULTS')} f
+                WHERE COALESCE(f.STANDARDIZED_JSON:extraction.is_standard_invoice::BOOLEAN, TRUE)
+                ORDER BY f.FINALIZED_TS
+            """)
+            rows = 0
+            while True:
+                batch = cursor.fetchmany(_HISTORY_FETCH_ROWS)
+                if not batch:
+                    break
+                for company_id, doc_id, vendor, naics, invoice_number, spend, kg in batch:
+                    fresh._observe(company_id, doc_id, InvoiceFacts(
+                        vendor=vendor,
+                        naics_code=naics,
+                        invoice_number=_invoice_number(invoice_number),
+                        spend=spend,
+                        kg_per_dollar=kg / spend if spend is not None and spend > 0 else None,
+                    ))
+                    if doc_id in self._pending_ids:
+                        fresh._pending_ids.add(doc_id)
+                rows += len(batch)
+            logger.info(f"Vendor statistics rebuilt from {rows} finalized invoices ({len(fresh._metrics)} series)")
+            return fresh
+        finally:
+            cursor.close()
+            conn.close()
+
+    async def rebuild(self):
+        self._rebuilding = True
+        self._pending, self._pending_ids = [], set()
+        start = time.perf_counter()
+        try:
+            fresh = await asyncio.get_running_loop().run_in_executor(None, self._load_history)
+        except Exception as e:
+            logger.error(f"Vendor statistics rebuild failed; anomaly checks use live data only: {e}")
+            self._rebuilding = False
+            return
+        # Documents finalized while the history query ran and not part of its snapshot
+        for company_id, doc_id, facts in self._pending:
+            if doc_id not in fresh._pending_ids:
+                fresh._observe(company_id, doc_id, facts)
+        self._metrics, self._invoices = fresh._metrics, fresh._invoices
+        self._pending, self._pending_ids = [], set()
+        self._rebuilding = False
+        self.ready = True
+        logger.info(f"Vendor statistics ready in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def start(self):
+        """Kicks off the startup rebuild without delaying application start."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.rebuild())
+
+
+vendor_stats = VendorStatsStore()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild vendor/NAICS statistics from history and print one series.")
+    parser.add_argument("--company", default=settings.DEFAULT_COMPANY_ID)
+    parser.add_argument("--scope", choices=["vendor", "naics"], default="vendor")
+    parser.add_argument("key", nargs="?")
+    args = parser.parse_args()
+
+    asyncio.run(vendor_stats.rebuild())
+    if args.key:
+        print(vendor_stats.summary(args.company, args.scope, args.key))
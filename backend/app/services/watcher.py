@@ -0,0 +1,509 @@
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import logging
+import mimetypes
+import os
+import signal
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from app.core.config import settings
+from app.core.db import get_snowflake_connection, init_db, q
+from app.core.tenancy import validate_company_id
+from app.services.fx import fx_rates
+from app.services.orchestrator import orchestrator
+from app.services.preprocess import preprocessor
+from app.services.retry_queue import retry_queue
+from app.services.scheduler import pipeline_scheduler
+from app.services.uploads import register_documents
+from app.services.vendor_stats import vendor_stats
+from app.services.write_buffer import write_buffer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROCESSING_DIR = "processing"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+
+_TERMINAL = {"finalized": DONE_DIR, "failed": FAILED_DIR}
+_LOOKUP_ROWS = 1000
+
+_FILE_TYPES = {
+    ".pdf": "application/pdf",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".webp": "image/webp",
+    ".heic": "image/heic",
+}
+
+
+def _file_type(name: str) -> str:
+    ext = os.path.splitext(name)[1].lower()
+    return _FILE_TYPES.get(ext) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def _move(src: str, directory: str, name: str) -> str:
+    """Renames `src` into `directory` without overwriting an existing file."""
+    dest = os.path.join(directory, name)
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while os.path.exists(dest):
+        dest = os.path.join(directory, f"{stem}.{n}{ext}")
+        n += 1
+    os.rename(src, dest)
+    return dest
+
+
+def _claimed_doc_id(name: str) -> Optional[str]:
+    """processing/ files are named `<doc_id>__<original name>`."""
+    doc_id, sep, _ = name.partition("__")
+    return doc_id if sep else None
+
+
+def _lookup(sql: str, params: List[Any]) -> List[tuple]:
+    conn = get_snowflake_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def existing_hashes(company_id: str, hashes: Sequence[str]) -> Dict[str, str]:
+    """FILE_HASH -> DOC_ID of documents the tenant already registered."""
+    found: Dict[str, str] = {}
+    hashes = list(hashes)
+    for i in range(0, len(hashes), _LOOKUP_ROWS):
+        chunk = hashes[i:i + _LOOKUP_ROWS]
+        rows = _lookup(
+            f"SELECT FILE_HASH, MIN(DOC_ID) FROM {q('RAW_DOCUMENTS')} "
+            f"WHERE COMPANY_ID = %s AND FILE_HASH IN ({', '.join(['%s'] * len(chunk))}) GROUP BY FILE_HASH",
+            [company_id, *chunk]
+        )
+        found.update({file_hash: doc_id for file_hash, doc_id in rows})
+    return found
+
+
+def document_statuses(doc_ids: Sequence[str]) -> Dict[str, Tuple[str, bool]]:
+    """DOC_ID -> (PROCESSING_STATUS, has ERROR_LOG rows); documents without a RAW_DOCUMENTS row are absent."""
+    found: Dict[str, Tuple[str, bool]] = {}
+    doc_ids = list(doc_ids)
+    for i in range(0, len(doc_ids), _LOOKUP_ROWS):
+        chunk = doc_ids[i:i + _LOOKUP_ROWS]
+        rows = _lookup(f"""
+            SELECT r.DOC_ID, r.PROCESSING_STATUS, COUNT(e.DOC_ID) > 0
+            FROM {q('RAW_DOCUMENTS')} r
+            LEFT JOIN {q('ERROR_LOG')} e ON e.DOC_ID = r.DOC_ID
+            WHERE r.DOC_ID IN ({', '.join(['%s'] * len(chunk))})
+            GROUP BY r.DOC_ID, r.PROCESSING_STATUS
+        """, chunk)
+        found.update({doc_id: (status, bool(errored)) for doc_id, status, errored in rows})
+    return found
+
+
+class _Inotify:
+    """
+    Minimal inotify binding through libc, so the watcher does not need a
+    third-party package. Events are only used as a hint to rescan early;
+    the directory scan stays the source of truth, so overflowed or missed
+    events cost latency, never documents.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, paths: Sequence[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for path in paths:
+            if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, f"inotify_add_watch({path}): {os.strerror(errno)}")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def drain(self):
+        while True:
+            try:
+                if not os.read(self.fd, 64 * 1024):
+                    return
+            except BlockingIOError:
+                return
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class InboxWatcher:
+    """
+    Ingests invoices dropped into local inbox directories (ERP exports,
+    scanner shares), one directory per tenant.
+
+    A file is picked up once its size and mtime have been stable for
+    WATCH_DEBOUNCE_S, hashed, and skipped if the tenant already has a
+    document with that FILE_HASH. New files are claimed by renaming them
+    into `processing/<doc_id>__<name>`, registered in RAW_DOCUMENTS with
+    one multi-row INSERT per batch, and handed to the fair-share scheduler.
+    When a pipeline ends the file moves to `done/` or `failed/`.
+
+    At most WATCH_MAX_INFLIGHT documents are queued or running; beyond that
+    the watcher stops claiming, so a backlog stays on disk instead of in
+    memory. `processing/` doubles as the restart journal: it is reconciled
+    against RAW_DOCUMENTS on start and every WATCH_RECONCILE_INTERVAL_S, so
+    a crash or a failed INSERT never loses a claimed file.
+    """
+
+    def __init__(self, dirs: Dict[str, str]):
+        self.dirs = dirs
+        self.extensions = {e.lower() for e in settings.WATCH_EXTENSIONS}
+        # path -> (size, mtime_ns, monotonic time the pair was first seen)
+        self._seen: Dict[str, Tuple[int, int, float]] = {}
+        self._ignored: Set[str] = set()
+        self._inflight: Set[str] = set()
+        # Handed to the retry queue by a pipeline run in this process
+        self._parked: Set[str] = set()
+        self._inotify: Optional[_Inotify] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._room: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reconcile_due = False
+        self._closing = False
+        self._metrics = {"scans": 0, "claimed": 0, "duplicates": 0, "done": 0, "failed": 0, "resumed": 0, "errors": 0}
+
+    def _prepare(self):
+        for directory, company_id in list(self.dirs.items()):
+            self.dirs[directory] = validate_company_id(company_id)
+            for sub in (PROCESSING_DIR, DONE_DIR, FAILED_DIR):
+                os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    def start(self):
+        if not self.dirs:
+            raise ValueError("No inbox directories configured (WATCH_DIRS)")
+        self._prepare()
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()
+        if settings.WATCH_USE_INOTIFY:
+            try:
+                self._inotify = _Inotify(list(self.dirs))
+                loop.add_reader(self._inotify.fileno(), self._on_event)
+            except (OSError, AttributeError) as e:
+                self._inotify = None
+                logger.warning(f"inotify unavailable ({e}); polling every {settings.WATCH_POLL_INTERVAL_S}s")
+        self._task = loop.create_task(self._run(), name="inbox-watcher")
+
+    def _on_event(self):
+        self._inotify.drain()
+        self._wakeup.set()
+
+    async def _run(self):
+        # processing/ is reconciled first, so a restart resumes before it claims anything new
+        last_reconcile = None
+        while not self._closing:
+            pending = False
+            try:
+                if self._reconcile_due or last_reconcile is None or time.monotonic() - last_reconcile >= settings.WATCH_RECONCILE_INTERVAL_S:
+                    self._reconcile_due = False
+                    last_reconcile = time.monotonic()
+                    await self.reconcile()
+                pending = await self.scan()
+            except Exception as e:
+                self._metrics["errors"] += 1
+                logger.warning(f"Inbox scan failed: {e}")
+
+            self._wakeup.clear()
+            # Unsettled files are rechecked once their debounce window has passed
+            timeout = min(settings.WATCH_DEBOUNCE_S, settings.WATCH_POLL_INTERVAL_S) if pending else settings.WATCH_POLL_INTERVAL_S
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _list(self, directory: str) -> Tuple[List[Tuple[str, int, int]], Set[str]]:
+        """(path, size, mtime_ns) of candidate files, plus the files skipped for their extension."""
+        entries, skipped = [], set()
+        with os.scandir(directory) as it:
+            for entry in it:
+                # Dot-files are treated as in-progress copies (rsync, scp temp names)
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+                if os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                    skipped.add(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                entries.append((entry.path, st.st_size, st.st_mtime_ns))
+        return entries, skipped
+
+    def _settled(self, listing: List[Tuple[str, int, int]]) -> Tuple[List[str], bool]:
+        """Files whose size and mtime have not changed for the debounce window, oldest first."""
+        now = time.monotonic()
+        ready, pending = [], False
+        for path, size, mtime_ns in listing:
+            seen = self._seen.get(path)
+            if seen is None or seen[:2] != (size, mtime_ns):
+                self._seen[path] = (size, mtime_ns, now)
+                pending = True
+            elif not size:
+                continue
+            elif now - seen[2] >= settings.WATCH_DEBOUNCE_S:
+                ready.append((mtime_ns, path))
+            else:
+                pending = True
+        ready.sort()
+        return [path for _, path in ready], pending
+
+    async def scan(self) -> bool:
+        """One pass over every inbox; returns whether any file is still settling or waiting for room."""
+        loop = asyncio.get_running_loop()
+        self._metrics["scans"] += 1
+        pending = False
+        listed: Set[str] = set()
+        ignored: Set[str] = set()
+        for directory, company_id in self.dirs.items():
+            listing, skipped = await loop.run_in_executor(None, self._list, directory)
+            for path in skipped - self._ignored:
+                logger.info(f"Ignoring {path}: extension not in WATCH_EXTENSIONS")
+            ignored |= skipped
+            listed.update(path for path, _, _ in listing)
+            ready, unsettled = self._settled(listing)
+            pending |= unsettled
+            while ready and not self._closing:
+                room = settings.WATCH_MAX_INFLIGHT - len(self._inflight)
+                if room <= 0:
+                    # Backpressure: the rest waits on disk until pipelines finish
+                    self._room.clear()
+                    logger.info(f"{len(self._inflight)} documents in flight; waiting before claiming more")
+                    await self._room.wait()
+                    continue
+                n = min(room, settings.WATCH_BATCH_SIZE)
+                await self._ingest(directory, company_id, ready[:n])
+                ready = ready[n:]
+        for path in set(self._seen) - listed:
+            del self._seen[path]
+        self._ignored = ignored
+        return pending
+
+    def _hash(self, path: str) -> Tuple[bytes, str]:
+        with open(path, "rb") as f:
+            content = f.read()
+        return content, hashlib.sha256(content).hexdigest()
+
+    def _claim(self, directory: str, company_id: str, paths: List[str]) -> List[Tuple[str, str, str, bytes, str, str]]:
+        """Hashes, dedupes and renames a batch into processing/; returns the claimed documents."""
+        hashed = []
+        for path in paths:
+            try:
+                content, file_hash = self._hash(path)
+            except FileNotFoundError:
+                continue
+            hashed.append((path, content, file_hash))
+        known = existing_hashes(company_id, {h for _, _, h in hashed})
+
+        claimed = []
+        for path, content, file_hash in hashed:
+            name = os.path.basename(path)
+            if file_hash in known:
+                self._metrics["duplicates"] += 1
+                _move(path, os.path.join(directory, DONE_DIR), f"{known[file_hash]}__{name}")
+                logger.info(f"{path} duplicates document {known[file_hash]}; moved to {DONE_DIR}/")
+                continue
+            doc_id = str(uuid.uuid4())
+            known[file_hash] = doc_id
+            claimed_path = _move(path, os.path.join(directory, PROCESSING_DIR), f"{doc_id}__{name}")
+            claimed.append((doc_id, name, _file_type(name), content, file_hash, claimed_path))
+        if claimed:
+            register_documents(
+                [(doc_id, name, file_type, content, file_hash) for doc_id, name, file_type, content, file_hash, _ in claimed],
+                settings.WATCH_SOURCE_SYSTEM,
+                company_id,
+                settings.WATCH_BATCH_SIZE,
+            )
+        return claimed
+
+    async def _ingest(self, directory: str, company_id: str, paths: List[str]):
+        loop = asyncio.get_running_loop()
+        try:
+            claimed = await loop.run_in_executor(None, self._claim, directory, company_id, paths)
+        except Exception as e:
+            # Claimed files stay in processing/ (possibly half-registered); the next reconcile finishes them
+            self._reconcile_due = True
+            self._metrics["errors"] += 1
+            logger.warning(f"Registering documents from {directory} failed: {e}")
+            return
+        finally:
+            for path in paths:
+                self._seen.pop(path, None)
+        for doc_id, name, _, _, _, claimed_path in claimed:
+            self._submit(company_id, doc_id, claimed_path)
+        if claimed:
+            self._metrics["claimed"] += len(claimed)
+            logger.info(f"Registered {len(claimed)} documents from {directory} for {company_id}")
+
+    def _submit(self, company_id: str, doc_id: str, path: str, retry_count: int = 0):
+        self._inflight.add(doc_id)
+        pipeline_scheduler.submit(company_id, doc_id, functools.partial(self._process, path=path, retry_count=retry_count))
+
+    async def _process(self, doc_id: str, path: str, retry_count: int = 0):
+        try:
+            status = await orchestrator.process_invoice(doc_id, retry_count=retry_count)
+            # The file only leaves processing/ once the FINAL row and status are in Snowflake;
+            # otherwise a crash would lose a result whose file was already moved to done/
+            if status in _TERMINAL and await write_buffer.committed(doc_id):
+                await asyncio.get_running_loop().run_in_executor(None, self._settle, path, status)
+            else:
+                # Its status and ERROR_LOG row may still sit in the write buffer; reconcile must not
+                # resume it, and settles it once the terminal status is stored
+                self._parked.add(doc_id)
+        finally:
+            self._inflight.discard(doc_id)
+            self._room.set()
+
+    def _settle(self, path: str, status: str):
+        folder = _TERMINAL[status]
+        try:
+            _move(path, os.path.join(os.path.dirname(os.path.dirname(path)), folder), os.path.basename(path))
+            self._metrics["done" if folder == DONE_DIR else "failed"] += 1
+        except FileNotFoundError:
+            logger.warning(f"{path} disappeared before it could be moved to {folder}/")
+
+    def _claimed(self) -> List[Tuple[str, str, str]]:
+        """(directory, doc_id, path) of every file in processing/ that is not in flight here."""
+        claimed = []
+        for directory in self.dirs:
+            processing = os.path.join(directory, PROCESSING_DIR)
+            for name in os.listdir(processing):
+                doc_id = _claimed_doc_id(name)
+                if doc_id and doc_id not in self._inflight:
+                    claimed.append((directory, doc_id, os.path.join(processing, name)))
+        return claimed
+
+    def _register_orphans(self, orphans: List[Tuple[str, str, str]]):
+        """Registers files claimed before a crash or a failed INSERT, under the DOC_ID their name records."""
+        by_dir: Dict[str, list] = {}
+        for directory, doc_id, path in orphans:
+            name = os.path.basename(path).partition("__")[2]
+            content, file_hash = self._hash(path)
+            by_dir.setdefault(directory, []).append((doc_id, name, _file_type(name), content, file_hash))
+        for directory, documents in by_dir.items():
+            register_documents(documents, settings.WATCH_SOURCE_SYSTEM, self.dirs[directory], settings.WATCH_BATCH_SIZE)
+
+    async def reconcile(self) -> Dict[str, int]:
+        """
+        Brings processing/ in line with RAW_DOCUMENTS for files not in flight
+        in this process. Files whose document reached a terminal status (e.g.
+        after the retry queue re-ran it) move to done/ or failed/. Unregistered
+        claims are registered, and documents left queued or mid-pipeline by a
+        previous process are submitted again. Documents with ERROR_LOG history
+        belong to the retry queue and are left alone until they finish.
+        """
+        loop = asyncio.get_running_loop()
+        claimed = await loop.run_in_executor(None, self._claimed)
+        if not claimed:
+            return {"settled": 0, "resumed": 0}
+        statuses = await loop.run_in_executor(None, document_statuses, [doc_id for _, doc_id, _ in claimed])
+
+        orphans = [c for c in claimed if c[1] not in statuses]
+        if orphans:
+            await loop.run_in_executor(None, self._register_orphans, orphans)
+
+        settled = resumed = 0
+        for directory, doc_id, path in claimed:
+            status, errored = statuses.get(doc_id, ("uploaded", False))
+            if status in _TERMINAL:
+                await loop.run_in_executor(None, self._settle, path, status)
+                self._parked.discard(doc_id)
+                settled += 1
+            elif not errored and doc_id not in self._parked:
+                self._submit(self.dirs[directory], doc_id, path)
+                resumed += 1
+        self._metrics["resumed"] += resumed
+        if settled or resumed:
+            logger.info(f"Reconciled {PROCESSING_DIR}/: {settled} settled, {resumed} resumed")
+        return {"settled": settled, "resumed": resumed}
+
+    async def close(self):
+        self._closing = True
+        if self._room is not None:
+            self._room.set()
+        if self._inotify is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify.fileno())
+            self._inotify.close()
+            self._inotify = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "dirs": dict(self.dirs),
+            "mode": "inotify" if self._inotify is not None else "polling",
+            "inflight": len(self._inflight),
+            "parked": len(self._parked),
+            "settling": len(self._seen),
+            **self._metrics,
+        }
+
+
+inbox_watcher = InboxWatcher(dict(settings.WATCH_DIRS))
+
+
+async def main(run_retry_queue: bool = False):
+    """Standalone ingestion worker: same pipeline and buffers as the API process, fed from disk."""
+    init_db()
+    await write_buffer.start()
+    await asyncio.get_running_loop().run_in_executor(None, lambda: fx_rates.table)
+    vendor_stats.start()
+    if run_retry_queue:
+        retry_queue.start(orchestrator.process_invoice)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    inbox_watcher.start()
+    try:
+        await stop.wait()
+    finally:
+        logger.info(f"Stopping inbox watcher: {inbox_watcher.stats()}")
+        # Files of cancelled pipelines stay in processing/ and are resumed on the next start
+        await inbox_watcher.close()
+        await retry_queue.close()
+        await orchestrator.drain()
+        await write_buffer.close()
+        preprocessor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest invoices dropped into local inbox directories.")
+    parser.add_argument("--dir", action="append", default=[], metavar="PATH=COMPANY_ID",
+                        help="Inbox directory and its tenant; repeatable (default: WATCH_DIRS)")
+    parser.add_argument("--retry-queue", action="store_true",
+                        help="Also run the retry queue here, when no API process does")
+    args = parser.parse_args()
+
+    if args.dir:
+        inbox_watcher.dirs = dict(d.split("=", 1) if "=" in d else (d, settings.DEFAULT_COMPANY_ID) for d in args.dir)
+    asyncio.run(main(args.retry_queue))
@@ -0,0 +1,157 @@
+"""
+Micro-benchmark: CPU and allocations for the mapping -> carbon -> finalize ->
+serialize -> read-back path of a single invoice with many line items.
+
+"before" replays the previous list-of-dicts flow, "after" uses the column
+tables from app.models.line_items.
+
+    cd backend && python -m benchmarks.bench_line_items --lines 10000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from app.models.line_items import BreakdownTable, LineItemTable
+from app.models.schemas import (
+    AuditResult, CarbonResult, ExtractionResult, FinalResult, LineItem, MappingResult,
+)
+
+NAICS_CODE = "541512"
+NAICS_TITLE = "Computer Systems Design Services"
+FACTOR = 0.1
+
+
+class LegacyMappingResult(BaseModel):
+    vendor_canonical: str
+    standardized_line_items: List[Dict[str, Any]]
+    scope_category: str
+    naics_code: Optional[str] = None
+    mapping_confidence: float
+    rule_version: str
+
+
+class LegacyCarbonResult(BaseModel):
+    total_kg_co2e: float
+    spend_based_kg_co2e: float
+    logistics_kg_co2e: float = 0.0
+    distance_km: Optional[float] = None
+    scope: str
+    category: str
+    naics_code: Optional[str] = None
+    is_verified_match: bool = False
+    line_level_breakdown: List[Dict[str, Any]]
+
+
+class LegacyFinalResult(BaseModel):
+    doc_id: str
+    extraction: ExtractionResult
+    mapping: LegacyMappingResult
+    carbon: LegacyCarbonResult
+    audit: AuditResult
+    finalized_ts: datetime
+
+
+def make_extraction(lines: int) -> ExtractionResult:
+    items = [
+        LineItem(description=f"Consulting block {i}", quantity=2.0, unit_price=12.5, total=25.0, unit="hr")
+        for i in range(lines)
+    ]
+    total = 25.0 * lines
+    return ExtractionResult(
+        vendor_name="Acme Consulting", invoice_number="INV-1", invoice_date="2024-03-01",
+        currency="USD", line_items=items, subtotal=total, tax=0.0, grand_total=total,
+        extraction_confidence=0.95,
+    )
+
+
+AUDIT = AuditResult(is_valid=True, audit_flags=[], confidence_score=0.95)
+
+
+def run_before(extraction: ExtractionResult):
+    standardized = []
+    for item in extraction.line_items:
+        std_item = item.model_dump()
+        std_item["mapped_category"] = NAICS_TITLE
+        std_item["naics_code"] = NAICS_CODE
+        standardized.append(std_item)
+    mapping = LegacyMappingResult(
+        vendor_canonical="Acme", standardized_line_items=standardized, scope_category=NAICS_TITLE,
+        naics_code=NAICS_CODE, mapping_confidence=0.9, rule_version="bench",
+    )
+    breakdown = []
+    for item in mapping.standardized_line_items:
+        breakdown.append({
+            "description": item.get("description"),
+            "item_emissions": item.get("total", 0) * FACTOR,
+            "factor_used": FACTOR,
+        })
+    carbon = LegacyCarbonResult(
+        total_kg_co2e=extraction.grand_total * FACTOR, spend_based_kg_co2e=extraction.grand_total * FACTOR,
+        scope="Scope 3", category=NAICS_TITLE, naics_code=NAICS_CODE, line_level_breakdown=breakdown,
+    )
+    final = LegacyFinalResult(
+        doc_id="bench", extraction=extraction, mapping=mapping, carbon=carbon, audit=AUDIT,
+        finalized_ts=datetime.now(),
+    )
+    payload = final.model_dump_json()
+    data = json.loads(payload)
+    return LegacyFinalResult(**data)
+
+
+def run_after(extraction: ExtractionResult):
+    standardized = LineItemTable.from_line_items(extraction.line_items, NAICS_TITLE, NAICS_CODE)
+    mapping = MappingResult(
+        vendor_canonical="Acme", standardized_line_items=standardized, scope_category=NAICS_TITLE,
+        naics_code=NAICS_CODE, mapping_confidence=0.9, rule_version="bench",
+    )
+    carbon = CarbonResult(
+        total_kg_co2e=extraction.grand_total * FACTOR, spend_based_kg_co2e=extraction.grand_total * FACTOR,
+        scope="Scope 3", category=NAICS_TITLE, naics_code=NAICS_CODE,
+        line_level_breakdown=BreakdownTable.from_totals(mapping.standardized_line_items, FACTOR),
+    )
+    final = FinalResult(
+        doc_id="bench", extraction=extraction, mapping=mapping, carbon=carbon, audit=AUDIT,
+        finalized_ts=datetime.now(),
+    )
+    payload = final.model_dump_json()
+    return FinalResult.model_validate_json(payload)
+
+
+def measure(fn, extraction: ExtractionResult, repeat: int) -> Dict[str, float]:
+    fn(extraction)  # warm-up
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(extraction)
+    cpu_ms = (time.perf_counter() - start) / repeat * 1000
+
+    gc.collect()
+    tracemalloc.start()
+    result = fn(extraction)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"cpu_ms": cpu_ms, "peak_kib": peak / 1024, "retained_kib": retained / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    extraction = make_extraction(args.lines)
+    print(f"{args.lines} line items, {args.repeat} runs")
+    for name, fn in (("before", run_before), ("after", run_after)):
+        r = measure(fn, extraction, args.repeat)
+        print(f"{name:>6}: cpu {r['cpu_ms']:8.1f} ms | peak alloc {r['peak_kib']:9.0f} KiB | retained {r['retained_kib']:9.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark: payload size reduction from the OCR pre-processing stage and its
+effect on OCR latency.
+
+    cd backend && python -m benchmarks.bench_preprocess invoice1.jpg scan.pdf
+    cd backend && python -m benchmarks.bench_preprocess --ocr invoice1.jpg   # also calls Gemini
+
+With no files, a synthetic 12-megapixel skewed "receipt photo" and a
+synthetic 3-page 300-dpi scan are generated. The scan's second page holds
+only a totals line and its third is an empty sheet with scanner noise; the
+run fails if blank-page removal drops anything but the empty sheet.
+"""
+import argparse
+import asyncio
+import io
+import mimetypes
+import random
+import sys
+import time
+from typing import List, Tuple
+
+from PIL import Image, ImageDraw
+from pypdf import PdfReader
+
+from app.services.preprocess import preprocessor
+
+
+def synthetic_photo() -> Tuple[str, bytes, str]:
+    img = Image.new("RGB", (4000, 3000), (236, 232, 225))
+    draw = ImageDraw.Draw(img)
+    rng = random.Random(7)
+    for row in range(60):
+        y = 300 + row * 40
+        x = 600
+        while x < 3300:
+            w = rng.randint(20, 140)
+            draw.rectangle((x, y, x + w, y + 18), fill=(30, 30, 40))
+            x += w + rng.randint(10, 30)
+    img = img.rotate(2.5, fillcolor=(236, 232, 225))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=95)
+    return "synthetic_receipt.jpg", out.getvalue(), "image/jpeg"
+
+
+def synthetic_sparse_scan() -> Tuple[str, bytes, str]:
+    size = (2550, 3300)  # US Letter at 300 dpi
+    rng = random.Random(11)
+    pages = []
+    for lines in (30, 1, 0):
+        img = Image.new("L", size, 255)
+        draw = ImageDraw.Draw(img)
+        for row in range(lines):
+            # One short line near the bottom on the sparse page, like a carried-over total
+            y = 3000 if lines == 1 else 300 + row * 80
+            draw.text((1700 if lines == 1 else 250, y), f"Total due  USD {rng.randint(100, 99999):,}.00", fill=0)
+        for _ in range(40):
+            img.putpixel((rng.randrange(size[0]), rng.randrange(size[1])), 0)  # isolated scanner specks
+        pages.append(img)
+    out = io.BytesIO()
+    pages[0].save(out, format="PDF", save_all=True, append_images=pages[1:], resolution=300)
+    return "synthetic_sparse_scan.pdf", out.getvalue(), "application/pdf"
+
+
+def page_count(content: bytes, file_type: str) -> int:
+    return len(PdfReader(io.BytesIO(content)).pages) if file_type == "application/pdf" else 1
+
+
+def load(paths: List[str]) -> List[Tuple[str, bytes, str]]:
+    docs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            docs.append((path, f.read(), mimetypes.guess_type(path)[0] or "application/octet-stream"))
+    return docs
+
+
+async def time_ocr(content: bytes, file_type: str) -> float:
+    from app.services.ocr import ocr_agent
+    start = time.perf_counter()
+    await ocr_agent.extract(content, file_type)
+    return (time.perf_counter() - start) * 1000
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--ocr", action="store_true", help="Also time Gemini OCR on original vs processed payload")
+    args = parser.parse_args()
+
+    docs = load(args.files) if args.files else [synthetic_photo(), synthetic_sparse_scan()]
+    for name, content, file_type in docs:
+        data, out_type, stats = await preprocessor.preprocess(content, file_type)
+        ratio = stats.processed_bytes / stats.original_bytes if stats.original_bytes else 1.0
+        print(f"{name}: {stats.original_bytes:>10} -> {stats.processed_bytes:>10} bytes "
+              f"({ratio:6.1%}) in {stats.duration_ms:7.1f} ms [{', '.join(stats.operations)}]")
+        if name == "synthetic_sparse_scan.pdf" and page_count(data, out_type) != 2:
+            preprocessor.shutdown()
+            sys.exit(f"{name}: expected the 2 pages with text to survive, got {page_count(data, out_type)}")
+        if args.ocr:
+            before = await time_ocr(content, file_type)
+            after = await time_ocr(data, out_type)
+            print(f"    OCR latency: original {before:8.0f} ms | processed {after:8.0f} ms")
+    preprocessor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
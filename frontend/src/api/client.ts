@@ -1,9 +1,16 @@
 import axios from 'axios';
 
+// Tenant every request is scoped to; without it the backend uses its default company
+const companyId = import.meta.env.VITE_COMPANY_ID || localStorage.getItem('aerocarbon.companyId');
+// Proves the caller may act for that tenant when the backend has TENANT_TOKENS configured
+const tenantToken = import.meta.env.VITE_TENANT_TOKEN || localStorage.getItem('aerocarbon.tenantToken');
+
 const api = axios.create({
     baseURL: import.meta.env.VITE_API_URL || 'http://localhost:8000',
     headers: {
         'Content-Type': 'application/json',
+        ...(companyId ? { 'X-Company-ID': companyId } : {}),
+        ...(tenantToken ? { 'X-Tenant-Token': tenantToken } : {}),
     },
 });
 
@@ -0,0 +1,123 @@
+import axios from 'axios';
+import api from './client';
+import { UploadSession, InvoiceUploadResponse } from '../types';
+
+const PARALLEL_CHUNKS = 4;
+const MAX_ATTEMPTS = 6;
+const STORAGE_PREFIX = 'aerocarbon.upload.';
+
+export interface UploadProgress {
+    uploadedBytes: number;
+    totalBytes: number;
+}
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const toHex = (buffer: ArrayBuffer) =>
+    Array.from(new Uint8Array(buffer))
+        .map((b) => b.toString(16).padStart(2, '0'))
+        .join('');
+
+// crypto.subtle only exists in secure contexts (HTTPS or localhost); without it
+// chunks are sent without the optional checksum header
+const sha256 = async (blob: Blob): Promise<string | undefined> =>
+    globalThis.crypto?.subtle
+        ? toHex(await crypto.subtle.digest('SHA-256', await blob.arrayBuffer()))
+        : undefined;
+
+// Same file re-selected after a dropped connection resumes the same session
+const storageKey = (file: File) => `${STORAGE_PREFIX}${file.name}:${file.size}:${file.lastModified}`;
+
+const withRetry = async <T>(fn: () => Promise<T>): Promise<T> => {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await fn();
+        } catch (error: unknown) {
+            const status = axios.isAxiosError(error) ? error.response?.status : undefined;
+            // Other client errors (bad chunk, checksum mismatch) will not succeed on retry
+            const retryable = !status || status >= 500 || status === 408 || status === 429;
+            if (!retryable || attempt >= MAX_ATTEMPTS) throw error;
+            await sleep(Math.min(500 * 2 ** (attempt - 1), 15000) * (0.5 + Math.random()));
+        }
+    }
+};
+
+// The server refuses chunks once the upload has been turned into a document
+const isAlreadyCompleted = (error: unknown) => axios.isAxiosError(error) && error.response?.status === 409;
+
+const openSession = async (file: File): Promise<UploadSession> => {
+    const saved = localStorage.getItem(storageKey(file));
+    if (saved) {
+        try {
+            const { data } = await api.get<UploadSession>(`/uploads/${saved}`);
+            return data;
+        } catch {
+            localStorage.removeItem(storageKey(file));
+        }
+    }
+    const { data } = await withRetry(() =>
+        api.post<UploadSession>('/uploads', {
+            file_name: file.name,
+            file_type: file.type || 'application/octet-stream',
+            file_size: file.size,
+        })
+    );
+    localStorage.setItem(storageKey(file), data.upload_id);
+    return data;
+};
+
+/**
+ * Uploads a file as numbered chunks sent in parallel, retrying each chunk
+ * independently and resuming a previous session for the same file. A session
+ * that was already completed (its response lost) is completed again, which
+ * returns the existing document.
+ */
+export const uploadResumable = async (
+    file: File,
+    onProgress?: (progress: UploadProgress) => void
+): Promise<InvoiceUploadResponse> => {
+    const session = await openSession(file);
+    const { upload_id, chunk_size, total_chunks } = session;
+
+    const received = new Set(session.received_chunks);
+    const chunkBytes = (index: number) => Math.min(chunk_size, file.size - index * chunk_size);
+    let uploadedBytes = session.received_chunks.reduce((sum, i) => sum + chunkBytes(i), 0);
+    onProgress?.({ uploadedBytes, totalBytes: file.size });
+
+    // A session with a DOC_ID was completed; its chunks may already be gone
+    const pending = session.doc_id
+        ? []
+        : Array.from({ length: total_chunks }, (_, i) => i).filter((i) => !received.has(i));
+
+    const worker = async () => {
+        for (let index = pending.shift(); index !== undefined; index = pending.shift()) {
+            const chunk = file.slice(index * chunk_size, index * chunk_size + chunkBytes(index));
+            const checksum = await sha256(chunk);
+            const chunkIndex = index;
+            try {
+                await withRetry(() =>
+                    api.put(`/uploads/${upload_id}/chunks/${chunkIndex}`, chunk, {
+                        headers: {
+                            'Content-Type': 'application/octet-stream',
+                            ...(checksum ? { 'X-Chunk-SHA256': checksum } : {}),
+                        },
+                    })
+                );
+            } catch (error: unknown) {
+                if (!isAlreadyCompleted(error)) throw error;
+                pending.length = 0;
+                return;
+            }
+            uploadedBytes += chunk.size;
+            onProgress?.({ uploadedBytes, totalBytes: file.size });
+        }
+    };
+
+    await Promise.all(Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, worker));
+
+    const { data } = await withRetry(() =>
+        api.post<InvoiceUploadResponse>(`/uploads/${upload_id}/complete`, {})
+    );
+    localStorage.removeItem(storageKey(file));
+    return data;
+};
@@ -68,6 +68,9 @@ const InvoiceDetail: React.FC = () => {
     if (!data) return null;
 
     const { extraction, mapping, carbon, audit } = data;
+    // Emissions stay empty while the spend has no USD rate (see the "FX Rate Missing" audit flag)
+    const totalKg = carbon.total_kg_co2e ?? 0;
+    const formatKg = (kg: number | null) => (kg === null ? '—' : kg.toFixed(2));
 
     const isNotInvoice = audit.audit_flags.includes("Not an industry standard Invoice");
 
@@ -137,7 +140,7 @@ const InvoiceDetail: React.FC = () => {
                     <div className="text-slate-400 text-sm mb-1">Carbon Impact</div>
                     <div className="text-xl font-bold text-emerald-400 flex items-center gap-2 whitespace-nowrap overflow-hidden">
                         <Leaf className="w-5 h-5 shrink-0" />
-                        <span className="truncate" title={`${carbon.total_kg_co2e.toFixed(2)} kgCO2e`}>{carbon.total_kg_co2e.toFixed(2)}</span>
+                        <span className="truncate" title={`${formatKg(carbon.total_kg_co2e)} kgCO2e`}>{formatKg(carbon.total_kg_co2e)}</span>
                         <span className="text-sm text-slate-500">kgCO2e</span>
                     </div>
                 </div>
@@ -185,22 +188,22 @@ const InvoiceDetail: React.FC = () => {
                                 <Leaf className="w-16 h-16 text-emerald-400 animate-pulse" />
                             </div>
                             <div className="absolute -bottom-2 -right-2 bg-emerald-500 text-slate-900 font-bold text-lg w-12 h-12 rounded-full flex items-center justify-center border-4 border-slate-800">
-                                {Math.ceil(carbon.total_kg_co2e / 21)}
+                                {Math.ceil(totalKg / 21)}
                             </div>
                         </div>
                         <h3 className="text-2xl font-bold text-white mb-2">
                             Full Grown Trees
                         </h3>
                         <p className="text-slate-400 text-sm max-w-sm">
-                            It would take approximately <span className="text-emerald-400 font-bold">{Math.ceil(carbon.total_kg_co2e / 21)}</span> mature trees one full year to sequester the carbon emitted by this transaction.
+                            It would take approximately <span className="text-emerald-400 font-bold">{Math.ceil(totalKg / 21)}</span> mature trees one full year to sequester the carbon emitted by this transaction.
                         </p>
 
                         <div className="mt-8 flex gap-1 flex-wrap justify-center max-w-[300px]">
-                            {Array.from({ length: Math.min(Math.ceil(carbon.total_kg_co2e / 21), 24) }).map((_, i) => (
+                            {Array.from({ length: Math.min(Math.ceil(totalKg / 21), 24) }).map((_, i) => (
                                 <Leaf key={i} className="w-4 h-4 text-emerald-500/40" />
                             ))}
-                            {Math.ceil(carbon.total_kg_co2e / 21) > 24 && (
-                                <span className="text-xs text-slate-500 font-bold">... +{Math.ceil(carbon.total_kg_co2e / 21) - 24} more</span>
+                            {Math.ceil(totalKg / 21) > 24 && (
+                                <span className="text-xs text-slate-500 font-bold">... +{Math.ceil(totalKg / 21) - 24} more</span>
                             )}
                         </div>
                     </div>
@@ -250,7 +253,7 @@ const InvoiceDetail: React.FC = () => {
                         <div className="grid grid-cols-2 gap-4">
                             <div className="bg-slate-900/50 p-3 rounded-lg border border-slate-800">
                                 <label className="text-[10px] text-slate-500 uppercase">Spend-based Impact</label>
-                                <div className="text-white font-bold">{carbon.spend_based_kg_co2e.toFixed(2)} kg</div>
+                                <div className="text-white font-bold">{formatKg(carbon.spend_based_kg_co2e)} kg</div>
                             </div>
                             <div className="bg-slate-900/50 p-3 rounded-lg border border-slate-800">
                                 <label className="text-[10px] text-slate-500 uppercase">Logistics Impact</label>
@@ -297,7 +300,7 @@ const InvoiceDetail: React.FC = () => {
                             {(() => {
                                 // Calculate totals
                                 const totalSpend = extraction.grand_total || 1;
-                                const totalEmission = carbon.total_kg_co2e || 1;
+                                const totalEmission = totalKg || 1;
 
                                 // Combine and sort items by emission % descending
                                 const chartItems = carbon.line_level_breakdown.map((item: any, i: number) => {
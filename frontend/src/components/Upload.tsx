@@ -3,7 +3,7 @@ import React, { useState, useRef, useEffect } from 'react';
 import { motion, AnimatePresence, Variants } from 'framer-motion';
 import { Upload as UploadIcon, FileText, Scan, Map, Shield, CheckCircle, Loader, ArrowRight } from 'lucide-react';
 import { useNavigate } from 'react-router-dom';
-import api from '../api/client';
+import { uploadResumable } from '../api/upload';
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { faSeedling } from '@fortawesome/free-solid-svg-icons';
 
@@ -21,6 +21,7 @@ const Upload: React.FC = () => {
     const [file, setFile] = useState<File | null>(null);
     const [isDragging, setIsDragging] = useState(false);
     const [uploading, setUploading] = useState(false);
+    const [progress, setProgress] = useState(0);
 
     const navigate = useNavigate();
 
@@ -79,20 +80,17 @@ const Upload: React.FC = () => {
         if (!file) return;
 
         setUploading(true);
-
-        const formData = new FormData();
-        formData.append('file', file);
+        setProgress(0);
 
         try {
-            const response = await api.post('/upload', formData, {
-                headers: {
-                    'Content-Type': 'multipart/form-data',
-                },
+            // Chunked + resumable: a dropped connection only re-sends the missing chunks
+            const response = await uploadResumable(file, ({ uploadedBytes, totalBytes }) => {
+                setProgress(totalBytes ? Math.round((uploadedBytes / totalBytes) * 100) : 100);
             });
             // Animate out or show success before navigating?
             // For now, let's navigate after a brief delay to show the "success" state
             setTimeout(() => {
-                navigate(`/invoice/${response.data.doc_id}`);
+                navigate(`/invoice/${response.doc_id}`);
             }, 1000);
         } catch (error) {
             console.error(error);
@@ -306,7 +304,9 @@ const Upload: React.FC = () => {
                                 className="mt-8 flex items-center gap-3 text-emerald-400 bg-emerald-500/10 px-6 py-3 rounded-full border border-emerald-500/20"
                             >
                                 <Loader className="w-5 h-5 animate-spin" />
-                                <span className="font-mono">Processing Invoice Data...</span>
+                                <span className="font-mono">
+                                    {progress < 100 ? `Uploading... ${progress}%` : 'Processing Invoice Data...'}
+                                </span>
                             </motion.div>
                         )}
                     </AnimatePresence>
@@ -5,6 +5,20 @@ export interface Invoice {
     upload_ts: string;
 }
 
+export interface InvoiceUploadResponse {
+    doc_id: string;
+    status: string;
+    message: string;
+}
+
+export interface UploadSession {
+    upload_id: string;
+    chunk_size: number;
+    total_chunks: number;
+    received_chunks: number[];
+    doc_id?: string | null;
+}
+
 export interface LineItem {
     description: string;
     quantity: number;
@@ -46,8 +60,8 @@ export interface MappingResult {
 }
 
 export interface CarbonResult {
-    total_kg_co2e: number;
-    spend_based_kg_co2e: number;
+    total_kg_co2e: number | null;  // null while the spend has no USD rate
+    spend_based_kg_co2e: number | null;
     logistics_kg_co2e: number;
     distance_km?: number;
     scope: string;